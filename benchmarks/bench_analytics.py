@@ -0,0 +1,82 @@
+"""
+Times the aggregations in scrutiny/analytics.py over a month of synthetic
+attempts, against doing the same with Counter over the tuples the log
+readers hand back (on a sample, scaled up, as it takes a while).
+
+    python benchmarks/bench_analytics.py [number of events]
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from scrutiny.analytics import EventStore, EventColumns
+
+SAMPLE = 500000
+
+
+def make_store(count, addresses=50000, usernames=5000):
+    rng = numpy.random.default_rng(0)
+    store = EventStore()
+    for number in range(addresses):
+        store.addresses.encode('{}.{}.{}.{}'.format(1 + number % 223, number // 7 % 256,
+                                                    number // 3 % 256, number % 256))
+    for number in range(usernames):
+        store.usernames.encode('user{}'.format(number))
+    start = int(datetime(2014, 6, 1).timestamp())
+    # A few addresses and names account for most of the attempts
+    timestamps = numpy.sort(rng.integers(start, start + 30 * 24 * 60 * 60, count))
+    ips = numpy.minimum(rng.zipf(1.3, count), addresses) - 1
+    users = numpy.minimum(rng.zipf(1.5, count), usernames) - 1
+    store.attempts = EventColumns(store, timestamps, ips, users)
+    return store
+
+
+def counter_version(store, count):
+    # What it takes with the events as tuples
+    addresses = store.addresses.values
+    usernames = store.usernames.values
+    events = [(datetime.utcfromtimestamp(timestamp), addresses[ip], usernames[user])
+              for timestamp, ip, user in zip(store.attempts.timestamps[:count].tolist(),
+                                             store.attempts.ips[:count].tolist(),
+                                             store.attempts.users[:count].tolist())]
+    start = time.perf_counter()
+    Counter(ip for date, ip, user in events).most_common(10)
+    Counter(user for date, ip, user in events).most_common(10)
+    Counter(date.date() for date, ip, user in events)
+    Counter(ip.rsplit('.', 1)[0] for date, ip, user in events).most_common(10)
+    return time.perf_counter() - start
+
+
+def bench(name, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('{:<12} {:.3f}s'.format(name, elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    store = make_store(count)
+    attempts = store.attempts
+    print('{} events, {} addresses, {} usernames'.format(count, len(store.addresses),
+                                                        len(store.usernames)))
+    total = 0
+    total += bench('top_ips', lambda: attempts.top_ips(10))
+    total += bench('top_users', lambda: attempts.top_users(10))
+    total += bench('histogram', lambda: attempts.histogram(60 * 60))
+    total += bench('networks', lambda: attempts.networks(24, limit=10))
+    total += bench('between', lambda: attempts.between(datetime(2014, 6, 8), datetime(2014, 6, 15)))
+    print('{:<12} {:.3f}s'.format('total', total))
+
+    sample = min(SAMPLE, count)
+    elapsed = counter_version(store, sample)
+    print('{:<12} {:.3f}s for {} events, ~{:.1f}s for {}'.format('Counter', elapsed, sample,
+                                                                 elapsed * count / sample, count))
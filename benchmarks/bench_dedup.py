@@ -0,0 +1,87 @@
+"""
+Times Scrutiny.insert_into_db putting the same events into the database a
+second time, as a rerun over logs that have already been read does, with
+and without the dedup filter (see scrutiny/dedup.py) and with and without
+the unique indexes. Then the same with events that are all new.
+
+    python benchmarks/bench_dedup.py [number of events]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+
+from scrutiny import Scrutiny
+from scrutiny.metrics import Metrics
+
+
+class BenchScrutiny(Scrutiny):
+
+    """
+    Scrutiny with its own database rather than the one in settings.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        super().__init__()
+        self.logger.setLevel(logging.WARNING)
+
+    def get_engine(self):
+        return create_engine('sqlite:///' + self.database)
+
+
+def make_events(count, start):
+    random.seed(count)
+    ips = ['{}.{}.{}.{}'.format(random.randint(1, 223), random.randint(0, 255),
+                                random.randint(0, 255), random.randint(1, 254))
+           for i in range(1000)]
+    breakin_attempts = {}
+    for number in range(count):
+        breakin_attempts[(start + timedelta(seconds=number // 3), number % 3)] = \
+            (random.choice(ips), 'user{}'.format(random.randint(0, 500)))
+    return breakin_attempts
+
+
+def insert(database, breakin_attempts, dedup_filter, unique_indexes):
+    scrutiny = BenchScrutiny(database)
+    scrutiny.metrics = Metrics()
+    scrutiny.dedup_filter_file = database + '.bloom' if dedup_filter else None
+    if not unique_indexes:
+        scrutiny.unique_indexes = False
+    # Loading or building the filter isn't part of what's being timed
+    scrutiny.get_dedup_filter()
+    ips = set(ip for ip, user in breakin_attempts.values())
+    start = time.perf_counter()
+    inserted = scrutiny.insert_into_db(ips, breakin_attempts, {})
+    elapsed = time.perf_counter() - start
+    scrutiny.session.close()
+    return inserted, elapsed, scrutiny.metrics.counters['dedup_lookups']
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    events = make_events(count, datetime(2014, 6, 1))
+    new_events = make_events(count, datetime(2014, 7, 1))
+    temp_dir = tempfile.mkdtemp()
+    print('{} events'.format(count))
+    print('{:<8} {:<15} {:>9} {:>9} {:>9}'.format('filter', 'unique indexes', 'rerun', 'new',
+                                                  'lookups'))
+    for number, (dedup_filter, unique_indexes) in enumerate(((False, True), (True, True),
+                                                             (False, False), (True, False))):
+        database = os.path.join(temp_dir, 'bench{}.db'.format(number))
+        insert(database, events, dedup_filter, unique_indexes)
+        inserted, rerun, lookups = insert(database, events, dedup_filter, unique_indexes)
+        assert inserted == 0, inserted
+        inserted, new, new_lookups = insert(database, new_events, dedup_filter, unique_indexes)
+        assert inserted == count, inserted
+        print('{:<8} {:<15} {:>8.2f}s {:>8.2f}s {:>9}'.format(
+            'yes' if dedup_filter else 'no', 'yes' if unique_indexes else 'no',
+            rerun, new, lookups + new_lookups))
@@ -0,0 +1,92 @@
+"""
+Benchmark for reading sshd's entries out of journalctl -o json output,
+compares the old approach of two uncompiled re.match calls per entry against
+JournalStreamReader's batches and compiled matcher.
+
+    python benchmarks/bench_journal.py [number of entries]
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrutiny.handlers.journal import JournalStreamReader
+
+# The patterns as they were before, with the doubled braces fixed so they
+# match anything at all
+OLD_INVALID_USER_MATCH = r"Invalid user (?P<user>.*) from (?P<ip_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
+OLD_USER_NOT_ALLOWED = r"User (?P<user>.*) from (?P<ip_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) not allowed"
+
+NOISE = [
+    'Accepted publickey for jordan from 10.0.0.4 port 51234 ssh2',
+    'pam_unix(sshd:session): session opened for user jordan by (uid=0)',
+    'Received disconnect from 10.0.0.4 port 51234:11: disconnected by user',
+    'Connection closed by 61.174.51.217 port 40022 [preauth]',
+]
+MATCHES = [
+    'Invalid user admin from 61.174.51.217',
+    "User root from 116.10.191.234 not allowed because none of user's groups are listed in AllowGroups",
+]
+
+
+def make_stream(count, match_ratio=0.05):
+    random.seed(0)
+    start = 1428482368000000
+    lines = []
+    for i in range(count):
+        if random.random() < match_ratio:
+            message = random.choice(MATCHES)
+        else:
+            message = random.choice(NOISE)
+        realtime = start + i * 1000
+        lines.append(json.dumps({
+            '__CURSOR': 's=c2af;i={:x};b=19c7;m={:x};t={:x};x=7130'.format(i, i, realtime),
+            '__REALTIME_TIMESTAMP': str(realtime),
+            '_SYSTEMD_UNIT': 'sshd.service',
+            'MESSAGE': message,
+        }))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def old_match(data):
+    matches = {}
+    for line in io.BytesIO(data):
+        entry = json.loads(line)
+        entry_time = entry['__REALTIME_TIMESTAMP']
+        match = re.match(OLD_INVALID_USER_MATCH, entry['MESSAGE'])
+        if match:
+            matches[entry_time] = (match.group('ip_addr'), match.group('user'))
+        match = re.match(OLD_USER_NOT_ALLOWED, entry['MESSAGE'])
+        if match:
+            matches[entry_time] = (match.group('ip_addr'), match.group('user'))
+    return len(matches)
+
+
+def new_match(data):
+    found = 0
+    for matches, cursor in JournalStreamReader(io.BytesIO(data)).batches():
+        found += len(matches)
+    return found
+
+
+def bench(name, func, data, count):
+    start = time.perf_counter()
+    found = func(data)
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>10.0f} entries/sec ({} matches in {:.3f}s)'.format(name, count / elapsed,
+                                                                    found, elapsed))
+    return found
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data = make_stream(count)
+    before = bench('before', old_match, data, count)
+    after = bench('after', new_match, data, count)
+    assert before == after, 'Readers disagree ({} vs {})'.format(before, after)
@@ -0,0 +1,119 @@
+"""
+Micro-benchmark for matching auth.log lines, compares the old approach of
+two uncompiled re.search calls per line against the compiled LineMatcher.
+Then adds more and more rules for other services to the auth rules, to see
+that the cost of a line stays about the same however many there are,
+against searching for each rule's pattern in turn.
+
+    python benchmarks/bench_matcher.py [number of lines]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrutiny.matchers import LineMatcher
+from scrutiny.rules import LOG_SOURCES
+
+AUTH_LOG_MATCHER = LOG_SOURCES['auth'].matcher
+
+# The patterns as they were before the matchers were introduced
+OLD_SEARCH_STRING = '(?P<log_date>^.*) defestri sshd.*Invalid user (?P<user>.*) from (?P<ip_add>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+OLD_ROOT_NOT_ALLOWED_SEARCH_STRING = '(?P<log_date>^.*) defestri sshd.*User (?P<user>.*) from (?P<ip_add>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) not allowed'
+
+NOISE = [
+    'Jun 10 12:40:06 defestri CRON[11020]: pam_unix(cron:session): session opened for user root by (uid=0)',
+    'Jun 10 12:40:06 defestri CRON[11020]: pam_unix(cron:session): session closed for user root',
+    'Jun 10 12:40:07 defestri sshd[11021]: Accepted publickey for jordan from 10.0.0.4 port 51234 ssh2',
+    'Jun 10 12:40:08 defestri sshd[11021]: pam_unix(sshd:session): session opened for user jordan by (uid=0)',
+    'Jun 10 12:40:09 defestri sudo:   jordan : TTY=pts/0 ; PWD=/home/jordan ; USER=root ; COMMAND=/usr/bin/apt-get update',
+]
+MATCHES = [
+    'Jun 10 12:40:05 defestri sshd[11019]: Invalid user admin from 61.174.51.217',
+    "Jun  8 04:31:10 defestri sshd[5013]: User root from 116.10.191.234 not allowed because none of user's groups are listed in AllowGroups",
+]
+
+
+def make_lines(count, match_ratio=0.01):
+    random.seed(0)
+    lines = []
+    for i in range(count):
+        if random.random() < match_ratio:
+            lines.append(random.choice(MATCHES))
+        else:
+            lines.append(random.choice(NOISE))
+    return lines
+
+
+def old_match(lines):
+    found = 0
+    for line in lines:
+        m = re.search(OLD_SEARCH_STRING, line)
+        if m is None:
+            m = re.search(OLD_ROOT_NOT_ALLOWED_SEARCH_STRING, line)
+        if m:
+            found += 1
+    return found
+
+
+def new_match(lines):
+    found = 0
+    for line in lines:
+        m = AUTH_LOG_MATCHER.match(line)
+        if m:
+            found += 1
+    return found
+
+
+def extra_rules(count):
+    return [('service{} failed'.format(number),
+             r'^(?P<log_date>\S+ +\d+ \S+) defestri service{0}\[\d+\]: service{0} failed for '
+             r'(?P<user>\S+) from (?P<ip_add>\S+)'.format(number))
+            for number in range(count)]
+
+
+def scaling(lines):
+    print('rules    LineMatcher     one search per rule (lines/sec)')
+    base = [(keyword, pattern) for name, keyword, pattern in LOG_SOURCES['auth'].rules]
+    for count in (0, 10, 50, 200):
+        rules = base + extra_rules(count)
+        matcher = LineMatcher(rules)
+        regexes = [re.compile(pattern) for keyword, pattern in rules]
+
+        start = time.perf_counter()
+        indexed = sum(1 for line in lines if matcher.match(line))
+        indexed_rate = len(lines) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sequential = 0
+        for line in lines:
+            for regex in regexes:
+                if regex.search(line):
+                    sequential += 1
+                    break
+        sequential_rate = len(lines) / (time.perf_counter() - start)
+
+        assert indexed == sequential, 'Matchers disagree ({} vs {})'.format(indexed, sequential)
+        print('{:<8} {:>11.0f} {:>15.0f}'.format(len(rules), indexed_rate, sequential_rate))
+
+
+def bench(name, func, lines):
+    start = time.perf_counter()
+    found = func(lines)
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>10.0f} lines/sec ({} matches in {:.3f}s)'.format(name, len(lines) / elapsed,
+                                                                  found, elapsed))
+    return found
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lines = make_lines(count)
+    before = bench('before', old_match, lines)
+    after = bench('after', new_match, lines)
+    assert before == after, 'Matchers disagree ({} vs {})'.format(before, after)
+    scaling(lines)
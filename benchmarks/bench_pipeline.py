@@ -0,0 +1,234 @@
+"""
+End to end benchmark, generates a corpus with generate_logs.py (or reuses
+one) and times each stage of getting it into the database on its own:
+
+    read       reading and decoding every line of every file
+    match      running the matchers over them, less the time spent reading
+    scan       reading and matching with LogFile.matches, which memory maps the
+               uncompressed files and only decodes the lines that match
+    timestamp  parsing the dates of the lines that matched
+    read_logs  LogFileReader.read_logs, all of the above as Scrutiny does it
+    insert     Scrutiny.insert_into_db into a fresh SQLite database
+    subnets    Scrutiny.calculate_common_subnets
+    geoip      looking up every attacker in a local GeoIP database
+
+The results are written out as JSON so runs can be compared over time.
+
+    python benchmarks/bench_pipeline.py [--lines N] [--log-dir DIR] [--output FILE] ...
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+
+from scrutiny import Scrutiny, SubnetDetails
+from scrutiny.geoip import LocalLocationProvider, compile_location_database
+from scrutiny.handlers.file import LogFile, LogFileReader
+from scrutiny.settings import PARSE_WORKERS
+from scrutiny.timestamps import SyslogTimestampParser, Fail2banTimestampParser
+
+from generate_logs import add_arguments, generate_from_args
+
+
+class BenchScrutiny(Scrutiny):
+
+    """
+    Scrutiny with its own database rather than the one in settings.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        super().__init__()
+
+    def get_engine(self):
+        return create_engine('sqlite:///' + self.database)
+
+
+class Stages():
+
+    def __init__(self):
+        self.results = {}
+
+    def time(self, name, func, *args, after=None):
+
+        """
+        Runs func, records how long it took and returns whatever it
+        returned. func returns a (result, items) tuple, items being how many
+        lines, matches, rows or addresses it got through. If the stage can't
+        be run without redoing an earlier one, that stage's time is taken
+        back off.
+        """
+
+        start = time.perf_counter()
+        result, items = func(*args)
+        elapsed = time.perf_counter() - start
+        if after is not None:
+            elapsed = max(elapsed - self.results[after]['seconds'], 0)
+        self.record(name, elapsed, items)
+        return result
+
+    def record(self, name, elapsed, items):
+        self.results[name] = {
+            'seconds': round(elapsed, 4),
+            'items': items,
+            'per_second': round(items / elapsed) if elapsed else None,
+        }
+        print('{:<10} {:>10.3f}s {:>12} items {:>12} /sec'.format(
+            name, elapsed, items, self.results[name]['per_second']), file=sys.stderr)
+
+
+def log_files(log_dir):
+    return LogFileReader().get_log_files(log_dir)
+
+
+def read_stage(log_dir):
+    count = 0
+    for path, source in log_files(log_dir):
+        for line in LogFile(path).lines():
+            count += 1
+    return None, count
+
+
+def match_stage(log_dir):
+    count = 0
+    matches = []
+    for path, source in log_files(log_dir):
+        for line in LogFile(path).lines():
+            count += 1
+            m = source.matcher.match(line)
+            if m:
+                matches.append((source, m))
+    return matches, count
+
+
+def scan_stage(log_dir):
+    count = 0
+    for path, source in log_files(log_dir):
+        log_file = LogFile(path)
+        for m in log_file.matches(source.matcher):
+            pass
+        count += log_file.lines_read
+    return None, count
+
+
+def timestamp_stage(matches):
+    syslog_parser = SyslogTimestampParser()
+    fail2ban_parser = Fail2banTimestampParser()
+    for source, m in matches:
+        if source.timestamp == 'syslog':
+            syslog_parser.parse(m['log_date'])
+        else:
+            fail2ban_parser.parse(m['log_date'])
+    return None, len(matches)
+
+
+def read_logs_stage(log_dir, workers):
+    reader = LogFileReader()
+    breakin_attempt, banned_ip = reader.read_logs(log_dir, workers)
+    return (breakin_attempt, banned_ip), len(breakin_attempt) + len(banned_ip)
+
+
+def insert_stage(scrutiny, breakin_attempt, banned_ip):
+    unique_ips = set(ip for ip, user in breakin_attempt.values())
+    return None, scrutiny.insert_into_db(unique_ips, breakin_attempt, banned_ip)
+
+
+def subnets_stage(scrutiny):
+    scrutiny.calculate_common_subnets()
+    return None, scrutiny.session.query(SubnetDetails).count()
+
+
+def write_location_csv(path, ips):
+    # One range per /24 the attackers are in
+    networks = sorted(set(ip.rsplit('.', 1)[0] for ip in ips),
+                      key=lambda network: [int(part) for part in network.split('.')])
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('start,end,country,region,city\n')
+        for index, network in enumerate(networks):
+            f.write('{0}.0,{0}.255,Country {1},Region {1},\n'.format(network, index % 200))
+
+
+def geoip_stage(database, ips):
+    provider = LocalLocationProvider(database)
+    try:
+        found = sum(1 for ip in ips if provider.lookup(ip))
+    finally:
+        provider.close()
+    return found, len(ips)
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='scrutiny-bench-')
+    try:
+        log_dir = args.log_dir
+        corpus = None
+        if log_dir is None:
+            log_dir = os.path.join(work_dir, 'logs')
+            start = time.perf_counter()
+            corpus = generate_from_args(log_dir, args)
+            corpus['generate_seconds'] = round(time.perf_counter() - start, 4)
+
+        stages = Stages()
+        stages.time('read', read_stage, log_dir)
+        matches = stages.time('match', match_stage, log_dir, after='read')
+        stages.time('scan', scan_stage, log_dir)
+        stages.time('timestamp', timestamp_stage, matches)
+        breakin_attempt, banned_ip = stages.time('read_logs', read_logs_stage,
+                                                 log_dir, args.workers)
+
+        scrutiny = BenchScrutiny(os.path.join(work_dir, 'bench.db'))
+        scrutiny.create_db()
+        stages.time('insert', insert_stage, scrutiny, breakin_attempt, banned_ip)
+        stages.time('subnets', subnets_stage, scrutiny)
+        scrutiny.session.close()
+
+        ips = sorted(set(ip for ip, user in breakin_attempt.values()) | set(banned_ip.values()))
+        csv_path = os.path.join(work_dir, 'ranges.csv')
+        database = os.path.join(work_dir, 'ranges.geo')
+        write_location_csv(csv_path, ips)
+        compile_location_database(csv_path, database)
+        stages.time('geoip', geoip_stage, database, ips)
+
+        return {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'workers': args.workers,
+            'corpus': corpus or {'log_dir': log_dir},
+            'stages': stages.results,
+        }
+    finally:
+        if args.keep:
+            print('Left the corpus and database in {}'.format(work_dir), file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Scrutiny end to end benchmark.')
+    add_arguments(arg_parser)
+    arg_parser.add_argument('--log-dir',
+                            help="Benchmark an existing corpus instead of generating one.")
+    arg_parser.add_argument('--workers', type=int, default=PARSE_WORKERS,
+                            help="Number of processes for read_logs.")
+    arg_parser.add_argument('--output',
+                            help="Write the results to this file rather than stdout.")
+    arg_parser.add_argument('--keep', action='store_true',
+                            help="Keep the generated corpus and database afterwards.")
+    args = arg_parser.parse_args()
+
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print(results)
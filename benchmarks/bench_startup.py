@@ -0,0 +1,76 @@
+"""
+Times how long Scrutiny takes to get going, which for a cron job or a
+follower that's restarted is paid on every run: importing the package,
+then creating a Scrutiny against a database that's already set up. Each is
+run in a fresh interpreter a number of times and the best kept. Also lists
+the slowest imports according to python -X importtime.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = '''
+import time
+start = time.perf_counter()
+import scrutiny
+print(time.perf_counter() - start)
+'''
+
+CREATE = '''
+import sys, time
+start = time.perf_counter()
+from sqlalchemy import create_engine
+from scrutiny import Scrutiny
+class BenchScrutiny(Scrutiny):
+    def get_engine(self):
+        return create_engine('sqlite:///' + sys.argv[1])
+BenchScrutiny()
+print(time.perf_counter() - start)
+'''
+
+
+def best(code, runs, *args):
+    times = []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, '-c', code] + list(args), cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True, universal_newlines=True).stdout
+        times.append(float(output.split()[-1]))
+    return min(times)
+
+
+def slowest_imports(count=10):
+    # python -X importtime writes "import time: self | cumulative | name"
+    # to stderr for every module imported
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import scrutiny'],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            check=True, universal_newlines=True).stderr
+    found = []
+    for line in output.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            found.append((int(fields[1]), fields[2].strip()))
+    return sorted(found, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    temp_dir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(temp_dir, 'app.db')
+        # The first one sets the database up
+        best(CREATE, 1, database)
+        print('import scrutiny   {:.3f}s'.format(best(IMPORT, runs)))
+        print('Scrutiny()        {:.3f}s (import included)'.format(best(CREATE, runs, database)))
+    finally:
+        shutil.rmtree(temp_dir)
+    print('slowest imports (cumulative, us):')
+    for cumulative, name in slowest_imports():
+        print('  {:>8} {}'.format(cumulative, name))
@@ -0,0 +1,78 @@
+"""
+Benchmark for grouping repeat offenders into common subnets, the sort based
+group_common_subnets against the old compare-everything-with-everything
+loop (only run for the smaller sizes, it's quadratic).
+
+    python benchmarks/bench_subnets.py [size ...]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrutiny.netutils import group_common_subnets
+
+OLD_LIMIT = 2000
+
+
+def make_ips(count):
+    # Attackers tend to come from the same few networks, so draw them from a
+    # limited set of /16s
+    random.seed(0)
+    networks = [(random.randint(1, 223), random.randint(0, 255)) for i in range(max(count // 50, 1))]
+    ips = set()
+    while len(ips) < count:
+        a, b = random.choice(networks)
+        ips.add('{}.{}.{}.{}'.format(a, b, random.randint(0, 255), random.randint(0, 255)))
+    return list(ips)
+
+
+def compare_ip_strings(ip_addr1, ip_addr2):
+    ip_list1 = ip_addr1.split('.')
+    ip_list2 = ip_addr2.split('.')
+    for index, i in enumerate(ip_list1):
+        if int(i) != int(ip_list2[index]):
+            return [0, 8, 16, 24][index]
+
+
+def old_group_common_subnets(ips):
+    subnet24 = {}
+    subnet16 = {}
+    for index, ip in enumerate(ips):
+        for index2, comparison_ip in enumerate(ips):
+            if index != index2:
+                result = compare_ip_strings(ip, comparison_ip)
+                if result == 16:
+                    subnet16.setdefault(ip.rsplit('.', 2)[0], []).append(ip)
+                elif result == 24:
+                    subnet24.setdefault(ip.rsplit('.', 1)[0], []).append(ip)
+    subnet24 = dict((k, sorted(set(v))) for k, v in subnet24.items() if len(v) >= 2)
+    subnet16 = dict((k, sorted(set(v))) for k, v in subnet16.items() if len(v) >= 2)
+    return subnet24, subnet16
+
+
+def timed(func, ips):
+    start = time.perf_counter()
+    result = func(ips)
+    return result, time.perf_counter() - start
+
+
+def normalise(result):
+    # The old version sorts as strings, the new one numerically
+    return [dict((k, sorted(v)) for k, v in subnets.items()) for subnets in result]
+
+
+if __name__ == '__main__':
+    sizes = [int(i) for i in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    for size in sizes:
+        ips = make_ips(size)
+        new, new_time = timed(group_common_subnets, ips)
+        line = '{:>8} IPs  new {:8.3f}s'.format(size, new_time)
+        if size <= OLD_LIMIT:
+            old, old_time = timed(old_group_common_subnets, ips)
+            assert normalise(old) == normalise(new), 'Groupings differ'
+            line += '  old {:8.3f}s'.format(old_time)
+        print(line)
@@ -0,0 +1,54 @@
+"""
+Benchmark for parsing syslog and fail2ban timestamps, datetime.strptime
+against the parsers in scrutiny/timestamps.py.
+
+    python benchmarks/bench_timestamps.py [number of timestamps]
+"""
+
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrutiny.timestamps import SyslogTimestampParser, Fail2banTimestampParser
+
+
+def make_timestamps(count):
+    # A month's worth, in order like they'd be in a log
+    random.seed(0)
+    start = datetime(2014, 6, 1)
+    seconds = sorted(random.randint(0, 30 * 24 * 60 * 60) for i in range(count))
+    dates = [start + timedelta(seconds=second, milliseconds=random.randint(0, 999))
+             for second in seconds]
+    syslog = [date.strftime('%b %d %H:%M:%S').replace(' 0', '  ', 1) for date in dates]
+    fail2ban = [date.strftime('%Y-%m-%d %H:%M:%S,') + '{:03}'.format(date.microsecond // 1000)
+                for date in dates]
+    return syslog, fail2ban
+
+
+def bench(name, func, timestamps):
+    start = time.perf_counter()
+    result = [func(timestamp) for timestamp in timestamps]
+    elapsed = time.perf_counter() - start
+    print('{:<20} {:>10.0f} timestamps/sec'.format(name, len(timestamps) / elapsed))
+    return result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    syslog, fail2ban = make_timestamps(count)
+
+    before = bench('syslog strptime',
+                   lambda text: datetime.strptime(text, '%b %d %H:%M:%S').replace(year=2014),
+                   syslog)
+    after = bench('syslog parser', SyslogTimestampParser(year=2014).parse, syslog)
+    assert before == after, 'Syslog parsers disagree'
+
+    before = bench('fail2ban strptime',
+                   lambda text: datetime.strptime(text, '%Y-%m-%d %H:%M:%S,%f'),
+                   fail2ban)
+    after = bench('fail2ban parser', Fail2banTimestampParser().parse, fail2ban)
+    assert before == after, 'fail2ban parsers disagree'
@@ -0,0 +1,123 @@
+"""
+Times matching batches of auth.log lines and inserting what's found, as the
+journal and --hosts do, with each batch written as soon as it's matched and
+with the DB writer thread (see scrutiny/writer.py) writing one batch while
+the next is matched. Both against SQLite as it was (rollback journal, full
+fsync on every commit) and in WAL mode with synchronous=NORMAL, on their own
+and with something reading the database the whole time, as the reports do.
+
+    python benchmarks/bench_writer.py [batches] [lines per batch]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+import scrutiny.engine
+from scrutiny import Scrutiny
+from scrutiny.rules import LOG_SOURCES
+from scrutiny.writer import DBWriter
+
+
+class BenchScrutiny(Scrutiny):
+
+    """
+    Scrutiny with its own database rather than the one in settings.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        super().__init__()
+        self.logger.setLevel(logging.WARNING)
+
+    def get_engine(self):
+        return create_engine('sqlite:///' + self.database)
+
+
+def make_batches(count, size):
+    random.seed(count)
+    start = datetime(2014, 6, 1)
+    batches = []
+    for number in range(count):
+        lines = []
+        for line in range(size):
+            log_date = start + timedelta(seconds=number * size + line)
+            lines.append('{} defestri sshd[1]: Invalid user user{} from 61.174.{}.{}\n'.format(
+                log_date.strftime('%b %d %H:%M:%S'), random.randint(0, 500),
+                random.randint(0, 255), random.randint(1, 254)))
+        # Lines that don't match, as most of auth.log doesn't
+        lines += ['{} defestri sshd[1]: Connection closed by 10.0.0.4\n'.format(
+            start.strftime('%b %d %H:%M:%S'))] * size * 4
+        batches.append(lines)
+    return batches
+
+
+def read_continuously(database, stop):
+    # Counts the attempts so far, over and over, in a process of its own
+    # in whatever journal mode the writer put the database in
+    engine = create_engine('sqlite:///' + database)
+    while not stop.is_set():
+        with engine.connect() as connection:
+            connection.execute('SELECT ipaddr, count(*) FROM breakinattempts '
+                               'GROUP BY ipaddr').fetchall()
+    engine.dispose()
+
+
+def run(database, batches, threaded, reader):
+    bench = BenchScrutiny(database)
+    source = LOG_SOURCES['auth']
+    # Not forked, a child mustn't inherit our SQLite connections
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    if reader:
+        reader = context.Process(target=read_continuously, args=(database, stop))
+        reader.start()
+    try:
+        start = time.perf_counter()
+        with DBWriter(bench, threaded=threaded) as writer:
+            for lines in batches:
+                matches = list(bench.log_reader.match_content(lines, None, source))
+                breakin_attempt, banned_ip = bench.log_reader.merge_matches(
+                    matches, {}, {}, source)
+                ips = set(ip for ip, user in breakin_attempt.values())
+                writer.submit(ips, breakin_attempt, banned_ip)
+        return time.perf_counter() - start
+    finally:
+        stop.set()
+        if reader:
+            reader.join()
+        bench.session.close()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    batches = make_batches(count, size)
+    temp_dir = tempfile.mkdtemp()
+    print('{} batches of {} attempts'.format(count, size))
+    print('{:<24} {:>10} {:>10} {:>14} {:>14}'.format('', 'inline', 'thread',
+                                                      'inline+reader', 'thread+reader'))
+    for name, wal, synchronous in (('rollback journal, FULL', False, 'FULL'),
+                                   ('WAL, NORMAL', True, 'NORMAL')):
+        scrutiny.engine.SQLITE_WAL = wal
+        scrutiny.engine.SQLITE_SYNCHRONOUS = synchronous
+        times = []
+        for reader in (False, True):
+            for threaded in (False, True):
+                database = os.path.join(temp_dir, '{}{}{}.db'.format(wal, threaded, reader))
+                try:
+                    times.append('{:.2f}s'.format(run(database, batches, threaded, reader)))
+                except OperationalError:
+                    # database is locked, the reader kept the writer out
+                    times.append('locked')
+        print('{:<24} {:>10} {:>10} {:>14} {:>14}'.format(name, *times))
@@ -0,0 +1,189 @@
+"""
+Generates a synthetic auth.log and fail2ban.log corpus to benchmark against.
+
+Attempts come from a fixed pool of attacker addresses, drawn from a limited
+number of /16 networks so there are common subnets to find, and some
+attackers are much busier than others (a Zipf distribution, the higher the
+skew the more the top few dominate). Every maxretry attempts from the same
+address gets it banned in fail2ban.log. Everything else is the sort of noise
+a real auth.log is mostly made of. The lines are spread evenly over last
+month and split across rotated files the way logrotate leaves them,
+auth.log, auth.log.1, then auth.log.2.gz and so on.
+
+    python benchmarks/generate_logs.py DIR [--lines N] [--attackers N] ...
+"""
+
+import os
+import sys
+import gzip
+import json
+import random
+import argparse
+from bisect import bisect
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrutiny.settings import HOST_SERVER_NAME
+
+USERS = ['root', 'admin', 'test', 'oracle', 'postgres', 'guest', 'user', 'ubuntu',
+         'pi', 'git', 'ftpuser', 'nagios', 'support', 'deploy', 'mysql', 'tomcat']
+NOISE = [
+    'CRON[{pid}]: pam_unix(cron:session): session opened for user root by (uid=0)',
+    'CRON[{pid}]: pam_unix(cron:session): session closed for user root',
+    'sshd[{pid}]: Accepted publickey for jordan from 10.0.0.4 port 51234 ssh2',
+    'sshd[{pid}]: pam_unix(sshd:session): session opened for user jordan by (uid=0)',
+    'sshd[{pid}]: Received disconnect from {ip} port 40022:11: Bye Bye [preauth]',
+    'sshd[{pid}]: Connection closed by {ip} port 40022 [preauth]',
+    'sudo:   jordan : TTY=pts/0 ; PWD=/home/jordan ; USER=root ; COMMAND=/usr/bin/apt-get update',
+    'systemd-logind[{pid}]: New session 4 of user jordan.',
+]
+INVALID_USER = 'sshd[{pid}]: Invalid user {user} from {ip}'
+NOT_ALLOWED = "sshd[{pid}]: User {user} from {ip} not allowed because none of user's groups are listed in AllowGroups"
+BAN = '{date} fail2ban.actions: WARNING [ssh] Ban {ip}'
+FAIL2BAN_NOISE = [
+    '{date} fail2ban.filter : INFO   [ssh] Found {ip}',
+    '{date} fail2ban.actions: WARNING [ssh] Unban {ip}',
+]
+
+
+def last_month_start():
+    last_month = datetime.now().replace(day=1) - timedelta(days=1)
+    return last_month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def make_attackers(count, networks, seed):
+    random.seed(seed)
+    prefixes = [(random.randint(1, 223), random.randint(0, 255)) for i in range(networks)]
+    attackers = set()
+    while len(attackers) < count:
+        a, b = random.choice(prefixes)
+        # Half of them packed into a handful of /24s in their /16
+        c = random.randint(0, 3) if random.random() < 0.5 else random.randint(0, 255)
+        attackers.add('{}.{}.{}.{}'.format(a, b, c, random.randint(1, 254)))
+    return sorted(attackers)
+
+
+def log_names(files, compress):
+    names = []
+    for index in range(files):
+        if index == 0:
+            names.append('auth.log')
+        elif index == 1 or not compress:
+            names.append('auth.log.{}'.format(index))
+        else:
+            names.append('auth.log.{}.gz'.format(index))
+    # Oldest first, the order the lines are written in
+    return names[::-1]
+
+
+def open_log(log_dir, name):
+    path = os.path.join(log_dir, name)
+    if name.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+
+def generate(log_dir, lines=1000000, attackers=2000, networks=40, skew=1.2,
+             match_ratio=0.05, maxretry=5, files=4, compress=True, start=None, seed=0):
+
+    """
+    Writes the corpus to log_dir and returns a dict describing it, along
+    with how many attempts and bans it holds.
+    """
+
+    start = start or last_month_start()
+    span = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - start
+    step = span.total_seconds() / lines
+
+    addresses = make_attackers(attackers, networks, seed)
+    # Zipf weights, the attacker at rank r makes 1 / r ** skew of the attempts
+    cum_weights = list(accumulate(1 / (rank ** skew) for rank in range(1, attackers + 1)))
+    total_weight = cum_weights[-1]
+    retries = {}
+
+    os.makedirs(log_dir, exist_ok=True)
+    names = log_names(files, compress)
+    per_file = -(-lines // files)
+    attempts = 0
+    bans = 0
+    fail2ban = open_log(log_dir, 'fail2ban.log')
+    try:
+        for file_index, name in enumerate(names):
+            with open_log(log_dir, name) as f:
+                first = file_index * per_file
+                for index in range(first, min(first + per_file, lines)):
+                    log_date = start + timedelta(seconds=index * step)
+                    pid = 1000 + index % 30000
+                    if random.random() < match_ratio:
+                        ip = addresses[bisect(cum_weights, random.random() * total_weight)]
+                        template = NOT_ALLOWED if random.random() < 0.2 else INVALID_USER
+                        message = template.format(pid=pid, user=random.choice(USERS), ip=ip)
+                        attempts += 1
+                        retries[ip] = retries.get(ip, 0) + 1
+                        if retries[ip] % maxretry == 0:
+                            ban_date = log_date + timedelta(milliseconds=random.randint(1, 999))
+                            fail2ban.write(BAN.format(date=fail2ban_date(ban_date), ip=ip) + '\n')
+                            bans += 1
+                    else:
+                        message = random.choice(NOISE).format(pid=pid, ip=random.choice(addresses))
+                        if random.random() < 0.01:
+                            fail2ban.write(random.choice(FAIL2BAN_NOISE).format(
+                                date=fail2ban_date(log_date), ip=random.choice(addresses)) + '\n')
+                    f.write('{} {:2d} {} {} {}\n'.format(log_date.strftime('%b'), log_date.day,
+                                                         log_date.strftime('%H:%M:%S'),
+                                                         HOST_SERVER_NAME, message))
+    finally:
+        fail2ban.close()
+
+    return {
+        'lines': lines,
+        'attackers': attackers,
+        'networks': networks,
+        'skew': skew,
+        'match_ratio': match_ratio,
+        'maxretry': maxretry,
+        'files': names + ['fail2ban.log'],
+        'seed': seed,
+        'start': start.isoformat(),
+        'attempts': attempts,
+        'bans': bans,
+        'active_attackers': len(retries),
+    }
+
+
+def fail2ban_date(date):
+    return '{},{:03d}'.format(date.strftime('%Y-%m-%d %H:%M:%S'), date.microsecond // 1000)
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument('--lines', type=int, default=1000000,
+                            help="Number of auth.log lines to generate.")
+    arg_parser.add_argument('--attackers', type=int, default=2000,
+                            help="Number of distinct attacking addresses.")
+    arg_parser.add_argument('--networks', type=int, default=40,
+                            help="Number of /16 networks the attackers come from.")
+    arg_parser.add_argument('--skew', type=float, default=1.2,
+                            help="Zipf exponent for how attempts are spread across attackers.")
+    arg_parser.add_argument('--match-ratio', type=float, default=0.05,
+                            help="Fraction of auth.log lines that are break-in attempts.")
+    arg_parser.add_argument('--files', type=int, default=4,
+                            help="Number of files auth.log is rotated across.")
+    arg_parser.add_argument('--plain', action='store_false', dest='compress',
+                            help="Don't gzip the older rotated logs.")
+    arg_parser.add_argument('--seed', type=int, default=0)
+
+
+def generate_from_args(log_dir, args):
+    return generate(log_dir, lines=args.lines, attackers=args.attackers,
+                    networks=args.networks, skew=args.skew, match_ratio=args.match_ratio,
+                    files=args.files, compress=args.compress, seed=args.seed)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Generate synthetic logs for benchmarking.')
+    arg_parser.add_argument('log_dir')
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    print(json.dumps(generate_from_args(args.log_dir, args), indent=2))
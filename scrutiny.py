@@ -1,7 +1,19 @@
+import sys
+import json
 import argparse
+from datetime import datetime
 
 from scrutiny import Scrutiny
-from scrutiny.settings import __version__
+from scrutiny.reports import REPORTS
+from scrutiny.settings import __version__, PARSE_WORKERS, INCREMENTAL
+
+
+def host_log_dir(value):
+    host, _, log_dir = value.partition('=')
+    if not host or not log_dir:
+        raise argparse.ArgumentTypeError('should be NAME=DIR, not {}'.format(value))
+    return host, log_dir
+
 
 if __name__ == "__main__":
 
@@ -11,11 +23,127 @@ if __name__ == "__main__":
                             default=False,
                             dest='delete_rows',
                             help="Delete existing rows in the Breakin-attempts and Banned IPs tables.")
+    arg_parser.add_argument('--workers',
+                            type=int,
+                            default=PARSE_WORKERS,
+                            dest='workers',
+                            help="Number of processes to parse the log files with.")
+    arg_parser.add_argument('--full',
+                            action='store_false',
+                            default=INCREMENTAL,
+                            dest='incremental',
+                            help="Reread all of last month's logs instead of carrying on from the last run.")
+    arg_parser.add_argument('--follow',
+                            action='store_true',
+                            default=False,
+                            dest='follow',
+                            help="Keep running and add new entries as they're written to the logs.")
+    arg_parser.add_argument('--journal',
+                            action='store_true',
+                            default=False,
+                            dest='journal',
+                            help="Read sshd's entries from the systemd journal instead of the log files.")
+    arg_parser.add_argument('--journal-file',
+                            metavar='FILE',
+                            dest='journal_file',
+                            help="Read journalctl -o export or -o json output from FILE ('-' for stdin) instead of the journal.")
+    arg_parser.add_argument('--hosts-dir',
+                            metavar='DIR',
+                            dest='hosts_dir',
+                            help="Read the logs of other hosts from DIR, which has a directory of logs for each host named after it.")
+    arg_parser.add_argument('--host',
+                            metavar='NAME=DIR',
+                            action='append',
+                            default=[],
+                            type=host_log_dir,
+                            dest='hosts',
+                            help="Read the logs of host NAME from DIR, can be given more than once.")
+    arg_parser.add_argument('--metrics-json',
+                            metavar='FILE',
+                            dest='metrics_json',
+                            help="Write the run's counters and timings to FILE as JSON.")
+    arg_parser.add_argument('--metrics-prometheus',
+                            metavar='FILE',
+                            dest='metrics_prometheus',
+                            help="Write the run's counters and timings to FILE for the node_exporter textfile collector.")
+    arg_parser.add_argument('--compile-geoip',
+                            nargs=2,
+                            metavar=('CSV', 'OUTPUT'),
+                            dest='compile_geoip',
+                            help="Compile a CSV of IP ranges into a database for GEOIP_DATABASE.")
+    arg_parser.add_argument('--migrate',
+                            action='store_true',
+                            default=False,
+                            dest='migrate',
+                            help="Bring an existing database up to date with this version of Scrutiny.")
+    arg_parser.add_argument('--rebuild-rollups',
+                            action='store_true',
+                            default=False,
+                            dest='rebuild_rollups',
+                            help="Recompute the daily summary tables from the raw attempts and bans.")
+    arg_parser.add_argument('--rebuild-dedup-filter',
+                            action='store_true',
+                            default=False,
+                            dest='rebuild_dedup_filter',
+                            help="Rebuild the filter of events already in the database from the database.")
+    arg_parser.add_argument('--report',
+                            choices=REPORTS,
+                            dest='report',
+                            help="Print a report over the database as JSON.")
+    arg_parser.add_argument('--since',
+                            metavar='YYYY-MM-DD',
+                            type=lambda day: datetime.strptime(day, '%Y-%m-%d').date(),
+                            dest='since',
+                            help="Only report on this day onwards.")
+    arg_parser.add_argument('--until',
+                            metavar='YYYY-MM-DD',
+                            type=lambda day: datetime.strptime(day, '%Y-%m-%d').date(),
+                            dest='until',
+                            help="Only report on the days before this one.")
+    arg_parser.add_argument('--limit',
+                            type=int,
+                            default=10,
+                            dest='limit',
+                            help="Number of addresses or usernames in the top-ips and top-users reports.")
 
     args = arg_parser.parse_args()
 
+    if args.compile_geoip:
+        from scrutiny.geoip import compile_location_database
+        count = compile_location_database(*args.compile_geoip)
+        print('Compiled {} ranges into {}'.format(count, args.compile_geoip[1]))
+        sys.exit()
+
     s = Scrutiny()
-    if args.delete_rows:
+    if args.metrics_json:
+        s.metrics_json_file = args.metrics_json
+    if args.metrics_prometheus:
+        s.metrics_prometheus_file = args.metrics_prometheus
+    if args.report:
+        report = s.get_reports().report(args.report, args.since, args.until, args.limit)
+        print(json.dumps(report, indent=2, default=str))
+    elif args.migrate:
+        s.migrate()
+    elif args.rebuild_rollups:
+        s.rebuild_rollups()
+    elif args.rebuild_dedup_filter:
+        s.rebuild_dedup_filter()
+    elif args.delete_rows:
         s.clear_db()
+    elif args.journal_file == '-':
+        s.parse_journal(sys.stdin.buffer, args.follow)
+    elif args.journal_file:
+        with open(args.journal_file, 'rb') as journal_file:
+            s.parse_journal(journal_file, args.follow)
+    elif args.journal:
+        s.parse_journal(follow=args.follow)
+    elif args.hosts_dir or args.hosts:
+        hosts = list(args.hosts)
+        if args.hosts_dir:
+            from scrutiny.hosts import host_log_dirs
+            hosts += host_log_dirs(args.hosts_dir)
+        s.parse_hosts(hosts, args.workers, args.incremental)
+    elif args.follow:
+        s.follow(args.workers)
     else:
-        s.parse()
+        s.parse(args.workers, args.incremental)
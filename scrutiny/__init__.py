@@ -1,4 +1,2 @@
 from scrutiny.scrutiny import *
 from scrutiny.models import *
-from scrutiny.tests import *
-
@@ -0,0 +1,295 @@
+"""
+Statistics over a lot of attempts and bans at once: counts per address,
+username or network, top-k and histograms over time. The events are loaded,
+from the database or straight from the log readers, into numpy arrays, one
+per column, and everything is worked out over whole arrays rather than an
+ORM object or a tuple at a time.
+
+    timestamps  int64 seconds since the epoch (naive times, as they're stored)
+    ips         int32 codes into the store's addresses
+    users       int32 codes into the store's usernames, -1 for none
+
+Addresses and usernames are dictionary encoded, each distinct one is stored
+once and the events refer to it by number, so counting per address is a
+single bincount. Addresses are also kept as the two 64 bit halves of their
+packed form (see netutils.pack_ip) for grouping them by network.
+
+Needs numpy, which the rest of Scrutiny doesn't (pip install numpy).
+
+    store = EventStore.from_db(session, since=datetime(2014, 6, 1))
+    store.attempts.top_ips(10)
+    store.attempts.networks(prefix=24)
+"""
+
+import ipaddress
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scrutiny.models import IPAddr, BreakinAttempts, BannedIPs, NO_USER
+from scrutiny.netutils import pack_ip
+from scrutiny.settings import ANALYTICS_CHUNK_SIZE
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError('scrutiny.analytics needs numpy, pip install numpy')
+
+
+def epoch_seconds(value):
+    # A datetime or date, or None for no limit
+    if value is None:
+        return None
+    return int(numpy.datetime64(value, 's').astype(numpy.int64))
+
+
+def to_epoch(dates):
+    return numpy.array(dates, dtype='datetime64[s]').astype(numpy.int64)
+
+
+def concatenate(parts, dtype):
+    if not parts:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.concatenate(parts)
+
+
+def top(counts, limit=None):
+
+    """
+    The indexes of the largest counts, biggest first, leaving out zeros.
+    Ties go to the lowest index.
+    """
+
+    indexes = numpy.flatnonzero(counts)
+    if limit is not None and limit < len(indexes):
+        # Only the top limit need sorting
+        partition = numpy.argpartition(-counts[indexes], limit - 1)[:limit]
+        indexes = numpy.sort(indexes[partition])
+    order = numpy.lexsort((indexes, -counts[indexes]))
+    return indexes[order]
+
+
+def prefix_mask(bits):
+    # Masks keeping the top bits of a 64 bit word, for an array of bit counts
+    bits = numpy.clip(bits, 0, 64)
+    ones = numpy.full(len(bits), numpy.iinfo(numpy.uint64).max, dtype=numpy.uint64)
+    shifted = ones << numpy.minimum(64 - bits, 63).astype(numpy.uint64)
+    return numpy.where(bits == 0, numpy.uint64(0), shifted)
+
+
+class Dictionary():
+
+    """
+    Hands out a code for each distinct value, in the order they're first
+    seen.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class EventColumns():
+
+    """
+    One kind of event, attempts or bans, as column arrays. The dictionaries
+    belong to the EventStore so the codes mean the same thing in both.
+    """
+
+    def __init__(self, store, timestamps, ips, users=None):
+        self.store = store
+        self.timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        self.ips = numpy.asarray(ips, dtype=numpy.int32)
+        if users is None:
+            users = numpy.full(len(self.ips), -1, dtype=numpy.int32)
+        self.users = numpy.asarray(users, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def between(self, since=None, until=None):
+
+        """
+        The events from since (included) until (not), either of which can
+        be None.
+        """
+
+        keep = numpy.ones(len(self), dtype=bool)
+        if since is not None:
+            keep &= self.timestamps >= epoch_seconds(since)
+        if until is not None:
+            keep &= self.timestamps < epoch_seconds(until)
+        return EventColumns(self.store, self.timestamps[keep], self.ips[keep], self.users[keep])
+
+    def ip_counts(self):
+        # Indexed by address code
+        return numpy.bincount(self.ips, minlength=len(self.store.addresses))
+
+    def user_counts(self):
+        users = self.users[self.users >= 0]
+        return numpy.bincount(users, minlength=len(self.store.usernames))
+
+    def top_ips(self, limit=10):
+        counts = self.ip_counts()
+        addresses = self.store.addresses.values
+        return [(addresses[code], int(counts[code])) for code in top(counts, limit)]
+
+    def top_users(self, limit=10):
+        counts = self.user_counts()
+        usernames = self.store.usernames.values
+        return [(usernames[code], int(counts[code])) for code in top(counts, limit)]
+
+    def histogram(self, bucket=24 * 60 * 60):
+
+        """
+        The number of events in each bucket seconds long, from the first to
+        the last one with any in. Returns the start of each bucket (seconds
+        since the epoch) and the counts, as arrays.
+        """
+
+        if not len(self):
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        buckets = self.timestamps // bucket
+        first = buckets.min()
+        counts = numpy.bincount(buckets - first)
+        return (first + numpy.arange(len(counts), dtype=numpy.int64)) * bucket, counts
+
+    def networks(self, prefix=24, ipv6_prefix=64, limit=None):
+
+        """
+        The number of events from each network, IPv4 addresses grouped into
+        networks of prefix bits and IPv6 ones ipv6_prefix bits, as a list of
+        (network, count) biggest first.
+        """
+
+        high, low = self.store.address_words()
+        ipv4 = (high == 0) & ((low >> numpy.uint64(32)) == 0xffff)
+        bits = numpy.where(ipv4, prefix + 96, ipv6_prefix)
+        keys = numpy.stack([high & prefix_mask(bits), low & prefix_mask(bits - 64)], axis=1)
+        # Each address's network, numbered
+        network_keys, network_codes = numpy.unique(keys, axis=0, return_inverse=True)
+        network_codes = network_codes.reshape(-1)
+        counts = numpy.bincount(network_codes[self.ips], minlength=len(network_keys))
+
+        found = []
+        for code in top(counts, limit):
+            key_high, key_low = (int(word) for word in network_keys[code])
+            address = ipaddress.ip_address((key_high << 64 | key_low).to_bytes(16, 'big'))
+            if address.ipv4_mapped is not None:
+                network = '{}/{}'.format(address.ipv4_mapped, prefix)
+            else:
+                network = '{}/{}'.format(address, ipv6_prefix)
+            found.append((network, int(counts[code])))
+        return found
+
+
+class EventStore():
+
+    """
+    Attempts and bans as EventColumns, sharing dictionaries of addresses
+    and usernames.
+    """
+
+    def __init__(self):
+        require_numpy()
+        self.addresses = Dictionary()
+        self.usernames = Dictionary()
+        self.attempts = EventColumns(self, [], [])
+        self.bans = EventColumns(self, [], [])
+        self.words = None
+
+    def address_words(self):
+        # The high and low 64 bits of each packed address, by code
+        if self.words is None or len(self.words[0]) != len(self.addresses):
+            packed = b''.join(pack_ip(address) for address in self.addresses.values)
+            words = numpy.frombuffer(packed, dtype='>u8').reshape(-1, 2).astype(numpy.uint64)
+            self.words = words[:, 0].copy(), words[:, 1].copy()
+        return self.words
+
+    def ban_ratio(self):
+
+        """
+        How many of the addresses that made attempts were banned, as
+        (banned, attackers).
+        """
+
+        attackers = self.attempts.ip_counts() > 0
+        banned = attackers & (self.bans.ip_counts() > 0)
+        return int(banned.sum()), int(attackers.sum())
+
+    @classmethod
+    def from_events(cls, breakin_attempt, banned_ip):
+
+        """
+        From what LogFileReader.read_logs returns, dicts keyed by
+        (date, sequence) of (ip, user) and of ip.
+        """
+
+        store = cls()
+        dates = [date for date, sequence in breakin_attempt]
+        ips = [store.addresses.encode(ip) for ip, user in breakin_attempt.values()]
+        users = [-1 if user is None else store.usernames.encode(user)
+                 for ip, user in breakin_attempt.values()]
+        store.attempts = EventColumns(store, to_epoch(dates), ips, users)
+
+        dates = [date for date, sequence in banned_ip]
+        ips = [store.addresses.encode(ip) for ip in banned_ip.values()]
+        store.bans = EventColumns(store, to_epoch(dates), ips)
+        return store
+
+    @classmethod
+    def from_db(cls, session, since=None, until=None, chunk_size=ANALYTICS_CHUNK_SIZE):
+
+        """
+        The attempts and bans in the database from since (included) until
+        (not), read chunk_size rows at a time.
+        """
+
+        store = cls()
+        # IPAddr ids to address codes
+        rows = session.query(IPAddr.id, IPAddr.ip_addr).all()
+        id_codes = numpy.full(max([row_id for row_id, ip_addr in rows] or [0]) + 1, -1,
+                              dtype=numpy.int32)
+        for row_id, ip_addr in rows:
+            id_codes[row_id] = store.addresses.encode(ip_addr)
+
+        def read(model, columns, with_users):
+            query = session.query(model.date, model.ipaddr, *columns). \
+                filter(model.ipaddr!=None)
+            if since is not None:
+                query = query.filter(model.date >= since)
+            if until is not None:
+                query = query.filter(model.date < until)
+            rows = iter(query.yield_per(chunk_size))
+            timestamps, ips, users = [], [], []
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                timestamps.append(to_epoch([row[0] for row in chunk]))
+                ips.append(id_codes[numpy.array([row[1] for row in chunk], dtype=numpy.int64)])
+                if with_users:
+                    users.append(numpy.array([-1 if row[2] in (None, NO_USER) else
+                                              store.usernames.encode(row[2])
+                                              for row in chunk], dtype=numpy.int32))
+            return EventColumns(store, concatenate(timestamps, numpy.int64),
+                                concatenate(ips, numpy.int32),
+                                concatenate(users, numpy.int32) if with_users else None)
+
+        store.attempts = read(BreakinAttempts, [BreakinAttempts.user], True)
+        store.bans = read(BannedIPs, [], False)
+        session.rollback()
+        return store
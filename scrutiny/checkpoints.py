@@ -0,0 +1,158 @@
+"""
+Keeps track of how far through each log file, and the systemd journal,
+Scrutiny has read.
+"""
+
+from datetime import datetime
+
+from scrutiny.models import LogCheckpoint, JournalCursor
+
+
+class CheckpointStore():
+
+    """
+    Works out where to start reading each log file from, based on the
+    checkpoints saved by previous runs, and saves new ones once the results
+    of this run have made it into the database. Nothing is written until
+    save is called, so if a run dies part way through the next one simply
+    reads the same lines again.
+
+    host is the host the logs are from when they're another host's (see
+    scrutiny/hosts.py), so the same content turning up in two hosts' logs
+    isn't taken for a file we've already read.
+    """
+
+    def __init__(self, session, host=None):
+        self.session = session
+        self.host = host
+        self.pending = []
+
+    def find(self, log_file):
+        return self.session.query(LogCheckpoint). \
+            filter(LogCheckpoint.device==log_file.device). \
+            filter(LogCheckpoint.inode==log_file.inode).first()
+
+    def start_offset(self, log_file):
+
+        """
+        Returns the offset to start reading log_file from, or None if there
+        is nothing new in it since it was last read.
+        """
+
+        fingerprint = log_file.fingerprint()
+        if fingerprint is None:
+            # Empty, or not even a full line in it yet
+            return None
+
+        checkpoint = self.find(log_file)
+        if checkpoint is not None and checkpoint.fingerprint == fingerprint:
+            if log_file.compressed:
+                # Compressed logs don't change, if it's the same size it's
+                # the same file we read last time
+                if log_file.size == checkpoint.size:
+                    return None
+                return 0
+            if log_file.size < checkpoint.offset:
+                # Truncated (copytruncate), start again
+                return 0
+            if log_file.size == checkpoint.offset:
+                return None
+            return checkpoint.offset
+
+        # Either a file we've never seen or the inode has been reused. It
+        # could still be content we've already read under another name
+        # though, e.g. auth.log.1 after it's been compressed to auth.log.2.gz
+        checkpoint = self.session.query(LogCheckpoint). \
+            filter(LogCheckpoint.fingerprint==fingerprint). \
+            filter(LogCheckpoint.host==self.host). \
+            order_by(LogCheckpoint.offset.desc()).first()
+        if checkpoint is not None:
+            if not log_file.compressed and log_file.size < checkpoint.offset:
+                return 0
+            return checkpoint.offset
+
+        return 0
+
+    def mark(self, log_file):
+
+        """
+        Note that log_file has been read up to its current offset, the
+        checkpoint is written when save is called.
+        """
+
+        self.pending.append(log_file)
+
+    def save(self):
+        for log_file in self.pending:
+            checkpoint = self.find(log_file)
+            if checkpoint is None:
+                checkpoint = LogCheckpoint(device=log_file.device,
+                                           inode=log_file.inode)
+            checkpoint.host = self.host
+            checkpoint.path = log_file.path
+            checkpoint.size = log_file.size
+            checkpoint.offset = log_file.offset
+            checkpoint.fingerprint = log_file.fingerprint()
+            checkpoint.updated = datetime.now()
+            self.session.add(checkpoint)
+        self.session.commit()
+        self.pending = []
+
+
+class CursorStore():
+
+    """
+    The journal's answer to CheckpointStore, remembers the cursor of the last
+    entry read for each unit, and how far the numbering of its second had
+    got (journal entries have no offset to number them by, see
+    SequencedEvents). Like CheckpointStore nothing is written until save is called.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.pending = {}
+
+    def find(self, unit):
+        return self.session.query(JournalCursor). \
+            filter(JournalCursor.unit==unit).first()
+
+    def get(self, unit):
+        journal_cursor = self.find(unit)
+        if journal_cursor is None:
+            return None
+        return journal_cursor.cursor
+
+    def seed(self, unit, events):
+
+        """
+        Carries the numbering of the second the last run finished on over
+        to events, for the entries after the cursor. Returns events.
+        """
+
+        journal_cursor = self.find(unit)
+        if journal_cursor is not None:
+            events.seed(journal_cursor.last_date, journal_cursor.last_count)
+        return events
+
+    def mark(self, unit, cursor, events=None):
+        last_date = None
+        last_count = None
+        if events is not None and events.counts:
+            # The journal is in order, the latest second is the last one
+            last_date = max(events.counts)
+            last_count = events.counts[last_date]
+        self.pending[unit] = (cursor, last_date, last_count)
+
+    def save(self):
+        for unit, (cursor, last_date, last_count) in self.pending.items():
+            journal_cursor = self.find(unit)
+            if journal_cursor is None:
+                journal_cursor = JournalCursor(unit=unit)
+            journal_cursor.cursor = cursor
+            if last_date is not None:
+                journal_cursor.last_date = last_date
+                journal_cursor.last_count = last_count
+            journal_cursor.updated = datetime.now()
+            self.session.add(journal_cursor)
+        self.session.commit()
+        self.pending = {}
@@ -0,0 +1,165 @@
+"""
+A Bloom filter over the attempts and bans already in the database, kept in
+a file next to it, so insert_into_db can tell which events are new without
+asking the database. An event the filter hasn't seen is certainly new and
+is inserted straight away. One it has seen is probably a duplicate, but
+could be a false positive, so only those are looked up in SQL. On a rerun
+over logs that have already been read nearly everything is in the filter,
+and on new logs nearly nothing is.
+
+Events are keyed on the columns of their table's unique index, dates to
+the second so the key is the same whatever precision the DB keeps.
+
+It's only worth it where asking the database costs more than checking the
+filter in Python does. With the unique indexes in place the database turns
+duplicates away itself in the same statement that inserts the rest of a
+chunk, which against a local SQLite database is the quicker of the two (see
+benchmarks/bench_dedup.py), so it's off unless DEDUP_FILTER is set.
+
+The file records the data version (see scrutiny/reports.py) it was saved
+at. If the database has been written to by something that didn't update
+the filter, or the filter has had more put in it than it was sized for,
+it's rebuilt from the database rather than trusted. It can also be rebuilt
+with scrutiny.py --rebuild-dedup-filter.
+"""
+
+import os
+import json
+import math
+import struct
+import hashlib
+import logging
+from datetime import datetime
+
+from scrutiny.models import BreakinAttempts, BannedIPs
+from scrutiny.reports import data_version
+from scrutiny.settings import DEDUP_FILTER_CAPACITY, DEDUP_FILTER_ERROR_RATE, \
+    ANALYTICS_CHUNK_SIZE
+
+logger = logging.getLogger('scrutiny')
+
+# The tables the filter covers
+TABLES = (BreakinAttempts.__table__, BannedIPs.__table__)
+
+
+def unique_key(table):
+    # The columns of table's unique index
+    return [index for index in table.indexes if index.unique][0].columns
+
+
+def event_key(table, values):
+    # The date comes first in both unique indexes, as whole seconds since
+    # 0001-01-01 as that's quicker than formatting it
+    date = values[0]
+    seconds = date.toordinal() * 86400 + date.hour * 3600 + date.minute * 60 + date.second
+    return '{}\x1f{}\x1f{}'.format(table.name, seconds,
+                                   '\x1f'.join(map(str, values[1:]))).encode('utf-8')
+
+
+def default_filter_path(engine):
+    # Next to an SQLite database, other databases need DEDUP_FILTER_FILE set
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and database and database != ':memory:':
+        return database + '.bloom'
+    return None
+
+
+class DedupFilter():
+
+    """
+    The Bloom filter itself, sized for capacity keys with about error_rate
+    false positives once it has that many in it.
+    """
+
+    def __init__(self, capacity=DEDUP_FILTER_CAPACITY, error_rate=DEDUP_FILTER_ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        size = -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        # A whole number of bytes, and it has to fit the 32 bit positions
+        self.size = min(max(int(math.ceil(size / 8)) * 8, 8), 2 ** 32)
+        self.hashes = min(max(int(round(self.size / self.capacity * math.log(2))), 1), 16)
+        self.bits = bytearray(self.size // 8)
+        self.count = 0
+        self.version = None
+        self.unpack = struct.Struct('<{}I'.format(self.hashes)).unpack
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, key):
+        # One hash, cut up into the positions of the bits for key
+        digest = hashlib.blake2b(key, digest_size=4 * self.hashes).digest()
+        size = self.size
+        return [position % size for position in self.unpack(digest)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self.bits
+        for position in self.positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+    def save(self, path):
+        header = {'capacity': self.capacity, 'error_rate': self.error_rate,
+                  'count': self.count, 'size': self.size, 'hashes': self.hashes,
+                  'version': [self.version[0], self.version[1] and self.version[1].isoformat()]}
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(self.bits)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+
+        """
+        Reads a filter saved by save, raises ValueError if the file isn't
+        one or is damaged.
+        """
+
+        with open(path, 'rb') as f:
+            try:
+                header = json.loads(f.readline().decode('utf-8'))
+                dedup_filter = cls(header['capacity'], header['error_rate'])
+                version, updated = header['version']
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('{} is not a dedup filter: {}'.format(path, e))
+            bits = f.read()
+        if (dedup_filter.size, dedup_filter.hashes) != (header['size'], header['hashes']) or \
+                len(bits) != len(dedup_filter.bits):
+            raise ValueError('{} is damaged'.format(path))
+        dedup_filter.bits[:] = bits
+        dedup_filter.count = header['count']
+        dedup_filter.version = (version, updated and datetime.fromisoformat(updated))
+        return dedup_filter
+
+    @classmethod
+    def build(cls, session, capacity=DEDUP_FILTER_CAPACITY, error_rate=DEDUP_FILTER_ERROR_RATE,
+              chunk_size=ANALYTICS_CHUNK_SIZE):
+
+        """
+        A filter of everything in the database, with room for at least as
+        many rows again.
+        """
+
+        rows = sum(session.query(table).count() for table in TABLES)
+        dedup_filter = cls(max(capacity, rows * 2), error_rate)
+        for table in TABLES:
+            key = unique_key(table)
+            for values in session.query(*key).yield_per(chunk_size):
+                dedup_filter.add(event_key(table, values))
+        dedup_filter.version = data_version(session)
+        session.rollback()
+        logger.info('Built a dedup filter of {} events ({} KB)'.format(
+            dedup_filter.count, len(dedup_filter.bits) // 1024))
+        return dedup_filter
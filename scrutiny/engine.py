@@ -0,0 +1,72 @@
+"""
+How Scrutiny sets up its connections to the database.
+
+SQLite is put in WAL mode, where readers (the reports, anything else with
+the file open) don't block a writer and a writer doesn't block them, with
+synchronous=NORMAL, which only fsyncs the log when it's checkpointed rather
+than on every commit. A power cut can lose the last few commits but won't
+leave the database corrupt. The log checkpoints are committed after the
+rows they cover, so they're lost along with them, and the next run reads
+those lines again.
+
+Other databases (MySQL) get a connection pool whose connections are
+recycled before the server's wait_timeout closes them, and pinged as
+they're checked out of the pool so one the server has dropped anyway is
+replaced rather than handed out. That's done with a checkout event rather
+than create_engine's pool_pre_ping, which the SQLAlchemy in
+requirements.txt doesn't have.
+"""
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+
+from scrutiny.settings import SQLITE_WAL, SQLITE_SYNCHRONOUS, DB_POOL_SIZE, DB_POOL_RECYCLE
+
+
+def engine_options(uri):
+    # The create_engine keyword arguments for uri
+    if make_url(uri).get_backend_name() == 'sqlite':
+        return {}
+    return {'pool_size': DB_POOL_SIZE, 'pool_recycle': DB_POOL_RECYCLE}
+
+
+def memory_database(engine):
+    # An in-memory SQLite database only exists on the one connection, and
+    # SQLAlchemy keeps a connection per thread for it
+    return engine.dialect.name == 'sqlite' and engine.url.database in (None, '', ':memory:')
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if SQLITE_WAL:
+        cursor.execute('PRAGMA journal_mode=WAL')
+    if SQLITE_SYNCHRONOUS:
+        cursor.execute('PRAGMA synchronous={}'.format(SQLITE_SYNCHRONOUS))
+    cursor.close()
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool throws this connection away and tries another
+        raise exc.DisconnectionError()
+    cursor.close()
+
+
+def configure_engine(engine):
+
+    """
+    Sets the pragmas above on each new connection engine makes, if it's to
+    an SQLite file, or pings connections as they're checked out of the pool
+    for other databases. Returns engine.
+    """
+
+    if engine.dialect.name == 'sqlite':
+        if not memory_database(engine) and \
+                not event.contains(engine, 'connect', set_sqlite_pragmas):
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+    elif not event.contains(engine, 'checkout', ping_connection):
+        event.listen(engine, 'checkout', ping_connection)
+    return engine
@@ -0,0 +1,67 @@
+"""
+The in-memory store for matched log entries.
+"""
+
+
+class SequencedEvents(dict):
+
+    """
+    A dict of events keyed by (timestamp, sequence). Logs only go down to the
+    second (fail2ban and the journal a little further) and there's often more
+    than one attempt in the same one, so each event in the same timestamp
+    needs a number of its own.
+
+    An event from a log file is numbered by where its line starts in the
+    file. That's the same however much of the file a run reads, and before
+    and after it's renamed or compressed, so reading the same entry again
+    always gives the same key and the database can tell it's a duplicate.
+    Anything else (the journal) is numbered in the order it was seen, keeping
+    a count per timestamp so adding an event is O(1) however many share it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = {}
+
+    def add(self, timestamp, details, position=None):
+        if position is None:
+            sequence = self.counts.get(timestamp, 0)
+            self.counts[timestamp] = sequence + 1
+        else:
+            sequence = position
+            # Only a line at the same place in another file in the same
+            # second, it takes the next number free
+            while (timestamp, sequence) in self:
+                sequence += 1
+        self[(timestamp, sequence)] = details
+        return sequence
+
+    def seed(self, timestamp, count):
+
+        """
+        Starts numbering timestamp's events from count, if it's further on
+        than we'd have got to anyway. For carrying on from where a previous
+        run stopped, see CursorStore.
+        """
+
+        if timestamp is not None and count:
+            self.counts[timestamp] = max(self.counts.get(timestamp, 0), count)
+
+    def emptied(self):
+
+        """
+        Returns a new, empty store for when the events have been written out
+        but more might still be on the way. It carries on numbering for every
+        timestamp from the oldest event in this store onwards, as the logs
+        being read can lag behind each other and the next event could be in
+        any of those seconds. An empty store passes on all its counts.
+        """
+
+        events = SequencedEvents()
+        if self:
+            oldest = min(timestamp for timestamp, sequence in self)
+            events.counts = dict((timestamp, count) for timestamp, count in self.counts.items()
+                                 if timestamp >= oldest)
+        else:
+            events.counts = dict(self.counts)
+        return events
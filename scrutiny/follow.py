@@ -0,0 +1,201 @@
+"""
+Follows the current logs of each source (auth.log, fail2ban.log and so on,
+see rules.ini) as they're written to, rather than waiting for a batch run
+at the end of the month.
+"""
+
+import os
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from scrutiny.settings import LOG_DIR, FOLLOW_POLL_INTERVAL, \
+    FOLLOW_BATCH_SIZE, FOLLOW_FLUSH_INTERVAL
+from scrutiny.handlers.file import LogFile
+from scrutiny.checkpoints import CheckpointStore
+from scrutiny.events import SequencedEvents
+from scrutiny.rules import LOG_SOURCES
+
+FOLLOWED_LOGS = tuple((name, source) for source in LOG_SOURCES.values() for name in source.files)
+
+
+class TailedFile():
+
+    """
+    An open log file that we read appended lines from. The file is kept open
+    so when logrotate renames it we can still read whatever was written to it
+    before the new file took its place.
+    """
+
+    def __init__(self, log_file, source):
+        self.log_file = log_file
+        self.source = source
+        self.f = open(log_file.path, 'rb')
+        self.f.seek(log_file.offset)
+        self.partial = b''
+
+    def read_lines(self):
+
+        """
+        Returns the lines finished since the last call, decoded, along with
+        the offset in the file each one starts at.
+        """
+
+        data = self.f.read()
+        if not data:
+            return [], []
+        data = self.partial + data
+        lines = data.split(b'\n')
+        # Whatever is after the last newline hasn't been finished yet
+        self.partial = lines.pop()
+        offsets = []
+        offset = self.log_file.offset
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line) + 1
+        self.log_file.offset = offset
+        self.log_file.size = self.log_file.offset
+        return [line.decode('utf-8', errors='replace') for line in lines], offsets
+
+    def rotated(self):
+
+        """
+        True if the file at our path is no longer the one we have open, or
+        it has been truncated underneath us.
+        """
+
+        try:
+            stat = os.stat(self.log_file.path)
+        except FileNotFoundError:
+            return True
+        if (stat.st_dev, stat.st_ino) != (self.log_file.device, self.log_file.inode):
+            return True
+        return stat.st_size < self.log_file.offset
+
+    def close(self):
+        self.f.close()
+
+
+class LogFollower():
+
+    """
+    Polls the logs in log_dir for new lines and pushes anything the matchers
+    pick up into the database in batches, either once batch_size matches have
+    built up or flush_interval seconds after the first one, whichever comes
+    first. Checkpoints are saved with each batch so a restart (or the next
+    batch run) carries on from the same place.
+
+    Reading the files and writing to the database block, so run does them
+    on a thread of its own, one at a time, and the event loop is free for
+    anything else running on it in the meantime.
+    """
+
+    def __init__(self, scrutiny, log_dir=LOG_DIR, poll_interval=FOLLOW_POLL_INTERVAL,
+                 batch_size=FOLLOW_BATCH_SIZE, flush_interval=FOLLOW_FLUSH_INTERVAL):
+        self.scrutiny = scrutiny
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.checkpoints = CheckpointStore(scrutiny.session)
+        self.files = {}
+        self.breakin_attempt = SequencedEvents()
+        self.banned_ip = SequencedEvents()
+        self.pending = 0
+        self.stopped = False
+
+    def open_file(self, path, source, offset=None):
+        log_file = LogFile(path)
+        if offset is None:
+            offset = self.checkpoints.start_offset(log_file)
+            if offset is None:
+                # Nothing new in it (or nothing in it at all)
+                offset = log_file.size if log_file.fingerprint() else 0
+        log_file.offset = offset
+        return TailedFile(log_file, source)
+
+    def read(self, tailed_file):
+        lines, offsets = tailed_file.read_lines()
+        if lines:
+            matches = list(self.scrutiny.log_reader.match_content(lines, None,
+                                                                  tailed_file.source, offsets))
+            self.breakin_attempt, self.banned_ip = self.scrutiny.log_reader.merge_matches(
+                matches, self.breakin_attempt, self.banned_ip, tailed_file.source)
+            self.pending += len(matches)
+
+    def poll(self):
+        for name, source in FOLLOWED_LOGS:
+            path = os.path.join(self.log_dir, name)
+            tailed_file = self.files.get(path)
+
+            if tailed_file is not None:
+                self.read(tailed_file)
+                if tailed_file.rotated():
+                    # Everything written before the rotation has just been
+                    # read, save where the old file got to and start on the
+                    # new one from the top
+                    self.checkpoints.mark(tailed_file.log_file)
+                    tailed_file.close()
+                    del self.files[path]
+                    tailed_file = None
+                    if os.path.exists(path):
+                        self.scrutiny.logger.info('{} rotated, reopening'.format(path))
+                        tailed_file = self.open_file(path, source, 0)
+
+            elif os.path.exists(path):
+                tailed_file = self.open_file(path, source)
+
+            if tailed_file is not None:
+                self.files[path] = tailed_file
+                self.read(tailed_file)
+
+    def flush(self):
+        if self.pending:
+            self.scrutiny.logger.info('Inserting {} new entries...'.format(self.pending))
+            unique_ips = set(ip for ip, user in self.breakin_attempt.values())
+            self.scrutiny.insert_into_db(unique_ips, self.breakin_attempt, self.banned_ip)
+            # The entries are numbered by where they are in their files,
+            # there's nothing to carry on to the next batch
+            self.breakin_attempt = SequencedEvents()
+            self.banned_ip = SequencedEvents()
+            self.pending = 0
+        for tailed_file in self.files.values():
+            self.checkpoints.mark(tailed_file.log_file)
+        self.checkpoints.save()
+
+    def stop(self):
+        self.stopped = True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not on the main thread, or not supported on this platform
+                pass
+
+        # A single thread, so the session is only ever used from the one
+        executor = ThreadPoolExecutor(max_workers=1)
+        last_flush = loop.time()
+        try:
+            while not self.stopped:
+                await loop.run_in_executor(executor, self.poll)
+                if self.pending >= self.batch_size or \
+                        (self.pending and loop.time() - last_flush >= self.flush_interval):
+                    await loop.run_in_executor(executor, self.flush)
+                    last_flush = loop.time()
+                elif not self.pending:
+                    last_flush = loop.time()
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            # Waits for whatever the thread is in the middle of first
+            executor.submit(self.close).result()
+            executor.shutdown()
+
+    def close(self):
+        self.flush()
+        for tailed_file in self.files.values():
+            tailed_file.close()
+        self.files = {}
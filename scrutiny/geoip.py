@@ -0,0 +1,362 @@
+"""
+Location providers, these look up the rough location of an IP address.
+
+RemoteLocationProvider asks the ipinfodb API, one request every couple of
+seconds. When there are a lot of addresses to look up ConcurrentResolver
+makes several requests at once with it instead, limited to a steady rate
+and with the answers cached in the database.
+
+LocalLocationProvider answers from a local database of IP ranges instead,
+either a CSV file or the binary form compile_location_database builds from
+one, which is memory mapped so starting up doesn't mean parsing the whole
+CSV again.
+"""
+
+import csv
+import json
+import mmap
+import time
+import array
+import struct
+import logging
+import threading
+import urllib.request, urllib.parse
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from scrutiny.models import CachedLocation
+from scrutiny.netutils import ip_to_int
+from scrutiny.utils import chunks
+from scrutiny.settings import API_URL, API_KEY, DB_CHUNK_SIZE, GEOIP_RATE, \
+    GEOIP_BURST, GEOIP_WORKERS, GEOIP_CACHE_TTL, GEOIP_NEGATIVE_CACHE_TTL
+
+# Header of the compiled database, a magic string followed by the number of
+# ranges and the length of the JSON encoded list of locations. The ranges
+# are three arrays of unsigned ints in the machine's native byte order, the
+# start of each range, the end and the index of its location
+HEADER = struct.Struct('=8sII')
+MAGIC = b'SCRGEO1\0'
+
+
+class RemoteLocationProvider():
+
+    """
+    Looks up locations with the ipinfodb API. Being a good citizen, it waits
+    delay seconds after each request before letting the next one go.
+    """
+
+    def __init__(self, api_url=API_URL, api_key=API_KEY, delay=2):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.delay = delay
+        self.logger = logging.getLogger('scrutiny')
+
+    def fetch(self, ip):
+
+        """
+        Makes the request and returns the decoded response.
+        """
+
+        params = {'format': 'json', 'key': self.api_key, 'ip': ip, 'timezone': 'false'}
+        self.logger.debug('Checking IP - {}'.format(ip))
+        url_params = urllib.parse.urlencode(params)
+        url = self.api_url + '?' + url_params
+        url_obj = urllib.request.urlopen(url)
+        response = url_obj.read()
+        try:
+            response = response.decode("utf-8") # response is bytes, parse to string
+        except AttributeError:
+            pass
+        url_obj.close()
+        return json.loads(response)
+
+    def parse_response(self, response_dict):
+        return_dict = {}
+
+        if 'cityName' in response_dict and response_dict['cityName'] != '-':
+            return_dict['region'] = response_dict['cityName'] + ', ' + response_dict['regionName']
+        elif 'regionName' in response_dict and response_dict['regionName'] != '-':
+            return_dict['region'] = response_dict['regionName']
+        else:
+            return_dict['region'] = '-'
+
+        if 'countryName' in response_dict:
+            return_dict['country'] = response_dict['countryName']
+        else:
+            return_dict['country'] = '-'
+
+        self.logger.debug('Location - {} {}'.format(return_dict['region'], return_dict['country']))
+
+        return return_dict
+
+    def lookup(self, ip):
+        return_dict = self.parse_response(self.fetch(ip))
+        time.sleep(self.delay)
+        return return_dict
+
+
+class TokenBucket():
+
+    """
+    A thread safe token bucket, lets up to rate calls to acquire through per
+    second on average with bursts of up to burst at once.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class LocationCache():
+
+    """
+    Remembers locations from the API in the database. Entries are good for
+    ttl seconds, or negative_ttl if the API didn't know where the address
+    was. Failed requests aren't cached at all.
+    """
+
+    def __init__(self, session, ttl=GEOIP_CACHE_TTL, negative_ttl=GEOIP_NEGATIVE_CACHE_TTL,
+                 chunk_size=DB_CHUNK_SIZE):
+        self.session = session
+        self.ttl = timedelta(seconds=ttl)
+        self.negative_ttl = timedelta(seconds=negative_ttl)
+        self.chunk_size = chunk_size
+
+    def get_many(self, ips):
+
+        """
+        Returns a dict of IP address to location for those of ips that are
+        in the cache and haven't expired.
+        """
+
+        now = datetime.now()
+        locations = {}
+        for chunk in chunks(list(ips), self.chunk_size):
+            query = self.session.query(CachedLocation). \
+                filter(CachedLocation.ip_addr.in_(chunk))
+            for cached in query:
+                ttl = self.ttl if cached.found else self.negative_ttl
+                if cached.fetched + ttl > now:
+                    locations[cached.ip_addr] = {'region': cached.region,
+                                                 'country': cached.country}
+        return locations
+
+    def put_many(self, locations):
+        now = datetime.now()
+        ips = list(locations)
+        for chunk in chunks(ips, self.chunk_size):
+            query = self.session.query(CachedLocation). \
+                filter(CachedLocation.ip_addr.in_(chunk))
+            existing = dict((cached.ip_addr, cached) for cached in query)
+            for ip in chunk:
+                cached = existing.get(ip)
+                if cached is None:
+                    cached = CachedLocation(ip_addr=ip)
+                location = locations[ip]
+                cached.region = location.get('region', '-')
+                cached.country = location.get('country', '-')
+                cached.found = cached.country != '-'
+                cached.fetched = now
+                self.session.add(cached)
+        self.session.commit()
+
+
+class ConcurrentResolver():
+
+    """
+    Looks up a batch of addresses with a RemoteLocationProvider, using a pool
+    of worker threads so we aren't sat waiting on one request at a time,
+    while a token bucket keeps us to the rate the API allows. Anything in
+    the cache is answered from there without a request at all. Addresses
+    the request failed for are left out, to be tried again another time.
+    """
+
+    def __init__(self, provider, cache=None, rate=GEOIP_RATE, burst=GEOIP_BURST,
+                 workers=GEOIP_WORKERS):
+        self.provider = provider
+        self.cache = cache
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.logger = logging.getLogger('scrutiny')
+        self.api_calls = 0
+        self.cache_hits = 0
+
+    def fetch(self, ip):
+        self.bucket.acquire()
+        try:
+            return self.provider.parse_response(self.provider.fetch(ip))
+        except (OSError, ValueError) as e:
+            # urllib's errors are OSErrors, a garbled response a ValueError
+            self.logger.warning('Failed to look up {} - {}'.format(ip, e))
+            return None
+
+    def resolve(self, ips):
+
+        """
+        Returns a dict of IP address to location for those of ips that are
+        cached or could be looked up.
+        """
+
+        ips = list(ips)
+        if self.cache is not None:
+            locations = self.cache.get_many(ips)
+        else:
+            locations = {}
+        self.cache_hits += len(locations)
+
+        missing = [ip for ip in ips if ip not in locations]
+        if missing:
+            self.logger.debug('Looking up {} addresses ({} cached)'.format(len(missing),
+                                                                           len(locations)))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                fetched = dict((ip, location) for ip, location in
+                               zip(missing, executor.map(self.fetch, missing))
+                               if location is not None)
+            self.api_calls += len(missing)
+            if self.cache is not None:
+                self.cache.put_many(fetched)
+            locations.update(fetched)
+
+        return locations
+
+
+def read_location_csv(path):
+
+    """
+    Reads a CSV of IP ranges, one range per row in the form
+
+        start,end,country,region,city
+
+    where start and end are either dotted quads or integers, and returns a
+    sorted list of (start, end, (region, country)) tuples. The region is
+    given the same way the API does, including the city if there is one.
+    Rows that don't start with an address (like a header) are skipped.
+    """
+
+    ranges = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if len(row) < 3:
+                continue
+            try:
+                start, end = [int(i) if i.isdigit() else ip_to_int(i) for i in row[:2]]
+            except OSError:
+                continue
+            country = row[2] or '-'
+            region = row[3] if len(row) > 3 and row[3] else '-'
+            if len(row) > 4 and row[4] and row[4] != '-':
+                region = '{}, {}'.format(row[4], region)
+            ranges.append((start, end, (region, country)))
+
+    ranges.sort()
+    return ranges
+
+
+def compile_location_database(csv_path, output_path):
+
+    """
+    Compiles a CSV of IP ranges (see read_location_csv) into the binary form
+    LocalLocationProvider can memory map. Returns the number of ranges.
+    """
+
+    ranges = read_location_csv(csv_path)
+
+    locations = []
+    location_index = {}
+    starts = array.array('I')
+    ends = array.array('I')
+    indexes = array.array('I')
+    for start, end, location in ranges:
+        if location not in location_index:
+            location_index[location] = len(locations)
+            locations.append(location)
+        starts.append(start)
+        ends.append(end)
+        indexes.append(location_index[location])
+
+    encoded_locations = json.dumps(locations).encode('utf-8')
+    with open(output_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(ranges), len(encoded_locations)))
+        f.write(starts.tobytes())
+        f.write(ends.tobytes())
+        f.write(indexes.tobytes())
+        f.write(encoded_locations)
+
+    return len(ranges)
+
+
+class LocalLocationProvider():
+
+    """
+    Looks up locations in a local database of IP ranges, either a CSV or a
+    compiled database. Lookups are a binary search over the sorted range
+    starts so they take microseconds and never touch the network.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+
+        if magic == MAGIC:
+            self.load_compiled(path)
+        else:
+            self.load_csv(path)
+
+    def load_csv(self, path):
+        ranges = read_location_csv(path)
+        self.starts = array.array('I', [start for start, end, location in ranges])
+        self.ends = array.array('I', [end for start, end, location in ranges])
+        self.indexes = range(len(ranges))
+        self.locations = [location for start, end, location in ranges]
+
+    def load_compiled(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, locations_length = HEADER.unpack_from(self.mmap)
+        size = count * array.array('I').itemsize
+        view = memoryview(self.mmap)
+        offset = HEADER.size
+        self.starts = view[offset:offset + size].cast('I')
+        offset += size
+        self.ends = view[offset:offset + size].cast('I')
+        offset += size
+        self.indexes = view[offset:offset + size].cast('I')
+        offset += size
+        self.locations = [tuple(location) for location in
+                          json.loads(bytes(view[offset:offset + locations_length]).decode('utf-8'))]
+
+    def close(self):
+        if self.mmap is not None:
+            self.starts.release()
+            self.ends.release()
+            self.indexes.release()
+            self.mmap.close()
+            self.mmap = None
+
+    def lookup(self, ip):
+        number = ip_to_int(ip)
+        index = bisect_right(self.starts, number) - 1
+        if index >= 0 and number <= self.ends[index]:
+            region, country = self.locations[self.indexes[index]]
+            return {'region': region, 'country': country}
+        return {}
@@ -1,5 +1,17 @@
+import os
+import gzip
+import mmap
+import time
+import hashlib
+from itertools import repeat
 from datetime import timedelta, datetime
 
+from scrutiny.settings import LOG_DIR, PARSE_WORKERS, MMAP_LOGS
+from scrutiny.rules import LOG_SOURCES
+from scrutiny.events import SequencedEvents
+from scrutiny.metrics import Metrics
+from scrutiny.timestamps import SyslogTimestampParser, Fail2banTimestampParser
+
 """
 Instead of parsing log files, perhaps it would be better to basically tail them,
 subscribe to changes and when we see an entry that matches our regex, add it.
@@ -8,163 +20,414 @@ we see as some 'last checked' value, then tail the logs.
 """
 
 
+class LogFile():
+
+    """
+    A single log file on disk, along with how far through it we've read.
+    The offset is in bytes of the uncompressed content so it means the same
+    thing for a log before and after logrotate has gzipped it.
+    """
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self.compressed = os.path.splitext(path)[1] == '.gz'
+
+        stat = os.stat(path)
+        self.device = stat.st_dev
+        self.inode = stat.st_ino
+        self.size = stat.st_size
+        self.lines_read = 0
+        self._fingerprint = None
+
+    def __repr__(self):
+        return '<LogFile: {} @ {}>'.format(self.path, self.offset)
+
+    def open(self):
+        if self.compressed:
+            return gzip.open(self.path, 'rb')
+        else:
+            return open(self.path, 'rb')
+
+    def fingerprint(self):
+
+        """
+        A hash of the first line of the file, used to recognise the same
+        content under a different inode (say once it's been compressed) and
+        an inode that's been reused for a different file. None if the file
+        doesn't have a complete first line yet.
+        """
+
+        if self._fingerprint is None:
+            with self.open() as f:
+                first_line = f.readline()
+            if first_line.endswith(b'\n'):
+                self._fingerprint = hashlib.sha1(first_line).hexdigest()
+        return self._fingerprint
+
+    def lines(self, partial=True):
+
+        """
+        Yields the lines of the file from the current offset one at a time,
+        decoded to a string and without the trailing newline, moving the
+        offset along as it goes. Compressed logs are decompressed as they're
+        read, so only the current line is ever held in memory no matter how
+        big the file is. If partial is False a last line that hasn't been
+        finished yet is left for next time.
+        """
+
+        count = 0
+        with self.open() as f:
+            if self.offset:
+                # gzip files can seek too, they just have to decompress
+                # everything up to the offset to do it
+                f.seek(self.offset)
+            try:
+                for line in f:
+                    if not line.endswith(b'\n') and not partial:
+                        break
+                    self.offset += len(line)
+                    count += 1
+                    # Usernames in failed logins can be any old garbage, don't let
+                    # a bad byte stop us reading the rest of the file
+                    yield line.decode('utf-8', errors='replace').rstrip('\n')
+            finally:
+                self.lines_read += count
+
+    def matches(self, matcher, partial=True, offsets=False):
+
+        """
+        Yields the groups of each line from the current offset that matcher
+        matches, moving the offset along to the end once they've all been
+        yielded. Uncompressed files are memory mapped and scanned as bytes
+        (see LineMatcher.scan) so only the lines that match get decoded, the
+        rest are never copied out of the page cache. Compressed files are
+        read a line at a time. With offsets each comes as an (offset, groups)
+        tuple, offset being where the line starts in the file.
+        """
+
+        if self.compressed or not MMAP_LOGS:
+            line_start = self.offset
+            for line in self.lines(partial):
+                groups = matcher.match(line)
+                if groups:
+                    yield (line_start, groups) if offsets else groups
+                line_start = self.offset
+            return
+
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= self.offset:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+                end = size
+                if not partial:
+                    end = buffer.rfind(b'\n', self.offset, size) + 1 or self.offset
+                yield from matcher.scan(buffer, self.offset, end, offsets)
+                self.lines_read += count_lines(buffer, self.offset, end)
+                self.offset = end
+
+
+def count_lines(buffer, start, end, chunk_size=16 * 1024 * 1024):
+
+    """
+    The number of lines in buffer between start and end, counting a last
+    line without a newline. Counted a chunk at a time so a huge mmapped
+    file is never copied all at once.
+    """
+
+    count = 0
+    for chunk_start in range(start, end, chunk_size):
+        count += buffer[chunk_start:min(chunk_start + chunk_size, end)].count(b'\n')
+    if end > start and buffer[end - 1:end] != b'\n':
+        count += 1
+    return count
+
+
+def read_lines(path):
+
+    """
+    Yields the lines of a log file one at a time, decoded to a string and
+    without the trailing newline. See LogFile.lines.
+    """
+
+    return LogFile(path).lines()
+
+
+def match_log_file(path, last_month, source, offset=0, partial=True):
+
+    """
+    Matches a single log file on its own from the given offset, returns the
+    list of matches, the offset it finished at and how many lines it read.
+    Lives out here rather than on LogFileReader so it can be handed to a
+    process pool.
+    """
+
+    log_file = LogFile(path, offset)
+    matches = list(LogFileReader().match_file(log_file, last_month, source, partial))
+
+    return matches, log_file.offset, log_file.lines_read
+
+
 class LogFileReader():
 
-    def __init__(self):
-        pass
-
-
-    def parse_content(self, content, breakin_attempt, banned_ip, last_month, auth_log):
-
-        for line in content:
-            if auth_log:
-                # Catch the usual
-                # Jun 10 12:40:05 defestri sshd[11019]: Invalid user admin from 61.174.51.217
-                m = re.search(SEARCH_STRING, line)
-                if m is None:
-                    # Also catch these
-                    # Jun  8 04:31:10 defestri sshd[5013]: User root from 116.10.191.234 not allowed because none of user's groups are listed in AllowGroups
-                    m = re.search(ROOT_NOT_ALLOWED_SEARCH_STRING, line)
-                if m:
-                    if m.group('log_date')[:3] == last_month.strftime('%b'):
-                        log_date = datetime.strptime(m.group('log_date'), '%b %d %H:%M:%S')
-                        log_date = log_date.replace(year=last_month.year)
-                        # Set the time zone info for the system
-                        #log_date = log_date.replace(tzinfo=sys_tz)
-                        # Convert it to UTC time
-                        #log_date = log_date.astimezone(pytz.utc)
-
-                        #sometimes there's multiple entries per second, since we're
-                        #not that concerned about to the second accuracy just increment
-                        #the seconds until we find a unique log date to put in
-                        if log_date in breakin_attempt:
-                            while log_date in breakin_attempt:
-                                ns = log_date.second+1
-                                if ns >= 60:
-                                    ns = 0
-                                log_date = log_date.replace(second=ns)
-                        breakin_attempt[log_date] = (m.group('ip_add'), m.group('user'))
+    def __init__(self, sources=None):
+        # The kinds of log file to read and their rules, see scrutiny/rules.py
+        self.sources = sources if sources is not None else LOG_SOURCES
+
+
+    def match_content(self, content, last_month, source, offsets=None):
 
+        """
+        Yields a (date, details, offset) tuple for each line in content, a
+        log of the LogSource source, that we're interested in, in the order
+        they appear. For sources of attempts details is an (ip, user) tuple,
+        for bans it's the banned IP. offsets, if it's given, is where each
+        line of content starts in its file, otherwise offset is None. If
+        last_month is None everything is yielded rather than just the
+        entries from last month.
+        """
+
+        if offsets is None:
+            offsets = repeat(None)
+        found = ((offset, groups) for offset, groups in zip(offsets, map(source.matcher.match,
+                                                                          content)) if groups)
+
+        return self.date_matches(found, last_month, source)
+
+
+    def match_file(self, log_file, last_month, source, partial=True):
+
+        """
+        As match_content, for the lines of log_file from its offset. See
+        LogFile.matches.
+        """
+
+        return self.date_matches(log_file.matches(source.matcher, partial, offsets=True),
+                                 last_month, source)
+
+
+    def date_matches(self, found, last_month, source):
+
+        """
+        Parses the dates of the (offset, groups) tuples in found and
+        yields the (date, details, offset) tuples for match_content and
+        match_file.
+        """
+
+        month_name = None
+        if source.timestamp == 'syslog':
+            if last_month is None:
+                # The year is worked out from the month
+                parser = SyslogTimestampParser()
+            else:
+                parser = SyslogTimestampParser(year=last_month.year)
+                month_name = last_month.strftime('%b')
+        else:
+            parser = Fail2banTimestampParser()
+
+        for offset, m in found:
+            if month_name is not None:
+                # Checked before parsing, a Feb 29 from some other year
+                # wouldn't parse in last month's
+                if m['log_date'][:3] != month_name:
+                    continue
+                log_date = parser.parse(m['log_date'])
+            else:
+                log_date = parser.parse(m['log_date'])
+                if last_month is not None and log_date.month != last_month.month:
+                    continue
+            # Set the time zone info for the system
+            #log_date = log_date.replace(tzinfo=sys_tz)
+            # Convert it to UTC time
+            #log_date = log_date.astimezone(pytz.utc)
+
+            if source.attempts:
+                yield log_date, (m['ip_add'], m.get('user')), offset
             else:
-                m = re.search(FAIL2BAN_SEARCH_STRING, line)
-                if m:
-                        ban_time = datetime.strptime(m.group('log_date'),
-                                                     '%Y-%m-%d %H:%M:%S,%f')
-                        if ban_time.month == last_month.month:
-                            banned_ip[ban_time] = m.group('ip_add')
+                yield log_date, m['ip_add'], offset
+
+
+    def merge_matches(self, matches, breakin_attempt, banned_ip, source):
+
+        """
+        Adds matches to breakin_attempt or banned_ip, which are keyed by
+        (date, sequence) as there's often more than one entry in the same
+        second. The sequence is the offset of the entry's line in its file
+        where there is one, see SequencedEvents.
+        """
+
+        if not isinstance(breakin_attempt, SequencedEvents):
+            breakin_attempt = SequencedEvents(breakin_attempt)
+        if not isinstance(banned_ip, SequencedEvents):
+            banned_ip = SequencedEvents(banned_ip)
 
+        if source.attempts:
+            events = breakin_attempt
+        else:
+            events = banned_ip
+        for log_date, details, offset in matches:
+            events.add(log_date, details, offset)
 
         return breakin_attempt, banned_ip
 
 
-    def get_file_content(self, log_file):
+    def parse_content(self, content, breakin_attempt, banned_ip, last_month, source):
 
-        if os.path.splitext(log_file)[1] == '.gz':
-            # Use zcat?
-            with open(gzip.open(os.path.join(log_dir, log_file), 'r')) as f:
-                file_content = f.read()  # comes out as bytes
-            try:
-                file_content = file_content.decode("utf-8") # convert to a string
-            except AttributeError:
-                pass # wasn't bytes, ignore
-            content = file_content.split('\n')
+        matches = self.match_content(content, last_month, source)
 
-            return content
+        return self.merge_matches(matches, breakin_attempt, banned_ip, source)
 
-        else:
-            with open(os.path.join(log_dir, log_file), 'r') as f:
-                content = f.read()
-
-            return content
-
-
-    def parse_sshd_content(self, content):
-
-        matches = {}
-
-        for line in content:
-            # Catch the usual
-            # Jun 10 12:40:05 defestri sshd[11019]: Invalid user admin from 61.174.51.217
-            m = re.search(SEARCH_STRING, line)
-            if m is None:
-                # Also catch these
-                # Jun  8 04:31:10 defestri sshd[5013]: User root from 116.10.191.234 not allowed because none of user's groups are listed in AllowGroups
-                m = re.search(ROOT_NOT_ALLOWED_SEARCH_STRING, line)
-            if m:
-                if m.group('log_date')[:3] == last_month.strftime('%b'):
-                    log_date = datetime.strptime(m.group('log_date'), '%b %d %H:%M:%S')
-                    log_date = log_date.replace(year=last_month.year)
-                    # Set the time zone info for the system
-                    #log_date = log_date.replace(tzinfo=sys_tz)
-                    # Convert it to UTC time
-                    #log_date = log_date.astimezone(pytz.utc)
-
-                    #sometimes there's multiple entries per second, since we're
-                    #not that concerned about to the second accuracy just increment
-                    #the seconds until we find a unique log date to put in
-                    if log_date in matches:
-                        while log_date in matches:
-                            ns = log_date.second+1
-                            if ns >= 60:
-                                ns = 0
-                            log_date = log_date.replace(second=ns)
-                    matches[log_date] = (m.group('ip_add'), m.group('user'))
 
-        return matches
+    def get_file_content(self, log_file, log_dir=LOG_DIR):
+
+        return read_lines(os.path.join(log_dir, log_file))
+
 
+    def parse_sshd_content(self, content, last_month=None):
 
-    def read_sshd_logs(self):
+        source = self.sources['auth']
+        matches = self.match_content(content, last_month, source)
+        breakin_attempt, banned_ip = self.merge_matches(matches, SequencedEvents(),
+                                                        SequencedEvents(), source)
 
-        matches = {}
+        return breakin_attempt
 
-        for log_file is os.listdir(self.LOG_DIR):
+
+    def read_sshd_logs(self, checkpoints, log_dir=LOG_DIR):
+
+        """
+        Reads just the sshd attempts from auth.log (or secure on Red Hat
+        type systems), starting from wherever the last run got to.
+        """
+
+        matches = SequencedEvents()
+
+        for log_file in sorted(os.listdir(log_dir)):
             if 'auth.log' in log_file or 'secure' in log_file:
-                modified_time = datetime.strptime(time.ctime(os.path.getmtime(
-                                os.path.join(log_dir, log_file))), "%a %b %d %H:%M:%S %Y")
-                if modified_time > self.last_run():
-                    content = self.get_file_content(log_file)
-                    file_matches = parse_sshd_content(content)
-
-
-
-    def read_logs(self, log_dir):
-
-        banned_ip = {}
-        breakin_attempt = {}
-
-        last_month = datetime.now().replace(day=1) - timedelta(days=1) #.strftime('%b')
-        two_month_ago = last_month.replace(day=1) - timedelta(days=1)
-
-        for log_file in os.listdir(log_dir):
-            if 'auth.log' in log_file or 'fail2ban.log' in log_file:
-                modified_date = datetime.strptime(time.ctime(os.path.getmtime(
-                                os.path.join(log_dir, log_file))), "%a %b %d %H:%M:%S %Y")
-                if  modified_date > two_month_ago:
-                    if 'auth.log' in log_file:
-                        auth_log = True
-                    else:
-                        auth_log = False
-                    if os.path.splitext(log_file)[1] == '.gz':
-                        # Use zcat?
-                        f = gzip.open(os.path.join(log_dir, log_file), 'r')
-                        file_content = f.read()  # comes out as bytes
-                        try:
-                            file_content = file_content.decode("utf-8") # convert to a string
-                        except AttributeError:
-                            pass # wasn't bytes, ignore
-                        split_text = file_content.split('\n')
-                        breakin_attempt, banned_ip = self.parse_content(split_text,
+                log_file = LogFile(os.path.join(log_dir, log_file))
+                offset = checkpoints.start_offset(log_file)
+                if offset is not None:
+                    log_file.offset = offset
+                    source = self.sources['auth']
+                    matches, banned_ip = self.merge_matches(
+                        self.match_file(log_file, None, source, partial=log_file.compressed),
+                        matches, {}, source)
+                    checkpoints.mark(log_file)
+
+        return matches
+
+
+    def get_log_files(self, log_dir, two_month_ago=None):
+
+        """
+        Returns a list of (path, source) tuples for the log files that need
+        to be parsed, the current logs named by each source and the rotated
+        copies alongside them. They're sorted by name so the order, and so
+        the result of merging them, is the same from run to run.
+        """
+
+        log_files = {}
+
+        for source in self.sources.values():
+            for name in source.files:
+                directory, base_name = os.path.split(name)
+                directory = os.path.join(log_dir, directory)
+                if not os.path.isdir(directory):
+                    continue
+                for log_file in os.listdir(directory):
+                    path = os.path.join(directory, log_file)
+                    if base_name not in log_file or path in log_files:
+                        continue
+                    if two_month_ago is not None:
+                        modified_date = datetime.strptime(time.ctime(os.path.getmtime(path)),
+                                                          "%a %b %d %H:%M:%S %Y")
+                        if modified_date <= two_month_ago:
+                            continue
+                    log_files[path] = source
+
+        return sorted(log_files.items(), key=lambda item: item[0])
+
+
+    def read_logs(self, log_dir, workers=PARSE_WORKERS, checkpoints=None, metrics=None):
+
+        """
+        Reads the logs of each source in log_dir. Without checkpoints
+        every file modified in the last couple of months is read from the
+        start and only last month's entries are kept. With checkpoints (a
+        CheckpointStore) each file is read from where the last run stopped
+        and every new entry is kept. What was read is counted in metrics if
+        it's given.
+        """
+
+        if metrics is None:
+            metrics = Metrics(enabled=False)
+
+        banned_ip = SequencedEvents()
+        breakin_attempt = SequencedEvents()
+
+        if checkpoints is None:
+            last_month = datetime.now().replace(day=1) - timedelta(days=1) #.strftime('%b')
+            two_month_ago = last_month.replace(day=1) - timedelta(days=1)
+        else:
+            last_month = None
+            two_month_ago = None
+
+        log_files = []
+        for path, source in self.get_log_files(log_dir, two_month_ago):
+            log_file = LogFile(path)
+            if checkpoints is not None:
+                offset = checkpoints.start_offset(log_file)
+                if offset is None:
+                    # Nothing new since last time
+                    continue
+                log_file.offset = offset
+            log_files.append((log_file, source))
+
+        # The file currently being written to might have a half written
+        # last line, leave it for the next run
+        partial = checkpoints is None
+        start_offsets = [log_file.offset for log_file, source in log_files]
+
+        with metrics.stage('read_logs'):
+            if workers > 1 and len(log_files) > 1:
+                # Decompressing and matching each file is independent so farm
+                # the files out, the matches come back in the same order as
+                # log_files and are merged here exactly as they would be if we
+                # had parsed them one after another
+                paths = [log_file.path for log_file, source in log_files]
+                offsets = [log_file.offset for log_file, source in log_files]
+                partials = [partial or log_file.compressed for log_file, source in log_files]
+                sources = [source for log_file, source in log_files]
+                # Imported here as it pulls in multiprocessing, which a
+                # single worker never needs
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(match_log_file, paths, repeat(last_month),
+                                           sources, offsets, partials)
+                    for result, (log_file, source) in zip(results, log_files):
+                        matches, log_file.offset, log_file.lines_read = result
+                        breakin_attempt, banned_ip = self.merge_matches(matches,
                                                                         breakin_attempt,
                                                                         banned_ip,
-                                                                        last_month,
-                                                                        auth_log)
-
-                    else:
-                        with open(os.path.join(log_dir, log_file), 'r') as f:
-                            breakin_attempt, banned_ip = self.parse_content(f,
-                                                                            breakin_attempt,
-                                                                            banned_ip,
-                                                                            last_month,
-                                                                            auth_log)
+                                                                        source)
+
+            else:
+                for log_file, source in log_files:
+                    matches = self.match_file(log_file, last_month, source,
+                                              partial or log_file.compressed)
+                    breakin_attempt, banned_ip = self.merge_matches(matches,
+                                                                    breakin_attempt,
+                                                                    banned_ip,
+                                                                    source)
+
+        metrics.count('bytes_read', sum(log_file.offset - start_offset for (log_file, source),
+                                        start_offset in zip(log_files, start_offsets)))
+        metrics.count('lines_scanned', sum(log_file.lines_read for log_file, source in log_files))
+        metrics.count('lines_matched', len(breakin_attempt) + len(banned_ip))
+
+        if checkpoints is not None:
+            for log_file, source in log_files:
+                checkpoints.mark(log_file)
 
         return breakin_attempt, banned_ip
@@ -1,37 +1,294 @@
-import re
-from systemd import journal
+"""
+Reads sshd's login attempts from the systemd journal, either straight from
+the journal through python-systemd or from the output of
+journalctl -o export (or -o json) for systems where that isn't available,
+or to test and benchmark against.
+
+Where we got to is kept as the journal's own cursor (see
+checkpoints.CursorStore), so a run only goes through the entries added
+since the last one.
+"""
+
+import json
+import struct
+from itertools import islice, chain
+from datetime import datetime, timedelta
+
+from scrutiny.events import SequencedEvents
+from scrutiny.matchers import JOURNAL_MATCHER
+from scrutiny.settings import JOURNAL_BATCH_SIZE, JOURNAL_WAIT_TIMEOUT
 
 SSHD_UNIT_NAME = "sshd.service"
 
-INVALID_USER_MATCH = "Invalid user (?P<user>.*) from (?P<ip_addr>\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}})"
-USER_NOT_ALLOWED = "User (?P<user>.*) from (?P<ip_addr>\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}) not allowed"
 
+def entry_time(timestamp):
+
+    """
+    The local time of a journal entry from its __REALTIME_TIMESTAMP, which
+    python-systemd has already turned into a datetime but export and JSON
+    output give as microseconds since the epoch.
+    """
+
+    if isinstance(timestamp, datetime):
+        return timestamp
+    microseconds = int(timestamp)
+    return datetime.fromtimestamp(microseconds // 1000000) + \
+        timedelta(microseconds=microseconds % 1000000)
+
+
+def cursor_time(cursor):
+
+    """
+    The __REALTIME_TIMESTAMP (in microseconds) of the entry a cursor points
+    to, taken from its t= field.
+    """
+
+    for field in cursor.split(';'):
+        if field.startswith('t='):
+            return int(field[2:], 16)
+    return None
+
+
+def field_value(value):
+    # Fields that aren't valid UTF-8 come out of journalctl -o json as a
+    # list of byte values, and out of export as bytes
+    if isinstance(value, list):
+        value = bytes(value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    return value
+
+
+def read_export(stream):
+
+    """
+    Yields the entries in journalctl -o export output as dicts. Entries are
+    separated by a blank line, each field is either NAME=value on a line of
+    its own or, if the value isn't plain text, the name on its own line
+    followed by the length of the value as a little endian 64 bit integer
+    and then the value itself.
+    """
+
+    entry = {}
+    for line in iter(stream.readline, b''):
+        if line == b'\n':
+            if entry:
+                yield entry
+                entry = {}
+            continue
+        name, separator, value = line.rstrip(b'\n').partition(b'=')
+        if not separator:
+            size, = struct.unpack('<Q', stream.read(8))
+            value = stream.read(size)
+            stream.read(1)
+        entry[name.decode('ascii')] = field_value(value)
+    if entry:
+        yield entry
+
+
+def read_json(stream):
+
+    """
+    Yields the entries in journalctl -o json output, one JSON object a line.
+    Fields are left as they come, only MESSAGE is looked at closely enough to
+    need field_value.
+    """
+
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+class BaseJournalReader():
+
+    """
+    Matches sshd's journal entries batch_size at a time. Subclasses provide
+    entries, an iterator over the entries after the cursor given to seek.
+    """
+
+    def __init__(self, unit_name=SSHD_UNIT_NAME, batch_size=JOURNAL_BATCH_SIZE):
+        self.unit_name = unit_name
+        self.batch_size = batch_size
+        self.cursor = None
+        self.stopped = False
+
+    def seek(self, cursor):
+        self.cursor = cursor
+
+    def entries(self):
+        raise NotImplementedError
+
+    def match_entries(self, entries, matches):
+        for entry in entries:
+            self.cursor = entry.get('__CURSOR', self.cursor)
+            message = field_value(entry.get('MESSAGE'))
+            if not message:
+                continue
+            m = JOURNAL_MATCHER.match(message)
+            if m:
+                matches.add(entry_time(entry['__REALTIME_TIMESTAMP']),
+                            (m['ip_add'], m['user']))
+
+    def batches(self, matches=None):
 
-class JournalReader():
+        """
+        Yields a (matches, cursor) tuple for every batch_size entries, where
+        matches is a SequencedEvents of the (ip, user) attempts in the batch
+        and cursor is the cursor of the last entry in it. Once the matches
+        are in the database the cursor can be saved. matches is where to
+        carry the numbering on from, see CursorStore.seed.
+        """
 
-    def __init__(self):
+        if matches is None:
+            matches = SequencedEvents()
+        entries = self.entries()
+        while True:
+            batch = list(islice(entries, self.batch_size))
+            if not batch:
+                break
+            # Carry the numbering on from the last batch (or run) in case an
+            # entry in the same microsecond ended up either side of the
+            # boundary
+            matches = matches.emptied()
+            self.match_entries(batch, matches)
+            yield matches, self.cursor
+
+    def get_matches(self):
+
+        """
+        All the attempts after the cursor in one SequencedEvents.
+        """
+
+        matches = SequencedEvents()
+        for batch, cursor in self.batches():
+            matches.update(batch)
+        return matches
+
+    def follow(self, matches=None):
+
+        """
+        Yields batches like batches does, then waits for more entries to be
+        added and yields those too, until stop is called.
+        """
+
+        if matches is None:
+            matches = SequencedEvents()
+        while not self.stopped:
+            for matches, cursor in self.batches(matches):
+                yield matches, cursor
+            if not self.wait():
+                break
+
+    def wait(self):
+        # Nothing more is coming
+        return False
+
+    def stop(self):
+        self.stopped = True
+
+
+class JournalReader(BaseJournalReader):
+
+    """
+    Reads the systemd journal itself through python-systemd.
+    """
+
+    def __init__(self, unit_name=SSHD_UNIT_NAME, batch_size=JOURNAL_BATCH_SIZE,
+                 wait_timeout=JOURNAL_WAIT_TIMEOUT):
+        super().__init__(unit_name, batch_size)
+        # Only needed here, so the rest of Scrutiny (and the export readers)
+        # work without python-systemd installed
+        from systemd import journal
         self.reader = journal.Reader()
         #self.reader.this_boot()
+        self.wait_timeout = wait_timeout
+        self.set_unit(unit_name)
 
     def set_unit(self, unit_name=SSHD_UNIT_NAME):
-        self.reader.add_match(_SYSTEMD_UNIT=unit_name)
+        self.unit_name = unit_name
+        self.reader.flush_matches()
+        if unit_name:
+            self.reader.add_match(_SYSTEMD_UNIT=unit_name)
 
-    def get_matches(self):
-        matches = {}
+    def seek(self, cursor):
+        super().seek(cursor)
+        if cursor:
+            self.reader.seek_cursor(cursor)
 
-        for entry in self.reader():
-            entry_time = entry['__REALTIME_TIMESTAMP']
-            match = re.match(INVALID_USER_MATCH, entry["MESSAGE"])
-            if match:
-                # Need to check to ensure there isn't an entry with the
-                # exact same time
-                matches[entry_time] = (m.group('ip_addr'), m.group('user'))
+    def entries(self):
+        skip = self.cursor
+        while True:
+            entry = self.reader.get_next()
+            if not entry:
+                return
+            # After seek_cursor the first entry is the one the cursor points
+            # at, which was the last one read last time
+            if skip is not None and entry.get('__CURSOR') == skip:
+                skip = None
+                continue
+            skip = None
+            yield entry
 
-            match = re.match(USER_NOT_ALLOWED, entry["MESSAGE"])
-            if match:
-                matches[entry_time] = (m.group('ip_addr'), m.group('user'))
+    def wait(self):
+        # Returns early as soon as something is added to the journal
+        self.reader.wait(self.wait_timeout)
+        return True
 
-        return matches
+
+class JournalStreamReader(BaseJournalReader):
+
+    """
+    Reads journalctl -o export or -o json output from stream, a file opened
+    in binary mode (or sys.stdin.buffer). Which of the two it is is worked
+    out from the first line.
+    """
+
+    def __init__(self, stream, unit_name=SSHD_UNIT_NAME, batch_size=JOURNAL_BATCH_SIZE):
+        super().__init__(unit_name, batch_size)
+        self.stream = stream
+
+    def read_entries(self):
+        first_line = self.stream.readline()
+        if not first_line:
+            return iter(())
+        if first_line.lstrip().startswith(b'{'):
+            return read_json(chain([first_line], self.stream))
+        return read_export(_PrependedStream(first_line, self.stream))
+
+    def entries(self):
+        skip = self.cursor
+        after = cursor_time(skip) if skip else None
+        for entry in self.read_entries():
+            if self.unit_name and entry.get('_SYSTEMD_UNIT') != self.unit_name:
+                continue
+            if after is not None:
+                # There's no seeking in a stream, skip what was read last
+                # time by the cursor's timestamp
+                if entry.get('__CURSOR') == skip or \
+                        int(entry['__REALTIME_TIMESTAMP']) < after:
+                    continue
+                after = None
+            yield entry
+
+
+class _PrependedStream():
+
+    """
+    Puts a line that's already been read back in front of a stream.
+    """
+
+    def __init__(self, first_line, stream):
+        self.first_line = first_line
+        self.stream = stream
+
+    def readline(self):
+        if self.first_line is not None:
+            line, self.first_line = self.first_line, None
+            return line
+        return self.stream.readline()
+
+    def read(self, size):
+        return self.stream.read(size)
 
 
 # Sample data from journalctl
@@ -0,0 +1,206 @@
+"""
+Reads the logs of other hosts, for when syslog from a number of servers is
+collected in one place, typically a directory per host:
+
+    /var/log/hosts/web1/auth.log
+    /var/log/hosts/web1/fail2ban.log
+    /var/log/hosts/mail1/mail.log.2.gz
+
+Each host's logs are read by a single worker, one after another as they
+would be for the local logs, and the hosts are spread over a pool of
+processes. The attempts and bans of each host are handed to the DB writer
+(see scrutiny/writer.py), recorded against that host, as soon as it's
+done, and written while the other hosts are still being read. Each host
+has its own checkpoints, so a host that's behind or has gone quiet
+doesn't hold up the others, and its own figures in the metrics.
+
+    HostReader(scrutiny, host_log_dirs('/var/log/hosts'), workers=4).run()
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta, datetime
+
+from scrutiny.checkpoints import CheckpointStore
+from scrutiny.events import SequencedEvents
+from scrutiny.handlers.file import LogFile, LogFileReader
+from scrutiny.rules import load_sources
+from scrutiny.settings import PARSE_WORKERS, INCREMENTAL
+
+logger = logging.getLogger('scrutiny')
+
+
+def host_log_dirs(root):
+
+    """
+    Returns a (host, log_dir) tuple for each directory in root, which is
+    taken to be named after the host whose logs are in it.
+    """
+
+    return [(name, os.path.join(root, name)) for name in sorted(os.listdir(root))
+            if os.path.isdir(os.path.join(root, name))]
+
+
+def match_host_logs(log_files, last_month):
+
+    """
+    Matches the log files of a single host in order, log_files being a list
+    of (path, source, offset, partial) tuples. Returns the host's attempts
+    and bans, the (offset, lines read) each file finished at and how long it
+    took. Lives out here rather than on HostReader so it can be handed to a
+    process pool.
+    """
+
+    start = time.perf_counter()
+    reader = LogFileReader()
+    breakin_attempt = SequencedEvents()
+    banned_ip = SequencedEvents()
+    positions = []
+
+    for path, source, offset, partial in log_files:
+        log_file = LogFile(path, offset)
+        matches = reader.match_file(log_file, last_month, source, partial)
+        breakin_attempt, banned_ip = reader.merge_matches(matches, breakin_attempt,
+                                                          banned_ip, source)
+        positions.append((log_file.offset, log_file.lines_read))
+
+    return breakin_attempt, banned_ip, positions, time.perf_counter() - start
+
+
+class HostReader():
+
+    """
+    Reads the logs of the hosts in hosts, a list of (host, log_dir) tuples,
+    in up to workers processes and inserts what's found as each host
+    finishes. The rules are loaded with the host name left open, so a
+    host's logs match whatever it calls itself.
+    """
+
+    def __init__(self, scrutiny, hosts, workers=PARSE_WORKERS, incremental=INCREMENTAL):
+        self.scrutiny = scrutiny
+        self.hosts = hosts
+        self.workers = workers
+        self.incremental = incremental
+        self.reader = LogFileReader(load_sources(host=None))
+
+    def log_files(self, host, log_dir, checkpoints, two_month_ago):
+
+        """
+        The (LogFile, source) tuples to read for host, each LogFile starting
+        from where the host's checkpoints say, as LogFileReader.read_logs.
+        """
+
+        log_files = []
+        for path, source in self.reader.get_log_files(log_dir, two_month_ago):
+            log_file = LogFile(path)
+            if checkpoints is not None:
+                offset = checkpoints.start_offset(log_file)
+                if offset is None:
+                    continue
+                log_file.offset = offset
+            log_files.append((log_file, source))
+        return log_files
+
+    def results(self, jobs, last_month):
+
+        """
+        Yields each job in jobs, a list of (host, checkpoints, log_files),
+        along with what match_host_logs made of it, in the order the hosts
+        finish.
+        """
+
+        # The file currently being written to might have a half written
+        # last line, leave it for the next run
+        partial = not self.incremental
+
+        def arguments(log_files):
+            return [(log_file.path, source, log_file.offset, partial or log_file.compressed)
+                    for log_file, source in log_files]
+
+        if self.workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                yield job, match_host_logs(arguments(job[2]), last_month)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(match_host_logs, arguments(job[2]), last_month), job)
+                           for job in jobs)
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def store(self, writer, host, checkpoints, log_files, result):
+
+        """
+        Queues a host's attempts and bans with writer, which moves its
+        checkpoints on once they're in, and records what it took.
+        """
+
+        breakin_attempt, banned_ip, positions, seconds = result
+        metrics = self.scrutiny.metrics
+
+        bytes_read = 0
+        lines_scanned = 0
+        for (log_file, source), (offset, lines_read) in zip(log_files, positions):
+            bytes_read += offset - log_file.offset
+            lines_scanned += lines_read
+            log_file.offset = offset
+            log_file.lines_read = lines_read
+
+        def save_checkpoints():
+            for log_file, source in log_files:
+                checkpoints.mark(log_file)
+            checkpoints.save()
+
+        unique_ips = set(ip for ip, user in breakin_attempt.values())
+        writer.submit(unique_ips, breakin_attempt, banned_ip, host=host,
+                      then=None if checkpoints is None else save_checkpoints)
+
+        stats = {
+            'files': len(log_files),
+            'bytes_read': bytes_read,
+            'lines_scanned': lines_scanned,
+            'lines_matched': len(breakin_attempt) + len(banned_ip),
+            'seconds': seconds,
+        }
+        metrics.count('bytes_read', bytes_read)
+        metrics.count('lines_scanned', lines_scanned)
+        metrics.count('lines_matched', stats['lines_matched'])
+        metrics.host(host, stats)
+        logger.info('{}: {} files, {} lines, {} matches in {:.2f}s ({:.0f} lines/sec)'.format(
+            host, stats['files'], lines_scanned, stats['lines_matched'], seconds,
+            lines_scanned / seconds if seconds else 0))
+        return stats
+
+    def run(self):
+
+        """
+        Reads and stores the logs of every host, returns a dict of host
+        name to the figures recorded in the metrics for it.
+        """
+
+        if self.incremental:
+            last_month = None
+            two_month_ago = None
+        else:
+            last_month = datetime.now().replace(day=1) - timedelta(days=1)
+            two_month_ago = last_month.replace(day=1) - timedelta(days=1)
+
+        jobs = []
+        for host, log_dir in self.hosts:
+            if self.incremental:
+                checkpoints = CheckpointStore(self.scrutiny.session, host)
+            else:
+                checkpoints = None
+            log_files = self.log_files(host, log_dir, checkpoints, two_month_ago)
+            if log_files:
+                jobs.append((host, checkpoints, log_files))
+            else:
+                logger.info('{}: nothing new'.format(host))
+
+        stats = {}
+        with self.scrutiny.metrics.stage('read_hosts'), self.scrutiny.get_writer() as writer:
+            for (host, checkpoints, log_files), result in self.results(jobs, last_month):
+                stats[host] = self.store(writer, host, checkpoints, log_files, result)
+        return stats
@@ -0,0 +1,189 @@
+"""
+Compiled matchers for the log lines Scrutiny is interested in. The rules
+for the log files themselves are loaded from rules.ini, see scrutiny/rules.py.
+"""
+
+import re
+
+from scrutiny.settings import JOURNAL_SEARCH_STRING, JOURNAL_NOT_ALLOWED_SEARCH_STRING
+
+# Up to this many keywords each one is looked for in turn with a substring
+# check, past it a single regex of all of them is quicker
+FEW_KEYWORDS = 8
+
+
+def keyword_pattern(keywords):
+
+    """
+    A regex that matches any of keywords, built as a trie so keywords that
+    start the same way share the start ('service(?:1|2)' rather than
+    'service1|service2'). The regex engine tries alternatives one after
+    another, a plain alternation would cost more the more keywords there
+    are.
+    """
+
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        # The end of a keyword
+        node[''] = {}
+
+    def build(node):
+        alternatives = [re.escape(char) + build(child)
+                        for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        # A keyword can end here, whatever comes next is enough
+        if '' in node:
+            return ''
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:{})'.format('|'.join(alternatives))
+
+    return build(trie)
+
+
+class LineMatcher():
+
+    """
+    Matches a line against any number of patterns. Each pattern comes with
+    a keyword that has to appear in the line for the pattern to have any
+    chance of matching, so the vast majority of lines are thrown away before
+    the regex engine is started on a pattern. With a handful of keywords
+    that's a substring check for each, with more it's one search of a regex
+    of them all, so the cost of a line that doesn't match stays about the
+    same however many rules there are. A line that has a keyword is only
+    tried against the patterns for the keywords it has, in the order the
+    rules were given, and the named groups of the first one to match are
+    handed back as a dict.
+
+    scan does the same over a bytes-like buffer, an mmapped log file say,
+    without splitting it into lines first. It jumps from one keyword to the
+    next and only the groups of lines that match are decoded.
+    """
+
+    def __init__(self, rules):
+        # rules is a list of (keyword, pattern) tuples, earlier patterns
+        # win if more than one could match the same line
+        self.keywords = tuple(sorted(set(keyword for keyword, pattern in rules)))
+        self.bytes_keywords = tuple(keyword.encode('utf-8') for keyword in self.keywords)
+        self.regexes = [re.compile(pattern) for keyword, pattern in rules]
+        self.bytes_regexes = [re.compile(pattern.encode('utf-8')) for keyword, pattern in rules]
+
+        # The rules to try for each keyword
+        self.index = {}
+        for number, (keyword, pattern) in enumerate(rules):
+            self.index.setdefault(keyword, []).append(number)
+        self.bytes_index = dict((keyword.encode('utf-8'), numbers)
+                                for keyword, numbers in self.index.items())
+
+        if len(self.keywords) > FEW_KEYWORDS:
+            pattern = keyword_pattern(self.keywords)
+            self.keyword_regex = re.compile(pattern)
+            self.bytes_keyword_regex = re.compile(pattern.encode('utf-8'))
+        else:
+            self.keyword_regex = None
+            self.bytes_keyword_regex = None
+
+    def candidates(self, line, keywords, index):
+
+        """
+        The numbers of the rules to try on line, in order.
+        """
+
+        found = [keyword for keyword in keywords if keyword in line]
+        if len(found) == 1:
+            return index[found[0]]
+        return sorted(set(number for keyword in found for number in index[keyword]))
+
+    def match(self, line):
+        if self.keyword_regex is None:
+            for keyword in self.keywords:
+                if keyword in line:
+                    break
+            else:
+                return None
+        elif self.keyword_regex.search(line) is None:
+            return None
+
+        for number in self.candidates(line, self.keywords, self.index):
+            m = self.regexes[number].search(line)
+            if m is not None:
+                return m.groupdict()
+        return None
+
+    def scan(self, buffer, start=0, end=None, offsets=False):
+
+        """
+        Yields the groups of each line in buffer between start and end that
+        matches, as match would for the decoded line. start has to be the
+        beginning of a line. With offsets each comes as an (offset, groups)
+        tuple, offset being where the line starts in buffer.
+        """
+
+        if end is None:
+            end = len(buffer)
+
+        for line_start, line_end in self.candidate_lines(buffer, start, end):
+            line = buffer[line_start:line_end]
+            for number in self.candidates(line, self.bytes_keywords, self.bytes_index):
+                m = self.bytes_regexes[number].search(line)
+                if m is not None:
+                    # Usernames can be any old garbage, a bad byte shouldn't
+                    # stop us reading the rest of the file
+                    groups = dict((name, None if value is None else
+                                   value.decode('utf-8', errors='replace'))
+                                  for name, value in m.groupdict().items())
+                    yield (line_start, groups) if offsets else groups
+                    break
+
+    def candidate_lines(self, buffer, start, end):
+
+        """
+        Yields the (start, end) of each line in buffer with a keyword in it.
+        """
+
+        def line_bounds(hit):
+            line_start = buffer.rfind(b'\n', start, hit) + 1 or start
+            line_end = buffer.find(b'\n', hit, end)
+            if line_end == -1:
+                line_end = end
+            return line_start, line_end
+
+        if self.bytes_keyword_regex is not None:
+            position = start
+            while position < end:
+                m = self.bytes_keyword_regex.search(buffer, position, end)
+                if m is None:
+                    return
+                line_start, line_end = line_bounds(m.start())
+                yield line_start, line_end
+                position = line_end + 1
+            return
+
+        # Where each keyword next turns up
+        hits = {}
+        for keyword in self.bytes_keywords:
+            hit = buffer.find(keyword, start, end)
+            if hit != -1:
+                hits[keyword] = hit
+
+        while hits:
+            line_start, line_end = line_bounds(min(hits.values()))
+            yield line_start, line_end
+
+            # Anything else on this line has been dealt with
+            for keyword, keyword_hit in list(hits.items()):
+                if keyword_hit < line_end:
+                    keyword_hit = buffer.find(keyword, line_end, end)
+                    if keyword_hit == -1:
+                        del hits[keyword]
+                    else:
+                        hits[keyword] = keyword_hit
+
+
+# The MESSAGE of sshd's journal entries, e.g. Invalid user admin from 61.174.51.217
+JOURNAL_MATCHER = LineMatcher([('Invalid user', JOURNAL_SEARCH_STRING),
+                               ('not allowed', JOURNAL_NOT_ALLOWED_SEARCH_STRING)])
@@ -0,0 +1,194 @@
+"""
+Counters and timers for a Scrutiny run, so when one is slow we can see
+where the time went.
+
+Stages are timed by wall clock and by CPU time, the difference being time
+spent waiting on disk, the DB or the GeoIP API. A stage can be entered more
+than once (each batch when following the logs, say) and the times add up.
+Stages can also be inside one another, insert includes geoip for example.
+Counts are kept per file or per batch rather than per line, so keeping
+them costs next to nothing, and when metrics are turned off count and stage
+do nothing at all.
+
+The DB writer thread (see scrutiny/writer.py) counts and times the inserts
+while the main thread counts what it reads, so the totals are only updated
+under a lock. A stage's CPU time is that of the thread it ran on, the
+other's work doesn't get counted towards it.
+
+At the end of a run the numbers are logged and can also be written as JSON
+or for Prometheus' node_exporter textfile collector.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+COUNTERS = (
+    ('bytes_read', 'Bytes of (uncompressed) log read'),
+    ('lines_scanned', 'Log lines run through the matchers'),
+    ('lines_matched', 'Log lines that were attempts or bans'),
+    ('events_deduped', 'Attempts and bans skipped as already in the database'),
+    ('dedup_lookups', 'Attempts and bans the dedup filter had to check with the database'),
+    ('rows_inserted', 'Rows inserted into the database'),
+    ('geoip_api_calls', 'Lookups made against the GeoIP API'),
+    ('geoip_cache_hits', 'GeoIP lookups answered from the cache'),
+)
+
+HOST_GAUGES = (
+    ('bytes_read', "Bytes of (uncompressed) log read from each host's logs"),
+    ('lines_scanned', "Lines read from each host's logs"),
+    ('lines_matched', "Attempts and bans found in each host's logs"),
+    ('seconds', "Time spent reading each host's logs"),
+)
+
+
+def peak_rss(who=None):
+
+    """
+    The peak resident set size in bytes of this process, or of the worker
+    processes it has waited on if who is resource.RUSAGE_CHILDREN. None
+    where the resource module isn't available.
+    """
+
+    if resource is None:
+        return None
+    if who is None:
+        who = resource.RUSAGE_SELF
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+class StageTimer():
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        with self.metrics.lock:
+            stage = self.metrics.stages.setdefault(self.name,
+                                                   {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['calls'] += 1
+        return False
+
+
+class Metrics():
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.counters = dict((name, 0) for name, description in COUNTERS)
+        self.stages = {}
+        # Counts for each host when reading other hosts' logs, see
+        # scrutiny/hosts.py
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def host(self, name, stats):
+        if self.enabled:
+            with self.lock:
+                self.hosts[name] = dict(stats)
+
+    def stage(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return StageTimer(self, name)
+
+    def as_dict(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = dict((name, dict(stage)) for name, stage in self.stages.items())
+            hosts = dict((name, dict(stats)) for name, stats in self.hosts.items())
+        return {
+            'started': self.started,
+            'counters': counters,
+            'stages': stages,
+            'hosts': hosts,
+            'peak_rss_bytes': peak_rss(),
+            'children_peak_rss_bytes': peak_rss(resource.RUSAGE_CHILDREN) if resource else None,
+        }
+
+    def log(self, logger):
+        values = self.as_dict()
+        for name, stage in sorted(values['stages'].items()):
+            logger.info('{}: {:.3f}s wall, {:.3f}s CPU'.format(name, stage['wall'], stage['cpu']))
+        logger.info(', '.join('{} {}'.format(name.replace('_', ' '), value)
+                              for name, value in values['counters'].items()))
+        rss = peak_rss()
+        if rss is not None:
+            logger.info('Peak RSS {:.1f} MB'.format(rss / 1024 / 1024))
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.as_dict(), indent=2) + '\n')
+
+    def prometheus(self):
+
+        """
+        The metrics in Prometheus' text format. They're all gauges as the
+        file is replaced each run rather than added to.
+        """
+
+        values = self.as_dict()
+        descriptions = dict(COUNTERS)
+        lines = []
+
+        def gauge(name, description, samples):
+            lines.append('# HELP scrutiny_{} {}'.format(name, description))
+            lines.append('# TYPE scrutiny_{} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('scrutiny_{}{} {}'.format(name, labels, value))
+
+        for name, value in values['counters'].items():
+            gauge(name, descriptions.get(name, name), [('', value)])
+        for field, description in (('wall', 'Wall clock time spent in each stage'),
+                                   ('cpu', 'CPU time spent in each stage')):
+            gauge('stage_{}_seconds'.format(field), description,
+                  [('{{stage="{}"}}'.format(name), '{:.6f}'.format(stage[field]))
+                   for name, stage in sorted(values['stages'].items())])
+        for field, description in HOST_GAUGES:
+            samples = [('{{host="{}"}}'.format(name), stats[field])
+                       for name, stats in sorted(values['hosts'].items())]
+            if samples:
+                gauge('host_{}'.format(field), description, samples)
+        if values['peak_rss_bytes'] is not None:
+            gauge('peak_rss_bytes', 'Peak resident set size', [('', values['peak_rss_bytes'])])
+        gauge('last_run_timestamp_seconds', 'When the run started', [('', values['started'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.prometheus())
+
+
+def write_atomically(path, content):
+    # The textfile collector could read the file at any moment, never let
+    # it see one that's half written
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
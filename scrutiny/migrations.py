@@ -0,0 +1,156 @@
+"""
+Brings a database created by an older version of Scrutiny up to date.
+
+metadata.create_all will create any tables that are missing, but it won't
+touch tables that already exist. migrate adds the columns and indexes the
+models have gained since, then fills in the new columns for existing rows.
+Duplicate attempts and bans are cleared out before the unique indexes are
+added. It's safe to run more than once.
+"""
+
+import logging
+
+from sqlalchemy import inspect, bindparam
+
+from scrutiny.models import Base, IPAddr, SubnetDetails, BreakinAttempts, BannedIPs, \
+    DailyIPCount, NO_USER
+from scrutiny.rollups import rebuild_rollups
+from scrutiny.netutils import pack_ip
+from scrutiny.utils import chunks
+from scrutiny.settings import DB_CHUNK_SIZE, HOST_SERVER_NAME
+
+logger = logging.getLogger('scrutiny')
+
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                logger.info('Adding column {}.{}'.format(table.name, column.name))
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect)))
+
+
+def missing_indexes(engine):
+    inspector = inspect(engine)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing += [index for index in table.indexes if index.name not in existing]
+    return missing
+
+
+def add_missing_indexes(engine):
+    for index in missing_indexes(engine):
+        logger.info('Adding index {}'.format(index.name))
+        index.create(engine)
+
+
+def remove_duplicate_events(session):
+
+    """
+    Deletes all but the first of any attempts or bans that are recorded
+    more than once, which the unique indexes won't allow. The ids to keep
+    are picked in a derived table as MySQL won't delete from a table it's
+    selecting from in the same statement.
+    """
+
+    for model, columns in ((BreakinAttempts, ('date', 'seq', 'host', 'user', 'ipaddr')),
+                           (BannedIPs, ('date', 'seq', 'host', 'ipaddr'))):
+        table = model.__tablename__
+        result = session.execute(
+            'DELETE FROM {table} WHERE id NOT IN (SELECT id FROM '
+            '(SELECT MIN(id) AS id FROM {table} GROUP BY {columns}) AS keep)'.format(
+                table=table, columns=', '.join(columns)))
+        if result.rowcount:
+            logger.info('Removed {} duplicate rows from {}'.format(result.rowcount, table))
+    session.commit()
+
+
+def backfill_packed_addresses(session, chunk_size=DB_CHUNK_SIZE):
+
+    """
+    Fills in IPAddr.ip_packed and the SubnetDetails network bounds for rows
+    added before they existed.
+    """
+
+    ipaddr = IPAddr.__table__
+    rows = session.query(IPAddr.id, IPAddr.ip_addr).filter(IPAddr.ip_packed==None).all()
+    update = ipaddr.update().where(ipaddr.c.id==bindparam('_id')). \
+        values(ip_packed=bindparam('_ip_packed'))
+    for chunk in chunks(rows, chunk_size):
+        session.execute(update, [{'_id': row_id, '_ip_packed': pack_ip(ip_addr)}
+                                 for row_id, ip_addr in chunk])
+        session.commit()
+    if rows:
+        logger.info('Packed {} addresses'.format(len(rows)))
+
+    subnets = session.query(SubnetDetails).filter(SubnetDetails.network_start==None).all()
+    for subnet in subnets:
+        subnet.set_bounds()
+    session.commit()
+
+
+def backfill_sequences(session):
+
+    """
+    Rows added before BreakinAttempts.seq and BannedIPs.seq existed had
+    their dates bumped along a second at a time instead, so they're all
+    the first in their second.
+    """
+
+    for model in (BreakinAttempts, BannedIPs):
+        session.query(model).filter(model.seq==None). \
+            update({model.seq: 0}, synchronize_session=False)
+    session.commit()
+
+
+def backfill_hosts(session):
+
+    """
+    Rows added before BreakinAttempts.host and BannedIPs.host existed were
+    all from the host Scrutiny runs on.
+    """
+
+    for model in (BreakinAttempts, BannedIPs):
+        session.query(model).filter(model.host==None). \
+            update({model.host: HOST_SERVER_NAME}, synchronize_session=False)
+    session.commit()
+
+
+def backfill_users(session):
+
+    """
+    Attempts without a username used to be stored with a NULL one, which
+    the unique index never counts as a duplicate. They're NO_USER now.
+    """
+
+    session.query(BreakinAttempts).filter(BreakinAttempts.user==None). \
+        update({BreakinAttempts.user: NO_USER}, synchronize_session=False)
+    session.commit()
+
+
+def build_missing_rollups(session):
+    # The summary tables are new, fill them in from what's already there
+    if session.query(DailyIPCount.id).first() is None and \
+            session.query(BreakinAttempts.id).first() is not None:
+        logger.info('Building summary tables')
+        rebuild_rollups(session)
+
+
+def migrate(engine, session):
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    # seq, host and user have to be filled in before duplicates can be found
+    # on them
+    backfill_sequences(session)
+    backfill_hosts(session)
+    backfill_users(session)
+    remove_duplicate_events(session)
+    add_missing_indexes(engine)
+    backfill_packed_addresses(session)
+    build_missing_rollups(session)
@@ -2,12 +2,21 @@
 The database models used by Scrutiny.
 """
 
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey, \
+    DateTime, Date, Boolean, VARBINARY, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
+from scrutiny.netutils import pack_ip, network_bounds
+from scrutiny.settings import HOST_SERVER_NAME
+
 Base = declarative_base()
 
+# What's stored as the user of an attempt that didn't give one (postfix
+# SASL failures without a sasl_username). It can't be NULL, the unique
+# index on BreakinAttempts would never see two NULLs as the same
+NO_USER = ''
+
 class IPAddr(Base):
 
     """
@@ -19,19 +28,34 @@ class IPAddr(Base):
     __tablename__ = 'ipaddr'
     id = Column(Integer, autoincrement=True, primary_key=True)
     ip_addr = Column(String(45), unique=True)
+    # The address packed into 16 bytes (see netutils.pack_ip), indexed so
+    # finding the addresses in a network is a range scan
+    ip_packed = Column(VARBINARY(16), index=True)
     city_name = Column(String(255))
     region = Column(String(255))
     country = Column(String(255))
     bans = relationship('BannedIPs', backref='ip', lazy='dynamic')
     breakins = relationship('BreakinAttempts', backref='ip', lazy='dynamic')
-    subnet_id = Column(Integer, ForeignKey('subnetdetails.id'))
+    subnet_id = Column(Integer, ForeignKey('subnetdetails.id'), index=True)
 
     def __init__(self, ip_addr):
         self.ip_addr = ip_addr
+        self.ip_packed = pack_ip(ip_addr)
 
     def __repr__(self):
         return '<IP: {}>'.format(self.ip_addr)
 
+    @classmethod
+    def in_network(cls, network):
+
+        """
+        A filter for the addresses in network, given in CIDR notation, e.g.
+        session.query(IPAddr).filter(IPAddr.in_network('61.174.0.0/16'))
+        """
+
+        start, end = network_bounds(network)
+        return cls.ip_packed.between(start, end)
+
     def print_location(self):
 
         """
@@ -61,7 +85,16 @@ class BannedIPs(Base):
     __tablename__ = 'bannedips'
     id = Column(Integer, autoincrement=True, primary_key=True)
     date = Column(DateTime)
-    ipaddr = Column(Integer, ForeignKey('ipaddr.id'))
+    # Orders bans logged with the same date, see events.SequencedEvents.
+    # Usually where the line is in its log so it can be a big number
+    seq = Column(BigInteger, default=0)
+    # The host it was logged on, see scrutiny/hosts.py
+    host = Column(String(255), default=HOST_SERVER_NAME)
+    ipaddr = Column(Integer, ForeignKey('ipaddr.id'), index=True)
+    # The same ban is never recorded twice, insert_into_db leaves it to the
+    # DB to turn away the ones we already have
+    __table_args__ = (Index('ix_bannedips_date_seq_host_ipaddr', 'date', 'seq', 'host', 'ipaddr',
+                            unique=True),)
 
     def __repr__(self):
         return '<BannedIP: {}>'.format(self.date.strftime('%d-%m-%Y %H:%M:%S'))
@@ -78,11 +111,20 @@ class BreakinAttempts(Base):
     __tablename__ = 'breakinattempts'
     id = Column(Integer, autoincrement=True, primary_key=True)
     date = Column(DateTime)
+    # Orders attempts logged in the same second, see events.SequencedEvents.
+    # As for BannedIPs
+    seq = Column(BigInteger, default=0)
     # Some programs accept only 8 character user names
     # The max for useradd seems to be 32 though, don't think
     # we'll see attempts with usernames longer than that though
-    user = Column(String(32))
-    ipaddr = Column(Integer, ForeignKey('ipaddr.id'))
+    user = Column(String(32), nullable=False, default=NO_USER)
+    # The host it was logged on, see scrutiny/hosts.py
+    host = Column(String(255), default=HOST_SERVER_NAME)
+    ipaddr = Column(Integer, ForeignKey('ipaddr.id'), index=True)
+    # See BannedIPs. The address is part of it as two logs can have a line
+    # in the same second at the same offset
+    __table_args__ = (Index('ix_breakinattempts_date_seq_host_user_ipaddr', 'date', 'seq', 'host',
+                            'user', 'ipaddr', unique=True),)
 
     def __repr__(self):
         return '<BreakinAttempt: {} on {}>'.format(self.user,
@@ -105,10 +147,163 @@ class SubnetDetails(Base):
     cidr = Column(String(3))
     netmask = Column(String(15))
     number_hosts = Column(Integer)
+    # The first and last addresses in the subnet, packed like IPAddr.ip_packed
+    network_start = Column(VARBINARY(16))
+    network_end = Column(VARBINARY(16))
     ipaddr = relationship('IPAddr', backref='subnetdetails')
 
     def __init__(self, subnet_id):
         self.subnet_id = subnet_id
 
+    def set_bounds(self):
+        self.network_start, self.network_end = network_bounds(self.subnet_id + self.cidr)
+
     def __repr__(self):
         return '<Subnet:{}>'.format(self.subnet_id)
+
+
+class DailyIPCount(Base):
+
+    """
+    The number of breakin attempts and bans for each IP address each day,
+    kept up to date by insert_into_db (see scrutiny/rollups.py) so reports
+    don't have to count up the raw rows.
+    """
+
+    __tablename__ = 'dailyipcount'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    day = Column(Date)
+    ipaddr = Column(Integer, ForeignKey('ipaddr.id'))
+    attempts = Column(Integer, default=0)
+    bans = Column(Integer, default=0)
+    __table_args__ = (Index('ix_dailyipcount_day_ipaddr', 'day', 'ipaddr', unique=True),
+                      Index('ix_dailyipcount_ipaddr', 'ipaddr'))
+
+    def __repr__(self):
+        return '<DailyIPCount: {} on {}>'.format(self.ipaddr, self.day)
+
+
+class DailyUserCount(Base):
+
+    """
+    The number of breakin attempts with each username each day.
+    """
+
+    __tablename__ = 'dailyusercount'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    day = Column(Date)
+    user = Column(String(32))
+    attempts = Column(Integer, default=0)
+    __table_args__ = (Index('ix_dailyusercount_day_user', 'day', 'user', unique=True),)
+
+    def __repr__(self):
+        return '<DailyUserCount: {} on {}>'.format(self.user, self.day)
+
+
+class DailySubnetCount(Base):
+
+    """
+    The number of breakin attempts and bans from each common subnet each
+    day. Which subnet an address is in can change whenever the common
+    subnets are recalculated, so this one is rebuilt each time they are.
+    """
+
+    __tablename__ = 'dailysubnetcount'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    day = Column(Date)
+    subnet_id = Column(Integer, ForeignKey('subnetdetails.id'))
+    attempts = Column(Integer, default=0)
+    bans = Column(Integer, default=0)
+    __table_args__ = (Index('ix_dailysubnetcount_day_subnet_id', 'day', 'subnet_id',
+                            unique=True),)
+
+    def __repr__(self):
+        return '<DailySubnetCount: {} on {}>'.format(self.subnet_id, self.day)
+
+
+class DataVersion(Base):
+
+    """
+    A single row counter that goes up every time new data is written, so
+    cached reports (see scrutiny/reports.py) know when they're out of date.
+    """
+
+    __tablename__ = 'dataversion'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return '<DataVersion: {}>'.format(self.version)
+
+
+class LogCheckpoint(Base):
+
+    """
+    The Log Checkpoint table. Records how far through each log file Scrutiny
+    has read so the next run can carry on from there. Files are identified
+    by their device and inode, so a checkpoint follows a file when logrotate
+    renames it, and by a fingerprint (a hash of the first line) so we can
+    tell when an inode has been reused or the same content has turned up
+    under a new inode, like when a rotated log is compressed. The offset is
+    in bytes of uncompressed content.
+    """
+
+    __tablename__ = 'logcheckpoint'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    # Only set for the logs of other hosts, see scrutiny/hosts.py
+    host = Column(String(255))
+    path = Column(String(255))
+    device = Column(BigInteger)
+    inode = Column(BigInteger)
+    size = Column(BigInteger)
+    offset = Column(BigInteger)
+    fingerprint = Column(String(40))
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return '<LogCheckpoint: {} @ {}>'.format(self.path, self.offset)
+
+
+class JournalCursor(Base):
+
+    """
+    The cursor of the last systemd journal entry read for a unit, so the
+    next run can seek straight to it rather than going through the whole
+    journal again.
+    """
+
+    __tablename__ = 'journalcursor'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    unit = Column(String(255), unique=True)
+    cursor = Column(String(255))
+    # The date of the last entry read and how many entries in that second
+    # had been numbered, see SequencedEvents.seed
+    last_date = Column(DateTime)
+    last_count = Column(Integer)
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return '<JournalCursor: {} @ {}>'.format(self.unit, self.cursor)
+
+
+class CachedLocation(Base):
+
+    """
+    The Cached Location table. Holds the responses we've had from the GeoIP
+    API so an address we've looked up before doesn't need looking up again
+    until the entry expires. found is False for addresses the API couldn't
+    tell us anything about (or failed for), those are remembered too so we
+    don't keep asking.
+    """
+
+    __tablename__ = 'cachedlocation'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    ip_addr = Column(String(45), unique=True)
+    region = Column(String(255))
+    country = Column(String(255))
+    found = Column(Boolean)
+    fetched = Column(DateTime)
+
+    def __repr__(self):
+        return '<CachedLocation: {}>'.format(self.ip_addr)
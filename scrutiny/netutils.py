@@ -0,0 +1,87 @@
+"""
+Helpers for working with IP addresses as integers.
+"""
+
+import socket
+import struct
+import ipaddress
+from itertools import groupby
+
+# IPv4 addresses are packed as IPv4-mapped IPv6 addresses (::ffff:a.b.c.d)
+# so both kinds sort together in one 16 byte column
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+def ip_to_int(ip_addr):
+
+    """
+    Converts an IPv4 address formatted as a string i.e. '74.123.51.130'
+    to the integer it represents, 1249588098. IPv4 only, an IPv6 address
+    raises OSError.
+    """
+
+    return struct.unpack('!I', socket.inet_aton(ip_addr))[0]
+
+
+def int_to_ip(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def pack_ip(ip_addr):
+
+    """
+    Packs an IPv4 or IPv6 address into 16 bytes, big endian so comparing the
+    packed forms compares the addresses. This is what's stored in
+    IPAddr.ip_packed.
+    """
+
+    address = ipaddress.ip_address(ip_addr)
+    if address.version == 4:
+        return IPV4_MAPPED_PREFIX + address.packed
+    return address.packed
+
+
+def network_bounds(network):
+
+    """
+    Returns the packed first and last addresses of a network given in CIDR
+    notation, e.g. '61.174.0.0/16'.
+    """
+
+    network = ipaddress.ip_network(network, strict=False)
+    return pack_ip(network.network_address), pack_ip(network.broadcast_address)
+
+
+def group_common_subnets(ip_addrs):
+
+    """
+    Groups IPv4 addresses that share a /24 or a /16 with at least one other
+    address. Returns two dicts, one of /24 prefixes ('74.123.51') and one of
+    /16 prefixes ('172.16'), to the sorted list of addresses in them. An
+    address is only put in a /16 if it shares it with an address from a
+    different /24. IPv6 addresses are left out, SubnetDetails only has room
+    for IPv4 networks.
+
+    The addresses are converted to integers and sorted once, after which
+    the members of each prefix are next to each other, so this is
+    O(n log n) rather than comparing every address with every other one.
+    """
+
+    numbers = sorted(set(ip_to_int(ip_addr) for ip_addr in ip_addrs if ':' not in ip_addr))
+
+    subnet24 = {}
+    for prefix, group in groupby(numbers, lambda number: number >> 8):
+        group = list(group)
+        if len(group) >= 2:
+            ip_list = [int_to_ip(number) for number in group]
+            subnet24[ip_list[0].rsplit('.', 1)[0]] = ip_list
+
+    subnet16 = {}
+    for prefix, group in groupby(numbers, lambda number: number >> 16):
+        group = list(group)
+        # Sorted, so if the first and last are in the same /24 they all are
+        if group[0] >> 8 != group[-1] >> 8:
+            ip_list = [int_to_ip(number) for number in group]
+            subnet16[ip_list[0].rsplit('.', 2)[0]] = ip_list
+
+    return subnet24, subnet16
@@ -0,0 +1,220 @@
+"""
+Reports over the Scrutiny database: the top attacking addresses and
+usernames, where the attacks come from, how many attackers get banned and
+which addresses make up the common subnets, each over an optional range of
+days. They read the daily summary tables (see scrutiny/rollups.py) rather
+than the raw attempts.
+
+Results are kept in an LRU cache keyed by the report, its parameters and
+the data version, a counter that's bumped whenever new data is written.
+Asking for the same report again costs one query for the version until
+something new comes in, however often it's polled.
+
+    reports = Reports(engine)
+    reports.top_ips(since=date(2014, 6, 1), limit=10)
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import func, distinct
+from sqlalchemy.orm import sessionmaker
+
+from scrutiny.models import IPAddr, SubnetDetails, DataVersion, DailyIPCount, \
+    DailyUserCount, DailySubnetCount
+from scrutiny.settings import REPORT_CACHE_SIZE
+
+REPORTS = ('top-ips', 'top-users', 'countries', 'ban-ratio', 'subnets')
+
+
+def bump_data_version(session):
+
+    """
+    Marks the data as changed, call after committing anything that could
+    change a report.
+    """
+
+    updated = session.query(DataVersion).filter(DataVersion.id==1). \
+        update({DataVersion.version: DataVersion.version + 1,
+                DataVersion.updated: datetime.now()}, synchronize_session=False)
+    if not updated:
+        session.add(DataVersion(id=1, version=1, updated=datetime.now()))
+    session.commit()
+
+
+def data_version(session):
+    # With when it was bumped, in case the database was recreated and the
+    # count started again
+    version = session.query(DataVersion.version, DataVersion.updated). \
+        filter(DataVersion.id==1).first()
+    return tuple(version) if version else (0, None)
+
+
+class LRUCache():
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class Reports():
+
+    """
+    Each report returns a list of dicts, ready to be turned into JSON.
+    since and until are dates, since is included and until isn't, either
+    can be left out.
+    """
+
+    def __init__(self, engine, cache_size=REPORT_CACHE_SIZE):
+        # A session of our own, ended after every report so we don't sit
+        # in a transaction that can't see anything newer
+        self.session = sessionmaker(bind=engine)()
+        self.cache = LRUCache(cache_size)
+
+    def close(self):
+        self.session.close()
+
+    def data_version(self):
+        return data_version(self.session)
+
+    def cached(self, name, query, *params):
+        try:
+            key = (name, params, self.data_version())
+            try:
+                return self.cache.get(key)
+            except KeyError:
+                pass
+            result = query(*params)
+            self.cache.put(key, result)
+            return result
+        finally:
+            self.session.rollback()
+
+    def in_range(self, query, day, since, until):
+        if since is not None:
+            query = query.filter(day >= since)
+        if until is not None:
+            query = query.filter(day < until)
+        return query
+
+    def top_ips(self, since=None, until=None, limit=10):
+        return self.cached('top-ips', self._top_ips, since, until, limit)
+
+    def _top_ips(self, since, until, limit):
+        attempts = func.sum(DailyIPCount.attempts)
+        query = self.session.query(IPAddr.ip_addr, IPAddr.country, attempts,
+                                   func.sum(DailyIPCount.bans)). \
+            join(DailyIPCount, DailyIPCount.ipaddr==IPAddr.id)
+        query = self.in_range(query, DailyIPCount.day, since, until)
+        query = query.group_by(IPAddr.ip_addr, IPAddr.country). \
+            order_by(attempts.desc(), IPAddr.ip_addr).limit(limit)
+        return [{'ip_addr': ip_addr, 'country': country, 'attempts': int(attempts or 0),
+                 'bans': int(bans or 0)}
+                for ip_addr, country, attempts, bans in query]
+
+    def top_users(self, since=None, until=None, limit=10):
+        return self.cached('top-users', self._top_users, since, until, limit)
+
+    def _top_users(self, since, until, limit):
+        attempts = func.sum(DailyUserCount.attempts)
+        query = self.session.query(DailyUserCount.user, attempts)
+        query = self.in_range(query, DailyUserCount.day, since, until)
+        query = query.group_by(DailyUserCount.user). \
+            order_by(attempts.desc(), DailyUserCount.user).limit(limit)
+        return [{'user': user, 'attempts': int(attempts)} for user, attempts in query]
+
+    def countries(self, since=None, until=None):
+        return self.cached('countries', self._countries, since, until)
+
+    def _countries(self, since, until):
+        attempts = func.sum(DailyIPCount.attempts)
+        query = self.session.query(IPAddr.country, attempts, func.sum(DailyIPCount.bans),
+                                   func.count(distinct(IPAddr.id))). \
+            join(DailyIPCount, DailyIPCount.ipaddr==IPAddr.id)
+        query = self.in_range(query, DailyIPCount.day, since, until)
+        query = query.group_by(IPAddr.country).order_by(attempts.desc(), IPAddr.country)
+        return [{'country': country, 'attempts': int(attempts or 0), 'bans': int(bans or 0),
+                 'addresses': addresses}
+                for country, attempts, bans, addresses in query]
+
+    def ban_ratio(self, since=None, until=None):
+        return self.cached('ban-ratio', self._ban_ratio, since, until)
+
+    def _ban_ratio(self, since, until):
+        attempts = func.sum(DailyIPCount.attempts)
+        bans = func.sum(DailyIPCount.bans)
+        query = self.session.query(DailyIPCount.ipaddr, attempts, bans)
+        query = self.in_range(query, DailyIPCount.day, since, until)
+        attackers = 0
+        banned = 0
+        total_attempts = 0
+        total_bans = 0
+        for ipaddr, ip_attempts, ip_bans in query.group_by(DailyIPCount.ipaddr):
+            if ip_attempts:
+                attackers += 1
+                if ip_bans:
+                    banned += 1
+            total_attempts += ip_attempts or 0
+            total_bans += ip_bans or 0
+        return [{'attempts': int(total_attempts), 'bans': int(total_bans),
+                 'attackers': attackers, 'banned_attackers': banned,
+                 'ratio': banned / attackers if attackers else 0.0}]
+
+    def subnets(self, since=None, until=None):
+        return self.cached('subnets', self._subnets, since, until)
+
+    def _subnets(self, since, until):
+        attempts = func.sum(DailySubnetCount.attempts)
+        query = self.session.query(SubnetDetails, attempts, func.sum(DailySubnetCount.bans)). \
+            join(DailySubnetCount, DailySubnetCount.subnet_id==SubnetDetails.id)
+        query = self.in_range(query, DailySubnetCount.day, since, until)
+        query = query.group_by(SubnetDetails.id).order_by(attempts.desc(), SubnetDetails.id)
+        subnets = query.all()
+
+        members = {}
+        ids = [subnet.id for subnet, subnet_attempts, subnet_bans in subnets]
+        if ids:
+            for subnet_id, ip_addr in self.session.query(IPAddr.subnet_id, IPAddr.ip_addr). \
+                    filter(IPAddr.subnet_id.in_(ids)).order_by(IPAddr.ip_packed):
+                members.setdefault(subnet_id, []).append(ip_addr)
+
+        return [{'subnet': subnet.subnet_id + subnet.cidr, 'netmask': subnet.netmask,
+                 'attempts': int(subnet_attempts or 0), 'bans': int(subnet_bans or 0),
+                 'members': members.get(subnet.id, [])}
+                for subnet, subnet_attempts, subnet_bans in subnets]
+
+    def report(self, name, since=None, until=None, limit=10):
+
+        """
+        Runs a report by its name in REPORTS, as given on the command line.
+        """
+
+        if name == 'top-ips':
+            return self.top_ips(since, until, limit)
+        elif name == 'top-users':
+            return self.top_users(since, until, limit)
+        elif name == 'countries':
+            return self.countries(since, until)
+        elif name == 'ban-ratio':
+            return self.ban_ratio(since, until)
+        elif name == 'subnets':
+            return self.subnets(since, until)
+        raise ValueError('Unknown report {}'.format(name))
@@ -0,0 +1,137 @@
+"""
+Keeps the daily summary tables (DailyIPCount, DailyUserCount and
+DailySubnetCount) in step with the raw BreakinAttempts and BannedIPs rows.
+
+Rather than adding each batch's numbers on to what's there, the days and
+keys a batch touched are counted up again from the raw rows. That only
+means counting the rows for a day or two and a few hundred addresses, and
+a batch that turns out to be all duplicates, or gets inserted twice,
+leaves the totals right.
+
+Every change to them bumps the data version, so cached reports (see
+scrutiny/reports.py) get worked out again.
+"""
+
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func, Date
+
+from scrutiny.models import IPAddr, BreakinAttempts, BannedIPs, DailyIPCount, \
+    DailyUserCount, DailySubnetCount, NO_USER
+from scrutiny.reports import bump_data_version
+from scrutiny.utils import chunks
+from scrutiny.settings import DB_CHUNK_SIZE
+
+# For each summary table, the column its rows are keyed on (alongside the
+# day) and where each of its counts comes from
+IP_ROLLUP = (DailyIPCount, DailyIPCount.ipaddr,
+             (('attempts', BreakinAttempts, BreakinAttempts.ipaddr),
+              ('bans', BannedIPs, BannedIPs.ipaddr)))
+USER_ROLLUP = (DailyUserCount, DailyUserCount.user,
+               (('attempts', BreakinAttempts, BreakinAttempts.user),))
+# Subnets come through the IPAddr an attempt or ban is for
+SUBNET_ROLLUP = (DailySubnetCount, DailySubnetCount.subnet_id,
+                 (('attempts', BreakinAttempts, IPAddr.subnet_id),
+                  ('bans', BannedIPs, IPAddr.subnet_id)))
+
+
+def day_of(column):
+    return func.date(column, type_=Date)
+
+
+def day_bounds(dates):
+
+    """
+    The start of the first day and the end of the last day that dates
+    fall on.
+    """
+
+    days = set(date.date() for date in dates)
+    return datetime.combine(min(days), time()), \
+        datetime.combine(max(days) + timedelta(days=1), time())
+
+
+def recount(session, rollup, start=None, end=None, keys=None):
+
+    """
+    Counts up the rows of rollup (one of the *_ROLLUP tuples above) between
+    start and end, for keys, from the raw rows and replaces what was there.
+    Without start and end it's every day, without keys every key.
+    """
+
+    model, key, sources = rollup
+    fields = [field for field, source, source_key in sources]
+    totals = {}
+
+    for field, source, source_key in sources:
+        day = day_of(source.date)
+        query = session.query(day, source_key, func.count(source.id))
+        if source_key.class_ is not source:
+            query = query.join(IPAddr, source.ipaddr==IPAddr.id)
+        if start is not None:
+            query = query.filter(source.date >= start).filter(source.date < end)
+        if keys is not None:
+            query = query.filter(source_key.in_(keys))
+        else:
+            query = query.filter(source_key!=None)
+            if source_key is BreakinAttempts.user:
+                # Attempts without a username don't count towards anyone's
+                query = query.filter(source_key!=NO_USER)
+        for row_day, row_key, count in query.group_by(day, source_key):
+            counts = totals.setdefault((row_day, row_key), dict.fromkeys(fields, 0))
+            counts[field] = count
+
+    delete = model.__table__.delete()
+    if start is not None:
+        delete = delete.where(model.day >= start.date()).where(model.day < end.date())
+    if keys is not None:
+        delete = delete.where(key.in_(keys))
+    session.execute(delete)
+
+    rows = []
+    for (row_day, row_key), counts in totals.items():
+        row = {'day': row_day, key.name: row_key}
+        row.update(counts)
+        rows.append(row)
+    if rows:
+        session.execute(model.__table__.insert(), rows)
+
+
+def refresh_rollups(session, rows, chunk_size=DB_CHUNK_SIZE):
+
+    """
+    Brings the summary tables up to date for the attempts or bans in rows,
+    as passed to insert_into_db's inserts (so dicts with date and ipaddr,
+    and user for attempts).
+    """
+
+    if not rows:
+        return
+
+    start, end = day_bounds(row['date'] for row in rows)
+    ipaddrs = sorted(set(row['ipaddr'] for row in rows))
+    users = sorted(set(row['user'] for row in rows if row.get('user')))
+
+    for chunk in chunks(ipaddrs, chunk_size):
+        recount(session, IP_ROLLUP, start, end, chunk)
+        subnets = [subnet_id for subnet_id, in session.query(IPAddr.subnet_id).
+                   filter(IPAddr.id.in_(chunk)).filter(IPAddr.subnet_id!=None).distinct()]
+        if subnets:
+            recount(session, SUBNET_ROLLUP, start, end, subnets)
+    for chunk in chunks(users, chunk_size):
+        recount(session, USER_ROLLUP, start, end, chunk)
+
+    session.commit()
+    bump_data_version(session)
+
+
+def rebuild_rollups(session, rollups=(IP_ROLLUP, USER_ROLLUP, SUBNET_ROLLUP)):
+
+    """
+    Recomputes the summary tables from scratch.
+    """
+
+    for rollup in rollups:
+        recount(session, rollup)
+    session.commit()
+    bump_data_version(session)
@@ -0,0 +1,99 @@
+"""
+Loads the rule files (rules.ini and any others in RULES_FILES) that say
+which log files Scrutiny reads and what it looks for in them. See rules.ini
+for the format.
+
+Each source's rules are compiled into a single LineMatcher, which picks the
+rules to try for a line by the keywords in it, so adding rules for other
+services costs the lines that don't match next to nothing.
+
+    LOG_SOURCES['auth'].matcher.match(line)
+"""
+
+import re
+import configparser
+from collections import OrderedDict
+
+from scrutiny.matchers import LineMatcher
+from scrutiny.settings import RULES_FILES, HOST_SERVER_NAME, SYSLOG_DATE, YMD_DATE, \
+    IP_ADDRESS
+
+TIMESTAMPS = ('syslog', 'ymd')
+EVENTS = ('attempt', 'ban')
+REQUIRED_GROUPS = ('log_date', 'ip_add')
+
+
+class LogSource():
+
+    def __init__(self, name, files, timestamp, event, rules):
+        # rules is a list of (name, keyword, pattern) tuples
+        self.name = name
+        self.files = tuple(files)
+        self.timestamp = timestamp
+        self.attempts = event == 'attempt'
+        self.rules = list(rules)
+        self.matcher = LineMatcher([(keyword, pattern) for rule_name, keyword, pattern in rules])
+
+    def __repr__(self):
+        return '<LogSource: {} ({} rules)>'.format(self.name, len(self.rules))
+
+
+def load_sources(paths=RULES_FILES, host=HOST_SERVER_NAME):
+
+    """
+    Reads the rule files in paths, later ones overriding earlier ones, and
+    returns an OrderedDict of source name to LogSource. Raises ValueError if
+    a source or rule doesn't make sense. With host None %(host)s matches
+    any host name, for logs collected from other hosts.
+    """
+
+    config = configparser.ConfigParser(defaults={
+        'host': r'\S+' if host is None else re.escape(host),
+        'syslog_date': SYSLOG_DATE,
+        'ymd_date': YMD_DATE,
+        'ip': IP_ADDRESS,
+    })
+    config.read(paths, encoding='utf-8')
+
+    sources = OrderedDict()
+    rules = OrderedDict()
+    for section in config.sections():
+        kind, _, name = section.partition(':')
+        options = config[section]
+        if kind == 'source':
+            if not options.get('files'):
+                raise ValueError('[{}] needs the names of its files'.format(section))
+            if options.get('timestamp') not in TIMESTAMPS:
+                raise ValueError('[{}] timestamp must be one of {}'.format(section, ', '.join(TIMESTAMPS)))
+            if options.get('event') not in EVENTS:
+                raise ValueError('[{}] event must be one of {}'.format(section, ', '.join(EVENTS)))
+            sources[name] = options
+            rules[name] = []
+        elif kind != 'rule':
+            raise ValueError('[{}] should be [source:NAME] or [rule:NAME]'.format(section))
+
+    for section in config.sections():
+        kind, _, name = section.partition(':')
+        if kind != 'rule':
+            continue
+        options = config[section]
+        source = options.get('source')
+        if source not in sources:
+            raise ValueError('[{}] has no [source:{}]'.format(section, source))
+        if not options.get('keyword') or not options.get('pattern'):
+            raise ValueError('[{}] needs a keyword and a pattern'.format(section))
+        try:
+            regex = re.compile(options['pattern'])
+        except re.error as e:
+            raise ValueError('[{}] pattern is invalid: {}'.format(section, e))
+        for group in REQUIRED_GROUPS:
+            if group not in regex.groupindex:
+                raise ValueError('[{}] pattern has no {} group'.format(section, group))
+        rules[source].append((name, options['keyword'], options['pattern']))
+
+    return OrderedDict((name, LogSource(name, options['files'].split(), options['timestamp'],
+                                        options['event'], rules[name]))
+                       for name, options in sources.items())
+
+
+LOG_SOURCES = load_sources()
@@ -1,34 +1,45 @@
-import re
-import gzip
-import os
 import time
-import json
-import codecs
-import urllib.request, urllib.parse  # urllib.error
-import pytz
 import logging
 import sys
-import platform
-from socket import gethostname
 from datetime import timedelta, datetime
-from sqlalchemy import create_engine, func
+from functools import partial
+from sqlalchemy import create_engine, func, select, inspect, bindparam
 from sqlalchemy.orm import sessionmaker
 from math import log
 
 from scrutiny.models import IPAddr, BannedIPs, BreakinAttempts, Base, \
-    SubnetDetails
-from scrutiny.settings import API_URL, API_KEY, LOG_DIR, SEARCH_STRING, \
-    FAIL2BAN_SEARCH_STRING, ROOT_NOT_ALLOWED_SEARCH_STRING, DATABASE_URI, \
-    DEBUG
-from scrutiny.tests import populate_test_data, populate_test_tz_data
+    SubnetDetails, DailyIPCount, NO_USER
+from scrutiny.handlers.file import LogFileReader
+from scrutiny.utils import chunks, os_release, system_timezone
+from scrutiny.netutils import group_common_subnets, pack_ip
+from scrutiny.settings import LOG_DIR, DATABASE_URI, DEBUG, HOST_SERVER_NAME, PARSE_WORKERS, \
+    INCREMENTAL, DB_CHUNK_SIZE, GEOIP_DATABASE, METRICS, METRICS_JSON_FILE, \
+    METRICS_PROMETHEUS_FILE, DEDUP_FILTER, DEDUP_FILTER_FILE
 
 
 class Scrutiny():
 
     def __init__(self):
-        self.engine = self.get_engine()
+        # Everything but the models, the log reader and what they need is
+        # imported by the methods that use it, a cron run that only parses
+        # the logs doesn't pay for the migrations, reports and so on
+        from scrutiny.engine import configure_engine
+        from scrutiny.metrics import Metrics
+        self.engine = configure_engine(self.get_engine())
         self.base = Base
         self.session = self.get_session(Base, self.engine)
+        self.log_reader = LogFileReader()
+        self._location_provider = None
+        self.metrics = Metrics(METRICS)
+        self.unique_indexes = None
+        self.dedup_filter = None
+        if DEDUP_FILTER:
+            from scrutiny.dedup import default_filter_path
+            self.dedup_filter_file = DEDUP_FILTER_FILE or default_filter_path(self.engine)
+        else:
+            self.dedup_filter_file = None
+        self.metrics_json_file = METRICS_JSON_FILE
+        self.metrics_prometheus_file = METRICS_PROMETHEUS_FILE
         self.get_distro()
 
         self.logger = logging.getLogger('scrutiny')
@@ -43,36 +54,61 @@ class Scrutiny():
             self.logger.setLevel(logging.INFO)
         self.logger.addHandler(stream_handler)
 
+        self.check_schema()
+
 
     def get_engine(self):
-        return create_engine(DATABASE_URI)
+        from scrutiny.engine import engine_options
+        return create_engine(DATABASE_URI, **engine_options(DATABASE_URI))
 
 
     def get_session(self, base, engine):
         Session = sessionmaker()
         Session.configure(bind=engine)
-        base.metadata.create_all(engine)
 
         return Session()
 
 
+    def check_schema(self):
+
+        """
+        Sets up a new database, or one that's missing tables, by way of
+        migrate. That's one query for the names of the tables, rather than
+        create_all looking up each table in turn every time Scrutiny starts.
+        """
+
+        existing = set(inspect(self.engine).get_table_names())
+        if not set(self.base.metadata.tables) <= existing:
+            self.migrate()
+
+
     def get_distro(self):
         # Maybe instead of this, try getting what capabilities we have
         # i.e., can we use journalctl? If not fall back to trying to find
         # the log file
-        self.distro = None
-        self.distro_version = None
-
-        distro = platform.linux_distribution()
-        if distro and len(distro) >= 2:
-            self.distro = distro[0]
-            self.distro_version = distro[1]
+        release = os_release()
+        self.distro = release.get('NAME')
+        self.distro_version = release.get('VERSION_ID')
 
 
     def create_db(self):
         self.base.metadata.create_all(self.engine)
 
 
+    def migrate(self):
+
+        """
+        Brings an existing database up to date with the models, see
+        scrutiny/migrations.py.
+        """
+
+        from scrutiny.migrations import migrate
+        self.logger.info('Migrating database...')
+        migrate(self.engine, self.session)
+        self.unique_indexes = None
+        self.logger.info('Finished!')
+
+
     def delete_db(self):
         self.base.metadata.drop_all(self.engine)
 
@@ -90,66 +126,72 @@ class Scrutiny():
 
         #Get zone info (aka just set the system time to UTC already)
         # need to check if the logs are in utc or not... somehow...
-        #a = os.popen("cat /etc/sysconfig/clock | grep ZONE")  # RHEL/CentOS 6.5?
-        if self.distro == 'Fedora':
-            a = os.popen('timedatectl | grep "Time zone')
-            # Time zone: Australia/Brisbane (AEST, +1000)
-        elif self.distro == 'Debian':
-            a = os.popen("cat /etc/timezone")   # Debian
-        cat_res = a.read()
-        if cat_res:
-            #cat_res = cat_res.replace('ZONE="', '')  # Debian doesn't need this
-            cat_res = cat_res.replace('"\n', '')
+        zone_name = system_timezone()
+        sys_tz = None
+        if zone_name:
+            # Only needed here, and it takes a while to import
+            import pytz
             try:
-                sys_tz = pytz.timezone(cat_res)
+                sys_tz = pytz.timezone(zone_name)
             except pytz.UnknownTimeZoneError:
                 # Couldn't get the time zone properly
-                sys_tz = None
-        else:
-            sys_tz = None
+                pass
 
         return displayed_time, time_offset, sys_tz
 
 
+    def get_location_provider(self):
+        if GEOIP_DATABASE:
+            from scrutiny.geoip import LocalLocationProvider
+            return LocalLocationProvider(GEOIP_DATABASE)
+        elif DEBUG:
+            # Don't hit the API while testing
+            return None
+        else:
+            from scrutiny.geoip import RemoteLocationProvider
+            return RemoteLocationProvider()
+
+
+    @property
+    def location_provider(self):
+        # Only made once there's something to look up, scrutiny/geoip.py
+        # pulls in urllib and friends
+        if self._location_provider is None:
+            self._location_provider = self.get_location_provider()
+        return self._location_provider
+
+
     def check_ip_location(self, ip):
 
-        if DEBUG:
+        if self.location_provider is None:
             # Do some stuff for testing here
             return_dict = {}
             return return_dict
         else:
-            params = {'format': 'json', 'key': API_KEY, 'ip': ip, 'timezone': 'false'}
-            self.logger.debug('Checking IP - {}'.format(ip))
-            url_params = urllib.parse.urlencode(params)
-            url = API_URL + '?' + url_params
-            url_obj = urllib.request.urlopen(url)
-            response = url_obj.read()
-            try:
-                response = response.decode("utf-8") # response is bytes, parse to string
-            except AttributeError:
-                pass
-            url_obj.close()
-            response_dict = json.loads(response)
+            return self.location_provider.lookup(ip)
 
-            return_dict = {}
 
-            if 'cityName' in response_dict and response_dict['cityName'] != '-':
-                return_dict['region'] = response_dict['cityName'] + ', ' + response_dict['regionName']
-            elif 'regionName' in response_dict and response_dict['regionName'] != '-':
-                return_dict['region'] = response_dict['regionName']
-            else:
-                return_dict['region'] = '-'
+    def resolve_locations(self, ips):
 
-            if 'countryName' in response_dict:
-                return_dict['country'] = response_dict['countryName']
-            else:
-                return_dict['country'] = '-'
+        """
+        Returns a dict of IP address to location for all of ips. Lookups
+        against the API are made concurrently (within its rate limit) and
+        cached, local lookups are quick enough to just do one by one.
+        """
 
-            self.logger.debug('Location - {} {}'.format(return_dict['region'], return_dict['country']))
+        if not ips or self.location_provider is None:
+            return dict((ip, self.check_ip_location(ip)) for ip in ips)
 
-            time.sleep(2)
+        from scrutiny.geoip import RemoteLocationProvider, ConcurrentResolver, LocationCache
+        if isinstance(self.location_provider, RemoteLocationProvider):
+            resolver = ConcurrentResolver(self.location_provider,
+                                          LocationCache(self.session))
+            locations = resolver.resolve(ips)
+            self.metrics.count('geoip_api_calls', resolver.api_calls)
+            self.metrics.count('geoip_cache_hits', resolver.cache_hits)
+            return locations
 
-        return return_dict
+        return dict((ip, self.check_ip_location(ip)) for ip in ips)
 
 
     def create_new_ipaddr(self, ip):
@@ -166,66 +208,295 @@ class Scrutiny():
         return ip_addr
 
 
-    def insert_into_db(self, ips, breakin_attempts, bans):
+    def get_ip_ids(self, ips, chunk_size=DB_CHUNK_SIZE):
+
+        """
+        Returns a dict of IP address to IPAddr id for those of ips that are
+        already in the database, looked up chunk_size at a time.
+        """
 
         ip_items = {}
+        for chunk in chunks(list(ips), chunk_size):
+            query = self.session.query(IPAddr.ip_addr, IPAddr.id). \
+                filter(IPAddr.ip_addr.in_(chunk))
+            ip_items.update(query)
 
-        #return_dict = self.check_ip_location(i)
-        # {ip: {region: '', country: ''}}
+        return ip_items
 
-        for ip in ips:
-            # Query to see if already exists first
-            ip_addr = self.session.query(IPAddr).filter(IPAddr.ip_addr==ip)
-            if ip_addr.count() == 0:
-                self.create_new_ipaddr(ip)
-            else:
-                ip_addr = ip_addr.first()
-            ip_items[ip] = ip_addr.id
-
-        for attempt_date, attempt_details in breakin_attempts.items():
-            # e.g. attempt_details = ('127.0.0.1', 'root')
-
-            breakin = self.session.query(BreakinAttempts).filter(BreakinAttempts.date==attempt_date). \
-                filter(BreakinAttempts.user==attempt_details[1])
-            # If it already exists in the db don't add it again
-            if breakin.count() == 0:
-                new_attempt = BreakinAttempts(date=attempt_date,
-                    user=attempt_details[1])
-                new_attempt.ipaddr = ip_items[attempt_details[0]]
-                self.session.add(new_attempt)
+
+    def get_unlocated_ips(self, ips, chunk_size=DB_CHUNK_SIZE):
+
+        """
+        Returns those of ips that are in the database without a location,
+        because looking them up failed. Not worth asking with nothing to
+        look them up with.
+        """
+
+        if self.location_provider is None:
+            return []
+        unlocated = []
+        for chunk in chunks(list(ips), chunk_size):
+            query = self.session.query(IPAddr.ip_addr). \
+                filter(IPAddr.ip_addr.in_(chunk)).filter(IPAddr.country==None)
+            unlocated += [ip for ip, in query]
+        return unlocated
+
+
+    def update_locations(self, locations):
+
+        """
+        Fills in the locations of addresses already in the database,
+        locations being a dict of IP address to location.
+        """
+
+        ipaddr = IPAddr.__table__
+        update = ipaddr.update().where(ipaddr.c.ip_addr==bindparam('_ip_addr')). \
+            values(region=bindparam('_region'), country=bindparam('_country'))
+        rows = [{'_ip_addr': ip, '_region': location.get('region'),
+                 '_country': location.get('country')}
+                for ip, location in locations.items() if location.get('country')]
+        if rows:
+            from scrutiny.reports import bump_data_version, data_version
+            dedup_filter = self.get_dedup_filter()
+            self.session.execute(update, rows)
+            self.session.commit()
+            # The cached reports of where attacks come from are out of date
+            bump_data_version(self.session)
+            if dedup_filter is not None:
+                # None of the events it holds have changed, it's still good
+                # for the new version
+                dedup_filter.version = data_version(self.session)
                 self.session.commit()
+                dedup_filter.save(self.dedup_filter_file)
 
-        for banned_date, banned_ip in bans.items():
-            # In some instances it references a ban that doesn't have the IP
-            # in ip_items?
-            try:
-                ban = self.session.query(BannedIPs).filter(BannedIPs.date==banned_date). \
-                    filter(BannedIPs.ipaddr.ip_addr==banned_ip)
-            # AttributeError: Neither 'InstrumentedAttribute' object nor 'Comparator' object associated with BannedIPs.ipaddr has an attribute 'ip_addr'
-            # Caused by the ban existing but not having an IPAddr associated with it I think
-            # Ugly work around, maybe change the query
-            # ban = self.session.query(BannedIPs).filter(BannedIPs.date==banned_date). \
-            # join(IPAddr)
-            except AttributeError:
-                # Make a new type of list inheriting from the builtin list
-                # this makes the below check (ban.count() == 0) work
-                # This is pretty silly but sometimes doing things the easy way
-                # is for chumps
-                class nList(list):
-                    def count(self):
-                        return len(self)
-                ban = nList()
-            # If it already exists in the db don't add it again
-            if ban.count() == 0:
-                new_ban = BannedIPs(date=banned_date)
-                if banned_ip in ip_items:
-                    new_ban.ipaddr = ip_items[banned_ip]
+
+    def has_unique_indexes(self):
+
+        """
+        True if the database has the unique indexes on BreakinAttempts and
+        BannedIPs, which a database from before they were added won't have
+        until it's been through --migrate. Only checked the once.
+        """
+
+        if self.unique_indexes is None:
+            from scrutiny.migrations import missing_indexes
+            missing = missing_indexes(self.engine)
+            self.unique_indexes = not any(index.unique for index in missing
+                                          if index.table.name in ('breakinattempts', 'bannedips'))
+            if not self.unique_indexes:
+                self.logger.warning('Database is missing its unique indexes, run '
+                                    'scrutiny.py --migrate to add them')
+        return self.unique_indexes
+
+
+    def get_dedup_filter(self):
+
+        """
+        The Bloom filter of the events already in the database (see
+        scrutiny/dedup.py), loaded from its file or built from the database
+        if there isn't one or it's out of date. None if it's turned off or
+        there's nowhere to keep it.
+        """
+
+        if self.dedup_filter_file is None:
+            return None
+        from scrutiny.dedup import DedupFilter
+        from scrutiny.reports import data_version
+        version = data_version(self.session)
+        if self.dedup_filter is not None and self.dedup_filter.version == version \
+                and not self.dedup_filter.full:
+            return self.dedup_filter
+
+        self.dedup_filter = None
+        try:
+            dedup_filter = DedupFilter.load(self.dedup_filter_file)
+            if dedup_filter.version == version and not dedup_filter.full:
+                self.dedup_filter = dedup_filter
+            else:
+                self.logger.info('Dedup filter is out of date, rebuilding it...')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            self.logger.warning('Rebuilding the dedup filter: {}'.format(e))
+        if self.dedup_filter is None:
+            self.rebuild_dedup_filter()
+        return self.dedup_filter
+
+
+    def rebuild_dedup_filter(self):
+
+        """
+        Builds the dedup filter afresh from what's in the database, see
+        scrutiny/dedup.py.
+        """
+
+        if self.dedup_filter_file is None:
+            self.logger.warning('The dedup filter is off, or there is nowhere to keep it. '
+                                'See DEDUP_FILTER and DEDUP_FILTER_FILE in settings.py')
+            return
+        from scrutiny.dedup import DedupFilter
+        self.logger.info('Building dedup filter...')
+        self.dedup_filter = DedupFilter.build(self.session)
+        self.dedup_filter.save(self.dedup_filter_file)
+
+
+    def insert_new_rows(self, table, rows, dedup_filter=None):
+
+        """
+        Inserts those of rows that aren't in table already, going by the
+        table's unique index, and returns how many that was. With the index
+        in place the DB turns the duplicates away itself, otherwise the
+        existing rows are looked up first. With a dedup_filter only the rows
+        it might have seen are looked up, and what's inserted is added to it.
+        """
+
+        if not rows:
+            return 0
+
+        from scrutiny.dedup import unique_key, event_key
+        key = unique_key(table)
+        if dedup_filter is not None:
+            keys = [event_key(table, [row[column.name] for column in key]) for row in rows]
+            maybe = [row for row, row_key in zip(rows, keys) if row_key in dedup_filter]
+            self.metrics.count('dedup_lookups', len(maybe))
+            if maybe:
+                existing = self.existing_rows(table, key, maybe)
+                found = [tuple(row[column.name] for column in key) in existing for row in rows]
+                rows = [row for row, duplicate in zip(rows, found) if not duplicate]
+                keys = [row_key for row_key, duplicate in zip(keys, found) if not duplicate]
+            # Definitely new, unless something wrote to the DB without
+            # updating the filter, the unique index still has the last word
+            if rows:
+                if self.has_unique_indexes():
+                    inserted = self.session.execute(self.insert_ignore(table), rows).rowcount
                 else:
-                    # Check ip location and make new IPAddr item here
-                    ip_addr = self.create_new_ipaddr(banned_ip)
-                    new_ban.ipaddr = ip_addr.id
-                self.session.add(new_ban)
+                    inserted = self.session.execute(table.insert(), rows).rowcount
+                for row_key in keys:
+                    dedup_filter.add(row_key)
+            else:
+                inserted = 0
+        elif self.has_unique_indexes():
+            inserted = self.session.execute(self.insert_ignore(table), rows).rowcount
+        else:
+            existing = self.existing_rows(table, key, rows)
+            rows = [row for row in rows
+                    if tuple(row[column.name] for column in key) not in existing]
+            if rows:
+                self.session.execute(table.insert(), rows)
+            inserted = len(rows)
+        self.session.commit()
+
+        return inserted
+
+
+    def insert_ignore(self, table):
+        return table.insert().prefix_with('OR IGNORE', dialect='sqlite'). \
+            prefix_with('IGNORE', dialect='mysql')
+
+
+    def existing_rows(self, table, key, rows):
+
+        """
+        The keys of the rows in table from the dates rows cover, which
+        includes those of rows that are already there. The dates in a chunk
+        are in the order they were logged so it's a short range, and a
+        range is a lot cheaper to compile and look up than a long IN.
+        """
+
+        dates = [row['date'] for row in rows]
+        query = select(list(key)).where(table.c.date.between(min(dates), max(dates)))
+        return set(tuple(found) for found in self.session.execute(query))
+
+
+    def insert_into_db(self, ips, breakin_attempts, bans, chunk_size=DB_CHUNK_SIZE,
+                       host=HOST_SERVER_NAME):
+
+        """
+        Inserts the breakin attempts and bans that aren't already in the
+        database, along with any IP addresses we haven't seen before. Rather
+        than checking each row one by one they're inserted a chunk at a time
+        in a single statement, with one commit per chunk, and the ones we
+        already have are left out by insert_new_rows. They're recorded as
+        logged on host, this one unless they're from scrutiny/hosts.py.
+        """
+
+        start_time = time.time()
+        inserted = 0
+
+        with self.metrics.stage('insert'):
+            # In some instances a ban references an IP we haven't seen an
+            # attempt from, so make sure it gets an IPAddr too
+            ips = set(ips) | set(bans.values())
+            ip_items = self.get_ip_ids(ips, chunk_size)
+            new_ips = [ip for ip in ips if ip not in ip_items]
+
+            with self.metrics.stage('geoip'):
+                # Addresses whose lookup failed last time (the API was down,
+                # say) are tried again along with the new ones
+                unlocated = self.get_unlocated_ips(ip_items, chunk_size)
+                locations = self.resolve_locations(new_ips + unlocated)
+                self.update_locations(dict((ip, locations[ip]) for ip in unlocated
+                                           if ip in locations))
+            for chunk in chunks(new_ips, chunk_size):
+                rows = []
+                for ip in chunk:
+                    location = locations.get(ip, {})
+                    rows.append({'ip_addr': ip,
+                                 'ip_packed': pack_ip(ip),
+                                 'region': location.get('region'),
+                                 'country': location.get('country')})
+                self.session.execute(IPAddr.__table__.insert(), rows)
+                self.session.commit()
+                inserted += len(rows)
+            ip_items.update(self.get_ip_ids(new_ips, chunk_size))
+
+            # Rows from chunks that added something, for the summary tables
+            new_rows = []
+            dedup_filter = self.get_dedup_filter()
+
+            # e.g. breakin_attempts = {(datetime, 0): ('127.0.0.1', 'root')}
+            for chunk in chunks(list(breakin_attempts.items()), chunk_size):
+                rows = [{'date': attempt_date,
+                         'seq': seq,
+                         'host': host,
+                         'user': attempt_details[1] or NO_USER,
+                         'ipaddr': ip_items[attempt_details[0]]}
+                        for (attempt_date, seq), attempt_details in chunk]
+                added = self.insert_new_rows(BreakinAttempts.__table__, rows, dedup_filter)
+                self.metrics.count('events_deduped', len(rows) - added)
+                inserted += added
+                if added:
+                    new_rows += rows
+
+            # e.g. bans = {(datetime, 0): '127.0.0.1'}
+            for chunk in chunks(list(bans.items()), chunk_size):
+                rows = [{'date': banned_date, 'seq': seq, 'host': host,
+                         'ipaddr': ip_items[banned_ip]}
+                        for (banned_date, seq), banned_ip in chunk]
+                added = self.insert_new_rows(BannedIPs.__table__, rows, dedup_filter)
+                self.metrics.count('events_deduped', len(rows) - added)
+                inserted += added
+                if added:
+                    new_rows += rows
+
+            with self.metrics.stage('rollups'):
+                from scrutiny.rollups import refresh_rollups
+                refresh_rollups(self.session, new_rows)
+
+            if dedup_filter is not None and new_rows:
+                # Saved along with the data version the new rows brought
+                # about, so it's known to match the DB
+                from scrutiny.reports import data_version
+                dedup_filter.version = data_version(self.session)
                 self.session.commit()
+                dedup_filter.save(self.dedup_filter_file)
+
+        self.metrics.count('rows_inserted', inserted)
+        elapsed = time.time() - start_time
+        self.logger.info('Inserted {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+            inserted, elapsed, inserted / elapsed if elapsed else 0))
+
+        return inserted
 
 
     def convert_ip_string_to_binary(self, ip_addr):
@@ -335,6 +606,7 @@ class Scrutiny():
             subnet.cidr = cidr
             subnet.netmask = netmask
             subnet.number_hosts = no_hosts
+            subnet.set_bounds()
             self.session.add(subnet)
             self.session.commit()
         else:
@@ -343,58 +615,68 @@ class Scrutiny():
         return subnet
 
 
+    def set_subnet(self, ip_list, subnet, chunk_size=DB_CHUNK_SIZE):
+        for chunk in chunks(ip_list, chunk_size):
+            self.session.query(IPAddr).filter(IPAddr.ip_addr.in_(chunk)). \
+                update({IPAddr.subnet_id: subnet.id}, synchronize_session=False)
+
+
     def calculate_common_subnets(self):
         self.logger.debug('Begin calculating subnets...')
-        common_ips = self.session.query(IPAddr).join(BreakinAttempts). \
-            group_by(IPAddr.ip_addr).having(func.count(IPAddr.breakins)>=3).all()
-
-        subnet24 = {}
-        subnet16 = {}
-
-        for index, ip in enumerate(common_ips):
-            # Compare the item against all the other items in the list
-            for index2, comparison_ip in enumerate(common_ips):
-                if index != index2:  # don't compare the same address
-                    result = self.compare_ip_strings(ip.ip_addr, comparison_ip.ip_addr)
-                    if result == 16:
-                        if self.get_first_16_bits(ip.ip_addr) not in subnet16.keys():
-                            subnet16[self.get_first_16_bits(ip.ip_addr)] = [ip.ip_addr]
-                        else:
-                            subnet16[self.get_first_16_bits(ip.ip_addr)] += [ip.ip_addr]
-                    elif result == 24:
-                        if self.get_first_24_bits(ip.ip_addr) not in subnet24.keys():
-                            subnet24[self.get_first_24_bits(ip.ip_addr)] = [ip.ip_addr]
-                        else:
-                            subnet24[self.get_first_24_bits(ip.ip_addr)] += [ip.ip_addr]
+        # Add up the daily counts rather than counting every attempt
+        common_ips = self.session.query(IPAddr.ip_addr). \
+            join(DailyIPCount, DailyIPCount.ipaddr==IPAddr.id). \
+            group_by(IPAddr.ip_addr).having(func.sum(DailyIPCount.attempts)>=3)
+
+        # Only IPv4 addresses are grouped, see group_common_subnets
+        subnet24, subnet16 = group_common_subnets(ip for ip, in common_ips)
         self.logger.debug(subnet16)
 
-        for network_prefix, ip_list in subnet24.items():
-            if len(ip_list) >= 2:
-                subnet = self.calculate_network_details(network_prefix, ip_list, twentyfour=True)
-                for ip in ip_list:
-                    ip_addr = self.session.query(IPAddr).filter(IPAddr.ip_addr==ip).first()
-                    ip_addr.subnet_id = subnet.id
-                    self.session.add(ip_addr)
-                    self.session.commit()
+        # An address in both a common /24 and /16 ends up with the /16
+        for network_prefix, ip_list in sorted(subnet24.items()):
+            subnet = self.calculate_network_details(network_prefix, ip_list, twentyfour=True)
+            self.set_subnet(ip_list, subnet)
+
+        for network_prefix, ip_list in sorted(subnet16.items()):
+            subnet = self.calculate_network_details(network_prefix, ip_list, sixteen=True)
+            self.set_subnet(ip_list, subnet)
+
+        self.session.commit()
+        # Addresses may have moved subnet, count them up again
+        from scrutiny.rollups import rebuild_rollups, SUBNET_ROLLUP
+        rebuild_rollups(self.session, [SUBNET_ROLLUP])
+        # The updates went straight to the DB, make sure any IPAddr objects
+        # we're holding on to see them
+        self.session.expire_all()
+
 
-        for network_prefix, ip_list in subnet16.items():
-            if len(ip_list) >= 2:
-                subnet = self.calculate_network_details(network_prefix, ip_list, sixteen=True)
-                for ip in ip_list:
-                    ip_addr = self.session.query(IPAddr).filter(IPAddr.ip_addr==ip).first()
-                    ip_addr.subnet_id = subnet.id
-                    self.session.add(ip_addr)
-                    self.session.commit()
+    def rebuild_rollups(self):
+
+        """
+        Recomputes the daily summary tables from the raw attempts and bans,
+        see scrutiny/rollups.py.
+        """
+
+        from scrutiny.rollups import rebuild_rollups
+        self.logger.info('Rebuilding summary tables...')
+        rebuild_rollups(self.session)
+        self.logger.info('Finished!')
 
 
-    def parse(self):
+    def parse(self, workers=PARSE_WORKERS, incremental=INCREMENTAL):
 
         self.logger.info('Scrutiny, begin scrutinising.')
         last_month = datetime.now().replace(day=1) - timedelta(days=1)
         self.logger.info('Timezone setup...')
         displayed_time, time_offset, sys_tz = self.tz_setup()
         self.logger.info('Reading logs...')
-        breakin_attempt, banned_ip = self.read_logs(LOG_DIR)
+        if incremental:
+            from scrutiny.checkpoints import CheckpointStore
+            checkpoints = CheckpointStore(self.session)
+        else:
+            checkpoints = None
+        breakin_attempt, banned_ip = self.log_reader.read_logs(LOG_DIR, workers,
+                                                               checkpoints, self.metrics)
         unique_ips = set()
         for i in breakin_attempt.values():
             unique_ips.add(i[0])
@@ -407,18 +689,148 @@ class Scrutiny():
 
         self.logger.info('Inserting results into database...')
         self.insert_into_db(unique_ips, breakin_attempt, banned_ip)
+        if checkpoints is not None:
+            # Only move the checkpoints on once the results are safely in
+            checkpoints.save()
+
+        self.report_metrics()
+        self.logger.info('Finished!')
+
+
+    def parse_hosts(self, hosts, workers=PARSE_WORKERS, incremental=INCREMENTAL):
+
+        """
+        Reads the logs of other hosts, hosts being a list of (host, log_dir)
+        tuples, see scrutiny/hosts.py.
+        """
+
+        from scrutiny.hosts import HostReader
+        self.logger.info('Reading the logs of {} hosts...'.format(len(hosts)))
+        stats = HostReader(self, hosts, workers, incremental).run()
+        self.report_metrics()
+        self.logger.info('Finished!')
+        return stats
+
+
+    def report_metrics(self):
+
+        """
+        Logs the counters and stage timings for the run so far and writes
+        them to the JSON and Prometheus files, if there are any.
+        """
+
+        if not self.metrics.enabled:
+            return
+        self.metrics.log(self.logger)
+        if self.metrics_json_file:
+            self.metrics.write_json(self.metrics_json_file)
+        if self.metrics_prometheus_file:
+            self.metrics.write_prometheus(self.metrics_prometheus_file)
+
+
+    def get_writer(self):
+
+        """
+        Something to hand batches of results to for inserting in the
+        background, see scrutiny/writer.py. Use it in a with block.
+        """
+
+        from scrutiny.writer import DBWriter
+        return DBWriter(self)
+
+
+    def get_reports(self):
+
+        """
+        Cached reports over this database, see scrutiny/reports.py. Keep
+        hold of it for the cache to be any use.
+        """
+
+        from scrutiny.reports import Reports
+        return Reports(self.engine)
 
+
+    def get_analytics(self, since=None, until=None):
+
+        """
+        The attempts and bans from since until until as column arrays, see
+        scrutiny/analytics.py. Needs numpy, so it's only imported here.
+        """
+
+        from scrutiny.analytics import EventStore
+        return EventStore.from_db(self.session, since, until)
+
+
+    def follow(self, workers=PARSE_WORKERS):
+
+        import asyncio
+        from scrutiny.follow import LogFollower
+
+        # Catch up on anything written since the last run, including in
+        # files that have been rotated since, then tail the current logs
+        self.parse(workers, incremental=True)
+        self.logger.info('Following logs in {}...'.format(LOG_DIR))
+        asyncio.run(LogFollower(self).run())
+        self.report_metrics()
+        self.logger.info('Finished!')
+
+
+    def parse_journal(self, stream=None, follow=False):
+
+        """
+        Reads sshd's attempts from the systemd journal, or from stream if
+        it's given (journalctl -o export or -o json output), starting after
+        the entry the last run finished on. Each batch is inserted, and then
+        its cursor saved, by the DB writer while the next one is read.
+        """
+
+        from scrutiny.handlers.journal import JournalReader, JournalStreamReader
+        from scrutiny.checkpoints import CursorStore
+        from scrutiny.events import SequencedEvents
+        self.logger.info('Reading journal...')
+        if stream is None:
+            reader = JournalReader()
+        else:
+            reader = JournalStreamReader(stream)
+        cursors = CursorStore(self.session)
+        reader.seek(cursors.get(reader.unit_name))
+        matches = cursors.seed(reader.unit_name, SequencedEvents())
+
+        if follow:
+            batches = reader.follow(matches)
+        else:
+            batches = reader.batches(matches)
+        def save_cursor(cursor, matches):
+            # Called by the writer once the batch the cursor ends is in
+            cursors.mark(reader.unit_name, cursor, matches)
+            cursors.save()
+
+        try:
+            # The next batch is read and matched while the last is inserted
+            with self.get_writer() as writer:
+                for matches, cursor in batches:
+                    unique_ips = set(ip for ip, user in matches.values())
+                    writer.submit(unique_ips, matches, {},
+                                  then=None if cursor is None else partial(save_cursor, cursor, matches))
+        except KeyboardInterrupt:
+            # Whatever was queued has been written and its cursor saved
+            pass
+
+        self.report_metrics()
         self.logger.info('Finished!')
 
 
     def setup_test_data(self):
 
+        from scrutiny.tests import populate_test_data
+        from scrutiny.rollups import rebuild_rollups
         self.logger.info('Setup test data')
         last_month = datetime.now().replace(day=1) - timedelta(days=1)
         #print('Timezone setup...')
         #displayed_time, time_offset, sys_tz = self.tz_setup()
         self.create_db()
         populate_test_data(self.session)
+        rebuild_rollups(self.session)
         self.calculate_common_subnets()
 
         #self.delete_db()
@@ -24,19 +24,98 @@ else:
     API_KEY = config.get("credentials", "API_KEY")
     DATABASE_URI = "mysql+oursql://" + username + ":" + password + "@localhost/mojibake"
 
+# How many rows are looked up and inserted at a time when writing the results
+# to the DB. Kept under 999 as that's the most parameters older versions of
+# SQLite allow in one statement
+DB_CHUNK_SIZE = 500
+# SQLite is run in WAL mode, so reading the DB doesn't hold up writing to it,
+# with synchronous=NORMAL rather than an fsync on every commit (see
+# scrutiny/engine.py). Set SQLITE_SYNCHRONOUS to None to leave it as it is
+SQLITE_WAL = True
+SQLITE_SYNCHRONOUS = 'NORMAL'
+# The connection pool for other DBs (MySQL). Connections are recycled after
+# DB_POOL_RECYCLE seconds, before the server's wait_timeout drops them
+DB_POOL_SIZE = 5
+DB_POOL_RECYCLE = 3600
+# How many batches of results can wait for the DB writer thread (see
+# scrutiny/writer.py) before whatever's reading the logs has to wait for it
+DB_WRITER_QUEUE_SIZE = 4
 
 HOST_SERVER_NAME = 'defestri'
 LOG_DIR = '/var/log/'
 #LOG_DIR = 'F:/Temp/'
+# Number of processes used to parse the log files, each file is parsed
+# by a single process so there's no point having more than there are files
+PARSE_WORKERS = 1
+# Memory map uncompressed logs and match them as bytes, decoding only the
+# lines that match, rather than reading and decoding them line by line
+MMAP_LOGS = True
+# Only read what's been added to the logs since the last run (see
+# scrutiny/checkpoints.py) rather than rereading all of last month each time
+INCREMENTAL = True
+# How often (in seconds) --follow checks the logs for new lines, and how
+# many matches or seconds it lets build up before writing them to the DB
+FOLLOW_POLL_INTERVAL = 1
+FOLLOW_BATCH_SIZE = 100
+FOLLOW_FLUSH_INTERVAL = 5
+# Time each stage of a run and count what went through it, the numbers are
+# logged at the end and, if a path is given, written out as JSON and/or for
+# Prometheus' node_exporter textfile collector (see scrutiny/metrics.py)
+METRICS = True
+METRICS_JSON_FILE = None
+METRICS_PROMETHEUS_FILE = None
+# How many report results scrutiny/reports.py keeps cached
+REPORT_CACHE_SIZE = 128
+# How many rows at a time scrutiny/analytics.py reads from the DB
+ANALYTICS_CHUNK_SIZE = 100000
+# Keep a Bloom filter of the attempts and bans in the DB so insert_into_db
+# only has to check the ones that might be duplicates (see scrutiny/dedup.py).
+# Off by default: with the unique indexes in place the DB turns duplicates
+# away in the same statement that inserts the rest, and against a local
+# SQLite DB that's quicker than checking the filter (see
+# benchmarks/bench_dedup.py). The file goes next to an SQLite DB unless
+# DEDUP_FILTER_FILE says otherwise, other DBs need it set. It's sized for at
+# least DEDUP_FILTER_CAPACITY events with DEDUP_FILTER_ERROR_RATE of the new
+# ones taken for possible duplicates
+DEDUP_FILTER = False
+DEDUP_FILTER_FILE = None
+DEDUP_FILTER_CAPACITY = 1000000
+DEDUP_FILTER_ERROR_RATE = 0.001
 
-# Search string for the usual invalid user login attempts from /var/log/auth.log
-# Jun 10 12:40:05 defestri sshd[11019]: Invalid user admin from 61.174.51.217
-SEARCH_STRING = '(?P<log_date>^.*) {server} sshd.*Invalid user (?P<user>.*) from (?P<ip_add>\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}})'.format(server=HOST_SERVER_NAME)
-# Search string for root login attempts from /var/log/auth.log
-# Jun  8 04:31:10 defestri sshd[5013]: User root from 116.10.191.234 not allowed because none of user's groups are listed in AllowGroups
-ROOT_NOT_ALLOWED_SEARCH_STRING = '(?P<log_date>^.*) {server} sshd.*User (?P<user>.*) from (?P<ip_add>\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}\.\d{{1,3}}) not allowed'.format(server=HOST_SERVER_NAME)
-# Search string for fail2ban banning repeat offenders as logged in /var/log/fail2ban.log
-# 2014-06-10 12:40:07,363 fail2ban.actions: WARNING [ssh] Ban 61.174.51.217
-FAIL2BAN_SEARCH_STRING = '(?P<log_date>^.*) fail2ban.actions: WARNING \[ssh] Ban (?P<ip_add>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+# What to look for in which log files is set out in rules.ini (see
+# scrutiny/rules.py for the format), add your own rule files after it.
+# Sections in later files replace ones with the same name in earlier ones
+RULES_FILES = [os.path.join(APP_DIR, 'rules.ini')]
+
+# The patterns are anchored and spell out the date so a line that isn't ours
+# fails in the first few characters instead of backtracking across the whole
+# line. These are the parts that rules.ini fills in for %(syslog_date)s,
+# %(ymd_date)s and %(ip)s
+SYSLOG_DATE = r'(?P<log_date>[A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2})'
+YMD_DATE = r'\d{4}[-/]\d{2}[-/]\d{2} \d{2}:\d{2}:\d{2}'
+IP_ADDRESS = r'(?P<ip_add>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+# sshd's entries in the systemd journal, where the message comes without
+# the syslog date and host name
+JOURNAL_SEARCH_STRING = r'^Invalid user (?P<user>.*) from {ip}'.format(ip=IP_ADDRESS)
+JOURNAL_NOT_ALLOWED_SEARCH_STRING = r'^User (?P<user>.*) from {ip} not allowed'.format(ip=IP_ADDRESS)
+# Journal entries are matched JOURNAL_BATCH_SIZE at a time, the results of
+# each batch go into the DB along with the cursor of the last entry in it.
+# When following the journal we wait up to JOURNAL_WAIT_TIMEOUT seconds at
+# a time for new entries
+JOURNAL_BATCH_SIZE = 1000
+JOURNAL_WAIT_TIMEOUT = 5
 
 API_URL = 'http://api.ipinfodb.com/v3/ip-city/'
+# Lookups against the API are made GEOIP_WORKERS at a time, no more than
+# GEOIP_RATE a second on average (in bursts of up to GEOIP_BURST). Answers
+# are cached in the DB for GEOIP_CACHE_TTL seconds, or GEOIP_NEGATIVE_CACHE_TTL
+# if the API didn't know or the lookup failed
+GEOIP_WORKERS = 4
+GEOIP_RATE = 2
+GEOIP_BURST = 4
+GEOIP_CACHE_TTL = 180 * 24 * 60 * 60
+GEOIP_NEGATIVE_CACHE_TTL = 24 * 60 * 60
+# A local database of IP ranges to look locations up in instead of the API
+# above, either a CSV or one compiled with scrutiny.py --compile-geoip.
+# See scrutiny/geoip.py for the format
+GEOIP_DATABASE = None
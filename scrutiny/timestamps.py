@@ -0,0 +1,82 @@
+"""
+Parsers for the timestamps at the start of syslog, fail2ban and nginx lines.
+
+datetime.strptime is general purpose, it takes a lock and works through the
+format string for every call. The formats we see are fixed width though, so
+these just slice the fields out. The date part only changes once a day, so
+it's worked out once per distinct day and cached.
+"""
+
+from datetime import datetime
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+
+class SyslogTimestampParser():
+
+    """
+    Parses syslog timestamps, e.g. 'Jun 10 12:40:05' or 'Jun  8 04:31:10'.
+
+    syslog doesn't log the year. If year is given every timestamp is put in
+    that year, otherwise it's inferred from reference (now by default): a
+    month later in the year than the reference month must be from the year
+    before, so a log running from December into January comes out right.
+    """
+
+    def __init__(self, year=None, reference=None):
+        self.year = year
+        self.reference = reference or datetime.now()
+        self.days = {}
+
+    def parse_day(self, text):
+        month = MONTHS[text[:3]]
+        day = int(text[4:6])
+        if self.year is not None:
+            year = self.year
+        elif month > self.reference.month:
+            year = self.reference.year - 1
+        else:
+            year = self.reference.year
+        # Checks the day exists (e.g. Feb 29) before it's cached
+        datetime(year, month, day)
+        return year, month, day
+
+    def parse(self, text):
+        key = text[:6]
+        try:
+            year, month, day = self.days[key]
+        except KeyError:
+            year, month, day = self.days[key] = self.parse_day(text)
+        return datetime(year, month, day,
+                        int(text[7:9]), int(text[10:12]), int(text[13:15]))
+
+
+class Fail2banTimestampParser():
+
+    """
+    Parses fail2ban timestamps, e.g. '2014-06-10 12:40:07,363', the same as
+    strptime with '%Y-%m-%d %H:%M:%S,%f' would. The fields are picked out by
+    position so nginx's '2014/06/10 12:40:05' works too, it's the 'ymd'
+    timestamp in rules.ini.
+    """
+
+    def __init__(self):
+        self.days = {}
+
+    def parse(self, text):
+        key = text[:10]
+        try:
+            year, month, day = self.days[key]
+        except KeyError:
+            year, month, day = int(text[:4]), int(text[5:7]), int(text[8:10])
+            datetime(year, month, day)
+            self.days[key] = year, month, day
+        # Like %f the fraction is padded out to microseconds, ',363' is
+        # 363000 of them
+        microsecond = int(text[20:26].ljust(6, '0')) if len(text) > 20 else 0
+        return datetime(year, month, day,
+                        int(text[11:13]), int(text[14:16]), int(text[17:19]),
+                        microsecond)
@@ -0,0 +1,68 @@
+"""
+Odds and ends used around Scrutiny.
+"""
+
+import os
+import functools
+
+# Where the zone files are, /etc/localtime is usually a link into here
+ZONEINFO_DIR = '/usr/share/zoneinfo/'
+
+
+def chunks(items, size):
+
+    """
+    Yields successive slices of items, each at most size long.
+    """
+
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@functools.lru_cache()
+def os_release(path='/etc/os-release'):
+
+    """
+    The fields of /etc/os-release (NAME, VERSION_ID and so on) as a dict,
+    empty if there isn't one. Read once per process.
+    """
+
+    fields = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, sep, value = line.strip().partition('=')
+                if sep and not name.startswith('#'):
+                    fields[name] = value.strip('"\'')
+    except OSError:
+        pass
+    return fields
+
+
+@functools.lru_cache()
+def system_timezone():
+
+    """
+    The name of the system's time zone, e.g. Australia/Brisbane, from TZ,
+    /etc/timezone (Debian) or where /etc/localtime links to, or None if
+    none of them say. Worked out once per process, without running
+    anything.
+    """
+
+    zone = os.environ.get('TZ', '').lstrip(':')
+    if zone and not zone.startswith('/'):
+        return zone
+    try:
+        with open('/etc/timezone') as f:
+            zone = f.read().strip()
+        if zone:
+            return zone
+    except OSError:
+        pass
+    try:
+        target = os.path.realpath('/etc/localtime')
+    except OSError:
+        return None
+    if target.startswith(ZONEINFO_DIR):
+        return target[len(ZONEINFO_DIR):]
+    return None
@@ -0,0 +1,128 @@
+"""
+Writes results to the database from a thread of its own, so the logs of the
+next host, or the next batch of the journal, are read while the last one is
+being inserted. Batches go through a queue of at most DB_WRITER_QUEUE_SIZE,
+so reading can only get so far ahead of writing before it waits.
+
+The writer thread uses the Scrutiny's session, and nothing else may while
+it's running. So whatever has to be written once a batch is in, like its
+checkpoints, is handed over along with it as a function to call afterwards.
+
+    with scrutiny.get_writer() as writer:
+        for attempts, bans, checkpoints in batches:
+            writer.submit(ips, attempts, bans, then=checkpoints.save)
+
+Leaving the with block waits for everything queued to be written. If a
+batch fails, the ones after it are dropped, their follow up functions
+aren't called, and the error is raised by the next submit, or on leaving.
+
+An in-memory SQLite database only exists on the connection it was created
+on, which would be the wrong one in another thread. Against one of those,
+as in the tests, each batch is written as it's submitted instead.
+"""
+
+import queue
+import logging
+import threading
+
+from scrutiny.engine import memory_database
+from scrutiny.settings import DB_WRITER_QUEUE_SIZE, HOST_SERVER_NAME
+
+logger = logging.getLogger('scrutiny')
+
+
+class DBWriter():
+
+    """
+    Inserts batches of (ips, breakin_attempts, bans) with
+    Scrutiny.insert_into_db in a background thread.
+    """
+
+    def __init__(self, scrutiny, queue_size=DB_WRITER_QUEUE_SIZE, threaded=True):
+        self.scrutiny = scrutiny
+        self.threaded = threaded and not memory_database(scrutiny.engine)
+        self.batches = queue.Queue(maxsize=max(queue_size, 1))
+        self.thread = None
+        self.error = None
+        self.inserted = 0
+
+    def start(self):
+        if self.threaded and self.thread is None:
+            # The session is the writer's from here on, let go of any
+            # connection this thread has open
+            self.scrutiny.session.commit()
+            self.thread = threading.Thread(target=self.run, name='scrutiny-db-writer',
+                                           daemon=True)
+            self.thread.start()
+        return self
+
+    def submit(self, ips, breakin_attempts, bans, host=HOST_SERVER_NAME, then=None):
+
+        """
+        Queues a batch to be inserted, and then to be called once it has
+        been. Waits if the queue is full.
+        """
+
+        self.raise_error()
+        batch = (ips, breakin_attempts, bans, host, then)
+        if self.thread is None:
+            self.write(batch)
+        else:
+            self.batches.put(batch)
+
+    def write(self, batch):
+        ips, breakin_attempts, bans, host, then = batch
+        if breakin_attempts or bans:
+            self.inserted += self.scrutiny.insert_into_db(ips, breakin_attempts, bans,
+                                                          host=host)
+        if then is not None:
+            then()
+
+    def run(self):
+        session = self.scrutiny.session
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                # Skip the rest, they'll be read again next time
+                continue
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.exception('Writing to the database failed')
+                self.error = e
+                session.rollback()
+        # Hand the session back without a connection from this thread
+        session.commit()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+
+        """
+        Waits for everything queued to be written, then raises the error
+        that stopped the writer, if anything did.
+        """
+
+        if self.thread is not None:
+            self.batches.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Already on the way out with an error of our own, don't hide it
+            # behind one from the writer
+            try:
+                self.close()
+            except Exception:
+                pass